@@ -0,0 +1,90 @@
+#
+# A benchmark for the notification snapshot transforms.
+#
+# Measures the CPU time spent per notification snapshot for the common camera settings, with and without the jpeg draft decode.
+# Run it on the target device (like an ARM printer board) to see the real cost.
+#
+#   python3 developer/snapshottransformbenchmark.py [frame.jpg ...]
+#
+# If no sample frames are given, synthetic frames of the common webcam sizes are used. Real frames are better, since the
+# jpeg decode cost depends on the image content.
+#
+import io
+import os
+import sys
+import time
+import logging
+
+# Allow the script to be run from the repo root or the developer folder.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.snapshotresizeparams import SnapshotResizeParams
+from octoeverywhere.Webcam.snapshottransform import SnapshotTransformer
+
+
+# The number of times each case is run.
+c_Iterations = 20
+
+# The synthetic frame sizes used if no sample frames are given.
+c_SyntheticSizes = ((640, 480), (1280, 720), (1920, 1080), (2560, 1440))
+
+# name, flipH, flipV, rotation, resize params
+c_Cases = (
+    ("notification", False, False, 0, lambda: SnapshotResizeParams(1080, True, False, False)),
+    ("notification rotate 90", False, False, 90, lambda: SnapshotResizeParams(1080, True, False, False)),
+    ("notification flip h+v", True, True, 0, lambda: SnapshotResizeParams(1080, True, False, False)),
+    ("gadget crop square", False, False, 0, lambda: SnapshotResizeParams(1080, False, False, True)),
+    ("gadget crop square rotate 270", True, False, 270, lambda: SnapshotResizeParams(1080, False, False, True)),
+    ("small crop square", False, False, 0, lambda: SnapshotResizeParams(360, False, False, True)),
+)
+
+
+def GetFrames():
+    frames = []
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, "rb") as f:
+                frames.append((os.path.basename(path), f.read()))
+        return frames
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+    from PIL import ImageDraw
+    for width, height in c_SyntheticSizes:
+        img = Image.new("RGB", (width, height), (40, 40, 40))
+        draw = ImageDraw.Draw(img)
+        # Add some detail, so the jpeg isn't trivial to decode.
+        for i in range(0, width, 16):
+            draw.line((i, 0, width - i, height), fill=(i % 255, (i * 3) % 255, 128), width=3)
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=90)
+        frames.append((f"synthetic {width}x{height}", buffer.getvalue()))
+    return frames
+
+
+def Measure(transformer:SnapshotTransformer, frame, flipH, flipV, rotation, paramsFactory) -> float:
+    # Run once to build the plan, like a camera that's been running for a bit.
+    transformer.Transform(frame, flipH, flipV, rotation, paramsFactory())
+    start = time.process_time()
+    for _ in range(c_Iterations):
+        transformer.Transform(frame, flipH, flipV, rotation, paramsFactory())
+    return (time.process_time() - start) * 1000.0 / c_Iterations
+
+
+def Main():
+    if SnapshotTransformer.IsSupported() is False:
+        print("PIL failed to import, the snapshot transforms can't run.")
+        return
+    logger = logging.getLogger("benchmark")
+    withDraft = SnapshotTransformer(logger, useDraft=True)
+    withoutDraft = SnapshotTransformer(logger, useDraft=False)
+    print(f"{'frame':<28} {'case':<32} {'full decode ms':>15} {'draft ms':>10}")
+    for frameName, frame in GetFrames():
+        for name, flipH, flipV, rotation, paramsFactory in c_Cases:
+            fullMs = Measure(withoutDraft, frame, flipH, flipV, rotation, paramsFactory)
+            draftMs = Measure(withDraft, frame, flipH, flipV, rotation, paramsFactory)
+            print(f"{frameName:<28} {name:<32} {fullMs:>15.2f} {draftMs:>10.2f}")
+
+
+if __name__ == '__main__':
+    Main()
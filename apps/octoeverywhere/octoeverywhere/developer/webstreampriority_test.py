@@ -0,0 +1,101 @@
+#
+# Tests for the web stream priority gate.
+#
+#   python3 developer/webstreampriority_test.py
+#
+import os
+import sys
+import time
+import threading
+import unittest
+
+# Allow the script to be run from the repo root or the developer folder.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.WebStream.octowebstreampriority import OctoWebStreamPriorityGate
+from octoeverywhere.Proto import MessagePriority
+
+
+# Extra time allowed for thread scheduling on slow machines.
+c_SlackSec = 0.25
+
+
+class WebStreamPriorityGateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.Gate = OctoWebStreamPriorityGate()
+
+
+    def test_NoHighPriStreamDoesNotBlock(self):
+        start = time.time()
+        self.Gate.WaitForRequestStart(MessagePriority.MessagePriority.Normal)
+        self.assertLess(time.time() - start, c_SlackSec)
+
+
+    def test_HighPriRequestIsNeverBlocked(self):
+        self.Gate.HighPriStreamStarted()
+        start = time.time()
+        self.Gate.WaitForRequestStart(MessagePriority.MessagePriority.High)
+        self.assertLess(time.time() - start, c_SlackSec)
+
+
+    def test_ReleasedWhenLastHighPriStreamEnds(self):
+        self.Gate.HighPriStreamStarted()
+        self.Gate.HighPriStreamStarted()
+        def endStreams():
+            time.sleep(0.05)
+            self.Gate.HighPriStreamEnded()
+            time.sleep(0.05)
+            self.Gate.HighPriStreamEnded()
+        t = threading.Thread(target=endStreams)
+        t.start()
+        start = time.time()
+        self.Gate.WaitForRequestStart(MessagePriority.MessagePriority.Normal)
+        elapsedSec = time.time() - start
+        t.join()
+        self.assertGreaterEqual(elapsedSec, 0.09)
+        self.assertLess(elapsedSec, OctoWebStreamPriorityGate.c_MaxRequestStartWaitSec)
+
+
+    def test_SteadyHighPriStreamsDoNotHoldBackRequests(self):
+        # Keep starting overlapping high pri streams, so there's always at least one active
+        # and a new one starts while each request is waiting.
+        stop = threading.Event()
+        def startStreams():
+            while stop.is_set() is False:
+                self.Gate.HighPriStreamStarted()
+                threading.Timer(0.2, self.Gate.HighPriStreamEnded).start()
+                time.sleep(0.05)
+        t = threading.Thread(target=startStreams)
+        t.start()
+        try:
+            time.sleep(0.1)
+            for _ in range(4):
+                start = time.time()
+                self.Gate.WaitForRequestStart(MessagePriority.MessagePriority.Normal)
+                elapsedSec = time.time() - start
+                self.assertGreater(self.Gate.ActiveHighPriStreamCount, 0)
+                self.assertLess(elapsedSec, OctoWebStreamPriorityGate.c_MaxRequestStartWaitSec + c_SlackSec)
+        finally:
+            stop.set()
+            t.join()
+            time.sleep(0.3)
+        self.assertEqual(self.Gate.ActiveHighPriStreamCount, 0)
+
+
+    def test_NewHighPriStreamsDoNotExtendTheHighPriPeriod(self):
+        self.Gate.HighPriStreamStarted()
+        firstStart = self.Gate.ActiveHighPriStreamStart
+        time.sleep(0.05)
+        self.Gate.HighPriStreamStarted()
+        self.assertEqual(self.Gate.ActiveHighPriStreamStart, firstStart)
+        # Once all of the high pri streams end, the next one starts a new period.
+        self.Gate.HighPriStreamEnded()
+        self.Gate.HighPriStreamEnded()
+        self.Gate.HighPriStreamStarted()
+        self.assertGreater(self.Gate.ActiveHighPriStreamStart, firstStart)
+
+
+if __name__ == '__main__':
+    unittest.main()
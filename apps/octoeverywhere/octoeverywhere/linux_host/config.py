@@ -31,6 +31,7 @@ class Config:
     RelaySection = "relay"
     RelayFrontEndPortKey = "frontend_port"            # This field is shared with the installer, the installer can write this value. It the name can't change!
     RelayFrontEndTypeHintKey = "frontend_type_hint"   # This field is shared with the installer, the installer can write this value. It the name can't change!
+    RelayWebStreamWorkerPoolSizeKey = "webstream_worker_pool_size"
 
 
     #
@@ -44,6 +45,7 @@ class Config:
     WebcamFlipH = "flip_horizontally"
     WebcamFlipV = "flip_vertically"
     WebcamRotation = "rotate"
+    WebcamSnapshotCacheFreshnessMsKey = "snapshot_cache_freshness_ms"
 
 
     #
@@ -82,6 +84,7 @@ class Config:
     c_ConfigComments = [
         { "Target": RelayFrontEndPortKey,  "Comment": "The port used for http relay. If your desired frontend runs on a different port, change this value. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": RelayFrontEndTypeHintKey,  "Comment": "A string only used by the UI to hint at what web interface this port is."},
+        { "Target": RelayWebStreamWorkerPoolSizeKey,  "Comment": "The max number of pooled threads used to handle relay requests. Long lived requests, like webcam streams and downloads, move to their own thread so they don't hold a pooled thread. A value of 0 will use a thread per request. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": LogLevelKey,  "Comment": "The active logging level. Valid values include: DEBUG, INFO, WARNING, or ERROR."},
         { "Target": CompanionKeyIpOrHostname,  "Comment": "The IP or hostname this companion plugin will use to connect to Moonraker. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": CompanionKeyPort,  "Comment": "The port this companion plugin will use to connect to Moonraker. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
@@ -95,6 +98,7 @@ class Config:
         { "Target": WebcamFlipH,  "Comment": "Flips the webcam image horizontally. Valid values are True or False"},
         { "Target": WebcamFlipV,  "Comment": "Flips the webcam image vertically. Valid values are True or False"},
         { "Target": WebcamRotation,  "Comment": "Rotates the webcam image. Valid values are 0, 90, 180, or 270"},
+        { "Target": WebcamSnapshotCacheFreshnessMsKey,  "Comment": "How long in milliseconds a webcam snapshot can be reused by notifications, Gadget, and remote requests before a new one is taken. A value of 0 will always take a new snapshot. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": GeneralBedCooldownThresholdTempC,  "Comment": "The temperature in Celsius that the bed must be under to be considered cooled down. This is used to fire the Bed Cooldown Complete notification."},
         { "Target": ElegooMainboardId,  "Comment": "This is the mainboard id of the linked printer."},
     ]
@@ -1,8 +1,71 @@
 import logging
+import threading
+from collections import OrderedDict
+
+
+# Holds the metadata values for a single file.
+class FileMetadataCacheEntry:
+
+    def __init__(self, filename:str) -> None:
+        self.FileName = filename
+        self.Modified:float = None
+        self.EstimatedPrintTimeSec:float = -1.0
+        self.EstimatedFilamentUsageMm:int = -1
+        self.FileSizeKBytes:int = -1
+        self.LayerCount:float = -1.0
+        self.FirstLayerHeight:float = -1.0
+        self.LayerHeight:float = -1.0
+        self.ObjectHeight:float = -1.0
+
+
+    # Parses the values from a moonraker file metadata dict.
+    # This format is used by both server.files.metadata and the extended server.files.get_directory file items.
+    @staticmethod
+    def FromMetadata(filename:str, res:dict):
+        e = FileMetadataCacheEntry(filename)
+        if "modified" in res and res["modified"] is not None:
+            e.Modified = float(res["modified"])
+        if "estimated_time" in res and res["estimated_time"] is not None:
+            value = float(res["estimated_time"])
+            if value > 0.001:
+                e.EstimatedPrintTimeSec = value
+        if "size" in res and res["size"] is not None:
+            value = int(res["size"])
+            if value > 0:
+                e.FileSizeKBytes = int(value / 1024)
+        if "filament_total" in res and res["filament_total"] is not None:
+            value = int(res["filament_total"])
+            if value > 0:
+                e.EstimatedFilamentUsageMm = value
+        if "layer_count" in res and res["layer_count"] is not None:
+            value = float(res["layer_count"])
+            if value > 0:
+                e.LayerCount = value
+        if "first_layer_height" in res and res["first_layer_height"] is not None:
+            value = float(res["first_layer_height"])
+            if value > 0:
+                e.FirstLayerHeight = value
+        if "layer_height" in res and res["layer_height"] is not None:
+            value = float(res["layer_height"])
+            if value > 0:
+                e.LayerHeight = value
+        if "object_height" in res and res["object_height"] is not None:
+            value = float(res["object_height"])
+            if value > 0:
+                e.ObjectHeight = value
+        return e
+
 
 # A helper class that caches known file metadata info, so we don't have to pull it often.
+#
+# The cache holds the metadata for many files in a size bounded LRU, keyed by the file path and the file's modified time.
+# The modified times are tracked from the file list, which is warmed up with a single directory sweep when moonraker connects
+# and kept up to date by the notify_filelist_changed events. If a file changes, the modified time changes, so the old entry will not be used.
 class FileMetadataCache:
 
+    # The max number of files we will hold metadata for.
+    c_MaxEntries = 100
+
     _Instance = None
 
     @staticmethod
@@ -18,103 +81,163 @@ class FileMetadataCache:
     def __init__(self, logger:logging.Logger, moonrakerClient) -> None:
         self.Logger = logger
         self.MoonrakerClient = moonrakerClient
-        self.FileName:str = None
-        self.EstimatedPrintTimeSec:float = -1.0
-        self.EstimatedFilamentUsageMm:int = -1
-        self.FileSizeKBytes:int = -1
-        self.LayerCount:float = -1.0
-        self.FirstLayerHeight:float = -1.0
-        self.LayerHeight:float = -1.0
-        self.ObjectHeight:float = -1.0
-        self.ResetCache()
+        self.Lock = threading.Lock()
+        # Maps (filename, modified) -> FileMetadataCacheEntry, in LRU order.
+        self.Cache = OrderedDict()
+        # Maps filename -> the last known modified time, from the file list.
+        self.KnownModifiedTimes = {}
+        self.IsWarmUpRunning = False
 
 
-    # Clears the cache from all current values.
-    def ResetCache(self):
-        self.FileName = None
-        self.EstimatedPrintTimeSec = -1.0
-        self.EstimatedFilamentUsageMm = -1
-        self.FileSizeKBytes = -1
-        self.LayerCount = -1.0
-        self.FirstLayerHeight = -1.0
-        self.LayerHeight = -1.0
-        self.ObjectHeight = -1.0
+    # Clears the cache.
+    # If a filename is passed, only that file is removed, otherwise all files are removed.
+    def ResetCache(self, filename:str = None):
+        with self.Lock:
+            if filename is None:
+                self.Cache.clear()
+                return
+            self._RemoveFile_UnderLock(filename)
 
 
     # If the estimated time for the print can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1.0
     def GetEstimatedPrintTimeSec(self, filename:str) -> float:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedPrintTimeSec
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedPrintTimeSec
+        e = self._GetEntry(filename)
+        return -1.0 if e is None else e.EstimatedPrintTimeSec
 
 
     # If the filament usage can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetEstimatedFilamentUsageMm(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedFilamentUsageMm
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedFilamentUsageMm
+        e = self._GetEntry(filename)
+        return -1 if e is None else e.EstimatedFilamentUsageMm
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetFileSizeKBytes(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.FileSizeKBytes
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.FileSizeKBytes
+        e = self._GetEntry(filename)
+        return -1 if e is None else e.FileSizeKBytes
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # Any of the values will return -1 if they are unknown.
     def GetLayerInfo(self, filename:str):
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
+        e = self._GetEntry(filename)
+        if e is None:
+            return (-1.0, -1.0, -1.0, -1.0)
+        return (e.LayerCount, e.LayerHeight, e.FirstLayerHeight, e.ObjectHeight)
 
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
 
-        # Return the value, which could still be -1 if it failed.
-        return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
+    # Called by the moonraker client when a notify_filelist_changed message is received.
+    # We only need to invalidate the entries, the next get will pull the new metadata.
+    def OnFileListChanged(self, msg:dict) -> None:
+        if "params" not in msg:
+            return
+        for p in msg["params"]:
+            if isinstance(p, dict) is False:
+                continue
+            action = p.get("action", None)
+            item = p.get("item", None)
+            sourceItem = p.get("source_item", None)
+            if item is None or item.get("root", "gcodes") != "gcodes":
+                continue
+            path = item.get("path", None)
+            if path is None:
+                continue
+            with self.Lock:
+                if action in ("create_file", "modify_file"):
+                    self._RemoveFile_UnderLock(path)
+                    if "modified" in item and item["modified"] is not None:
+                        self.KnownModifiedTimes[path] = float(item["modified"])
+                elif action == "delete_file":
+                    self._RemoveFile_UnderLock(path)
+                elif action == "move_file":
+                    self._RemoveFile_UnderLock(path)
+                    if sourceItem is not None and "path" in sourceItem:
+                        self._RemoveFile_UnderLock(sourceItem["path"])
+                elif action in ("delete_dir", "move_dir"):
+                    self._RemoveDir_UnderLock(path)
+                    if sourceItem is not None and "path" in sourceItem:
+                        self._RemoveDir_UnderLock(sourceItem["path"])
+
+
+    # Called when moonraker is connected, this will do a single sweep of the gcode files to warm the cache.
+    # This runs async, so it doesn't block the caller.
+    def KickOffWarmUp(self) -> None:
+        with self.Lock:
+            if self.IsWarmUpRunning:
+                return
+            self.IsWarmUpRunning = True
+        t = threading.Thread(target=self._WarmUpThread, name="FileMetadataCacheWarmUp")
+        t.daemon = True
+        t.start()
+
+
+    def _WarmUpThread(self) -> None:
+        try:
+            # Since we might have missed file list changes while disconnected, start fresh.
+            with self.Lock:
+                self.Cache.clear()
+                self.KnownModifiedTimes.clear()
+            # Walk the gcode directories, the extended directory listing includes the metadata for each file.
+            # All of the directories at the same depth are requested at once, so each level of the tree only takes one round trip.
+            count = 0
+            dirs = ["gcodes"]
+            while len(dirs) > 0:
+                levelDirs = dirs
+                dirs = []
+                waitContexts = [self.MoonrakerClient.SendJsonRpcRequestAsync("server.files.get_directory",
+                {
+                    "path": dirPath,
+                    "extended": True
+                }) for dirPath in levelDirs]
+                results = self.MoonrakerClient.WaitForJsonRpcResponses(waitContexts)
+                for dirPath, result in zip(levelDirs, results):
+                    if result.HasError():
+                        self.Logger.warning("FileMetadataCache warm up failed to get directory. "+result.GetLoggingErrorStr())
+                        return
+                    res = result.GetResult()
+                    # The paths we get back are relative to the directory, but the cache uses paths relative to the gcodes root.
+                    prefix = "" if dirPath == "gcodes" else dirPath[len("gcodes/"):] + "/"
+                    for d in res.get("dirs", []):
+                        if "dirname" in d:
+                            dirs.append(dirPath + "/" + d["dirname"])
+                    with self.Lock:
+                        for f in res.get("files", []):
+                            if "filename" not in f:
+                                continue
+                            filename = prefix + f["filename"]
+                            e = FileMetadataCacheEntry.FromMetadata(filename, f)
+                            self.KnownModifiedTimes[filename] = e.Modified
+                            # Only cache the entries that have metadata, so files moonraker hasn't processed yet are pulled again later.
+                            if count < FileMetadataCache.c_MaxEntries and "estimated_time" in f:
+                                self._Put_UnderLock(e)
+                                count += 1
+            self.Logger.info(f"FileMetadataCache warm up complete; {count} files cached, {len(self.KnownModifiedTimes)} files known.")
+        except Exception as e:
+            self.Logger.warning(f"FileMetadataCache warm up failed. {e}")
+        finally:
+            with self.Lock:
+                self.IsWarmUpRunning = False
+
+
+    # Returns the cache entry for this file, pulling it from moonraker if needed. Returns None on failure.
+    def _GetEntry(self, filename:str) -> FileMetadataCacheEntry:
+        if filename is None:
+            return None
+        with self.Lock:
+            key = (filename, self.KnownModifiedTimes.get(filename, None))
+            e = self.Cache.get(key, None)
+            if e is not None:
+                self.Cache.move_to_end(key)
+                return e
+        # The file isn't cached or has changed, do a refresh now.
+        return self._RefreshFileMetaDataCache(filename)
 
 
     # Does a refresh of the file name metadata cache.
-    def _RefreshFileMetaDataCache(self, filename:str) -> None:
-
-        # Reset everything.
-        self.ResetCache()
-
+    def _RefreshFileMetaDataCache(self, filename:str) -> FileMetadataCacheEntry:
         # Make the call.
         result = self.MoonrakerClient.SendJsonRpcRequest("server.files.metadata",
         {
@@ -124,41 +247,37 @@ class FileMetadataCache:
         # If we fail this call, just return, which will keep the cache invalid.
         if result.HasError():
             self.Logger.error("_RefreshFileMetaDataCache failed to get file meta. "+result.GetLoggingErrorStr())
-            return
+            return None
 
         # If we got here, we know we got a good result.
-        # Set the cached vars so we don't call again, even though we might not be able to get them, meaning the file doesn't have them.
-        self.FileName = filename
+        # Cache the entry so we don't call again, even though we might not be able to get the values, meaning the file doesn't have them.
+        e = FileMetadataCacheEntry.FromMetadata(filename, result.GetResult())
+        with self.Lock:
+            self._RemoveFile_UnderLock(filename)
+            self.KnownModifiedTimes[filename] = e.Modified
+            self._Put_UnderLock(e)
+
+        self.Logger.info(f"FileMetadataCache updated for file [{filename}]; est time: {str(e.EstimatedPrintTimeSec)}, size: {str(e.FileSizeKBytes)}, filament usage: {str(e.EstimatedFilamentUsageMm)}")
+        return e
+
+
+    def _Put_UnderLock(self, e:FileMetadataCacheEntry) -> None:
+        key = (e.FileName, e.Modified)
+        self.Cache[key] = e
+        self.Cache.move_to_end(key)
+        while len(self.Cache) > FileMetadataCache.c_MaxEntries:
+            self.Cache.popitem(last=False)
+
+
+    def _RemoveFile_UnderLock(self, filename:str) -> None:
+        self.KnownModifiedTimes.pop(filename, None)
+        for key in [k for k in self.Cache if k[0] == filename]:
+            del self.Cache[key]
 
-        # Get the value, if it exists and it's valid.
-        res = result.GetResult()
-        if "estimated_time" in res:
-            value = float(res["estimated_time"])
-            if value > 0.001:
-                self.EstimatedPrintTimeSec = value
-        if "size" in res:
-            value = int(res["size"])
-            if value > 0:
-                self.FileSizeKBytes = int(value / 1024)
-        if "filament_total" in res:
-            value = int(res["filament_total"])
-            if value > 0:
-                self.EstimatedFilamentUsageMm = value
-        if "layer_count" in res and res["layer_count"] is not None:
-            value = float(res["layer_count"])
-            if value > 0:
-                self.LayerCount = value
-        if "first_layer_height" in res and res["first_layer_height"] is not None:
-            value = float(res["first_layer_height"])
-            if value > 0:
-                self.FirstLayerHeight = value
-        if "layer_height" in res and res["layer_height"] is not None:
-            value = float(res["layer_height"])
-            if value > 0:
-                self.LayerHeight = value
-        if "object_height" in res and res["object_height"] is not None:
-            value = float(res["object_height"])
-            if value > 0:
-                self.ObjectHeight = value
 
-        self.Logger.info(f"FileMetadataCache updated for file [{filename}]; est time: {str(self.EstimatedPrintTimeSec)}, size: {str(self.FileSizeKBytes)}, filament usage: {str(self.EstimatedFilamentUsageMm)}")
+    def _RemoveDir_UnderLock(self, dirPath:str) -> None:
+        prefix = dirPath.rstrip("/") + "/"
+        for filename in [f for f in self.KnownModifiedTimes if f.startswith(prefix)]:
+            del self.KnownModifiedTimes[filename]
+        for key in [k for k in self.Cache if k[0].startswith(prefix)]:
+            del self.Cache[key]
@@ -260,7 +260,14 @@ class MoonrakerClient:
     # https://moonraker.readthedocs.io/en/latest/web_api/#websocket-setup
     #
     def SendJsonRpcRequest(self, method:str, paramsDict = None) -> JsonRpcResponse:
-        msgId = 0
+        return self.WaitForJsonRpcResponse(self.SendJsonRpcRequestAsync(method, paramsDict))
+
+
+    # Sends a rpc request via the connected websocket without waiting for the response.
+    # The returned waiting context must be passed to WaitForJsonRpcResponse or WaitForJsonRpcResponses to get the response.
+    # This allows many requests to be in flight at once, so a caller only waits for the slowest response, rather than the sum of them.
+    # This will not throw, if the send fails the context is completed with the error response.
+    def SendJsonRpcRequestAsync(self, method:str, paramsDict = None) -> "JsonRpcWaitingContext":
         waitContext = None
         with self.JsonRpcIdLock:
             # Get our unique ID
@@ -268,10 +275,9 @@ class MoonrakerClient:
             self.JsonRpcIdCounter += 1
 
             # Add our waiting context.
-            waitContext = JsonRpcWaitingContext(msgId)
+            waitContext = JsonRpcWaitingContext(msgId, method)
             self.JsonRpcWaitingContexts[msgId] = waitContext
 
-        # From now on, we need to always make sure to clean up the wait context, even in error.
         try:
             # Create the request object
             obj = {
@@ -287,45 +293,81 @@ class MoonrakerClient:
             jsonStr = json.dumps(obj, default=str)
             if self._WebSocketSend(jsonStr) is False:
                 self.Logger.info("Moonraker client failed to send JsonRPC request "+method)
-                return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_WS_NOT_CONNECTED)
+                self._RemoveWaitingContext(msgId)
+                waitContext.SetResponse(JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_WS_NOT_CONNECTED))
 
-            # Wait for a response
-            waitContext.GetEvent().wait(MoonrakerClient.RequestTimeoutSec)
+        except Exception as e:
+            Sentry.Exception("Moonraker client json rpc request failed to send.", e)
+            self._RemoveWaitingContext(msgId)
+            waitContext.SetResponse(JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, str(e)))
+        return waitContext
 
-            # Check if we got a result.
-            result = waitContext.GetResult()
-            if result is None:
-                self.Logger.info("Moonraker client timeout while waiting for request. "+str(id)+" "+method)
-                return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_TIMEOUT)
 
-            # Check for an error if found, return the error state.
-            if "error" in result:
-                # Get the error parts
-                errorCode = JsonRpcResponse.OE_ERROR_EXCEPTION
-                errorStr = "Unknown"
-                if "code" in result["error"]:
-                    errorCode = result["error"]["code"]
-                if "message" in result["error"]:
-                    errorStr = result["error"]["message"]
-                return JsonRpcResponse(None, errorCode, errorStr)
-
-            # If there's a result, return the entire response
-            if "result" in result:
-                return JsonRpcResponse(result["result"])
-
-            # Finally, both are missing?
-            self.Logger.error("Moonraker client json rpc got a response that didn't have an error or result object? "+json.dumps(result))
-            return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, "No result or error object")
+    # Blocks until the response for the request is received or the request times out.
+    # If no timeout is passed, the default request timeout is used.
+    # This will not throw, it will always return a JsonRpcResponse which can be checked for errors or success.
+    def WaitForJsonRpcResponse(self, waitContext:"JsonRpcWaitingContext", timeoutSec:float = None) -> JsonRpcResponse:
+        # From now on, we need to always make sure to clean up the wait context, even in error.
+        try:
+            # Wait for a response
+            if timeoutSec is None:
+                timeoutSec = MoonrakerClient.RequestTimeoutSec
+            waitContext.GetEvent().wait(timeoutSec)
+
+            # Check if the request completed.
+            response = waitContext.GetResponse()
+            if response is None:
+                self.Logger.info("Moonraker client timeout while waiting for request. "+str(waitContext.Id)+" "+str(waitContext.Method))
+                return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_TIMEOUT)
+            return response
 
         except Exception as e:
-            Sentry.Exception("Moonraker client json rpc request failed to send.", e)
+            Sentry.Exception("Moonraker client json rpc request failed while waiting for the response.", e)
             return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, str(e))
 
         finally:
             # Before leaving, always clean up any waiting contexts.
-            with self.JsonRpcIdLock:
-                if msgId in self.JsonRpcWaitingContexts:
-                    del self.JsonRpcWaitingContexts[msgId]
+            self._RemoveWaitingContext(waitContext.Id)
+
+
+    # Waits for a group of requests sent with SendJsonRpcRequestAsync, returning the responses in the same order.
+    # The timeout applies to the entire group, not each request.
+    def WaitForJsonRpcResponses(self, waitContexts:list, timeoutSec:float = None) -> list:
+        if timeoutSec is None:
+            timeoutSec = MoonrakerClient.RequestTimeoutSec
+        deadlineSec = time.time() + timeoutSec
+        responses = []
+        for c in waitContexts:
+            responses.append(self.WaitForJsonRpcResponse(c, max(0.0, deadlineSec - time.time())))
+        return responses
+
+
+    # Builds the response for a json rpc response message from moonraker.
+    def _ParseJsonRpcResponse(self, msgObj) -> JsonRpcResponse:
+        # Check for an error if found, return the error state.
+        if "error" in msgObj:
+            # Get the error parts
+            errorCode = JsonRpcResponse.OE_ERROR_EXCEPTION
+            errorStr = "Unknown"
+            if "code" in msgObj["error"]:
+                errorCode = msgObj["error"]["code"]
+            if "message" in msgObj["error"]:
+                errorStr = msgObj["error"]["message"]
+            return JsonRpcResponse(None, errorCode, errorStr)
+
+        # If there's a result, return the entire response
+        if "result" in msgObj:
+            return JsonRpcResponse(msgObj["result"])
+
+        # Finally, both are missing?
+        self.Logger.error("Moonraker client json rpc got a response that didn't have an error or result object? "+json.dumps(msgObj))
+        return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, "No result or error object")
+
+
+    def _RemoveWaitingContext(self, msgId:int) -> None:
+        with self.JsonRpcIdLock:
+            if msgId in self.JsonRpcWaitingContexts:
+                del self.JsonRpcWaitingContexts[msgId]
 
 
     # Sends a string to the connected websocket.
@@ -404,6 +446,10 @@ class MoonrakerClient:
         # These objects can come in all shapes and sizes. So we only look for exactly what we need, if we don't find it
         # We ignore the object, someone else might match it.
 
+        # Print state changes make any cached printer status stale, so drop it before the handlers below query it.
+        if method == "notify_history_changed" or (method == "notify_status_update" and self._GetWsMsgParam(msg, "print_stats") is not None):
+            self.MoonrakerCompat.InvalidatePrinterStatus()
+
         # Used to watch for print starts, ends, and failures.
         if method == "notify_history_changed":
             actionContainerObj = self._GetWsMsgParam(msg, "action")
@@ -472,6 +518,12 @@ class MoonrakerClient:
         if method == "notify_webcams_changed":
             self.ConnectionStatusHandler.OnWebcamSettingsChanged()
 
+        # When files are added, changed, or removed, let the metadata cache invalidate any entries.
+        if method == "notify_filelist_changed":
+            fileMetadataCache = FileMetadataCache.Get()
+            if fileMetadataCache is not None:
+                fileMetadataCache.OnFileListChanged(msg)
+
 
     # If the message has a progress contained in the virtual_sdcard, this returns it. The progress is a float from 0.0->1.0
     # Otherwise None
@@ -537,7 +589,8 @@ class MoonrakerClient:
             # When the websocket closes, we need to clear out all pending waiting contexts.
             with self.JsonRpcIdLock:
                 for context in self.JsonRpcWaitingContexts.values():
-                    context.SetSocketClosed()
+                    context.SetResponse(JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_WS_NOT_CONNECTED))
+                self.JsonRpcWaitingContexts.clear()
 
             # This will only happen if the websocket closes or there was an error.
             # Sleep for a bit so we don't spam the system with attempts.
@@ -690,8 +743,10 @@ class MoonrakerClient:
             if "id" in msgObj:
                 with self.JsonRpcIdLock:
                     idInt = int(msgObj["id"])
-                    if idInt in self.JsonRpcWaitingContexts:
-                        self.JsonRpcWaitingContexts[idInt].SetResultAndEvent(msgObj)
+                    # Remove the context now, so requests that are never waited on don't leak.
+                    waitContext = self.JsonRpcWaitingContexts.pop(idInt, None)
+                    if waitContext is not None:
+                        waitContext.SetResponse(self._ParseJsonRpcResponse(msgObj))
                     else:
                         self.Logger.warn("Moonraker RPC response received for request "+str(idInt) + ", but there is no waiting context.")
                     # If once the response is handled, we are done.
@@ -757,29 +812,28 @@ class MoonrakerClient:
 
 
 # A helper class used for waiting rpc requests
+# This is returned by SendJsonRpcRequestAsync, and acts as the future for the response.
 class JsonRpcWaitingContext:
 
-    def __init__(self, msgId) -> None:
+    def __init__(self, msgId, method:str = None) -> None:
         self.Id = msgId
+        self.Method = method
         self.WaitEvent = threading.Event()
-        self.Result = None
+        self.Response:JsonRpcResponse = None
 
 
     def GetEvent(self):
         return self.WaitEvent
 
 
-    def GetResult(self):
-        return self.Result
-
-
-    def SetResultAndEvent(self, result):
-        self.Result = result
-        self.WaitEvent.set()
+    # Returns None if the request hasn't completed yet.
+    def GetResponse(self) -> JsonRpcResponse:
+        return self.Response
 
 
-    def SetSocketClosed(self):
-        self.Result = None
+    # Completes the request, with the response when it's received or with an error response if the request failed.
+    def SetResponse(self, response:JsonRpcResponse):
+        self.Response = response
         self.WaitEvent.set()
 
 
@@ -787,9 +841,29 @@ class JsonRpcWaitingContext:
 # common OctoEverywhere logic.
 class MoonrakerCompat:
 
+    # The printer objects needed by all of the printer state interface functions.
+    # They are all queried at once, so one round trip can serve all of the status functions.
+    PrinterStatusQueryObjects = {
+        "print_stats": None,
+        "gcode_move": None,
+        "virtual_sdcard": None,
+        "toolhead": None,
+        "extruder": None,
+        "heater_bed": None,
+    }
+
+    # How long a printer status query result can be reused for.
+    # The notification logic calls a few of the status functions back to back, so this lets them share one query.
+    c_PrinterStatusMaxAgeSec = 0.5
+
     def __init__(self, logger:logging.Logger, printerId:str, bedCooldownThresholdTempC:float) -> None:
         self.Logger = logger
 
+        # The last successful printer status query and when it was made.
+        self.PrinterStatusLock = threading.Lock()
+        self.PrinterStatusResult:JsonRpcResponse = None
+        self.PrinterStatusTimeSec = 0.0
+
         # This indicates if we are ready to process notifications, so we don't
         # fire any notifications before we run the print state sync logic.
         self.IsReadyToProcessNotifications = False
@@ -888,11 +962,9 @@ class MoonrakerCompat:
         if self.IsReadyToProcessNotifications is False:
             return
 
-        # Since this is a new print, reset the cache. The file name might be the same as the last, but have
-        # different props, so we will always reset. We know when we are printing the same file name will have the same props.
-        FileMetadataCache.Get().ResetCache()
-
         # Try to get the starting file info if we can.
+        # There's no need to reset the cache for this file, the entries are keyed by the file's modified time,
+        # so if a file with the same name was changed, the old entry won't be used.
         filamentUsageMm = FileMetadataCache.Get().GetEstimatedFilamentUsageMm(fileName)
         fileSizeKBytes = FileMetadataCache.Get().GetFileSizeKBytes(fileName)
 
@@ -975,18 +1047,38 @@ class MoonrakerCompat:
     # Printer State Interface
     #
 
+    # Queries all of the PrinterStatusQueryObjects in one printer.objects.query request.
+    # If a successful query was made in the last c_PrinterStatusMaxAgeSec, that result is returned instead.
+    # The result is shared between callers, so it must not be modified.
+    def QueryPrinterStatus(self) -> JsonRpcResponse:
+        # Hold the lock during the query, so concurrent callers wait for the one query rather than making their own.
+        with self.PrinterStatusLock:
+            if self.PrinterStatusResult is not None and time.time() - self.PrinterStatusTimeSec < MoonrakerCompat.c_PrinterStatusMaxAgeSec:
+                return self.PrinterStatusResult
+            result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+            {
+                "objects": MoonrakerCompat.PrinterStatusQueryObjects
+            })
+            # Only cache successful results, so a failure is retried on the next call.
+            if result.HasError():
+                self.PrinterStatusResult = None
+            else:
+                self.PrinterStatusResult = result
+                self.PrinterStatusTimeSec = time.time()
+            return result
+
+
+    # Called when the printer state changes, so the next status query isn't served from the cache.
+    def InvalidatePrinterStatus(self):
+        with self.PrinterStatusLock:
+            self.PrinterStatusResult = None
+
+
     # ! Interface Function ! The entire interface must change if the function is changed.
     # This function will get the estimated time remaining for the current print.
     # Returns -1 if the estimate is unknown.
     def GetPrintTimeRemainingEstimateInSeconds(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
-        {
-            "objects": {
-                "virtual_sdcard": None,
-                "print_stats": None,
-                "gcode_move": None,
-            }
-        })
+        result = self.QueryPrinterStatus()
         # Like on OctoPrint, this logic is complicated.
         # So we use a shared common function to handle it.
         return int(self.GetPrintTimeRemainingEstimateInSeconds_WithPrintStatsVirtualSdCardAndGcodeMoveResult(result))
@@ -996,13 +1088,7 @@ class MoonrakerCompat:
     # If the printer is warming up, this value would be -1. The First Layer Notification logic depends upon this!
     # Returns the current zoffset if known, otherwise -1.
     def GetCurrentZOffset(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
-        {
-            "objects": {
-                "toolhead": None,
-                "print_stats": None
-            }
-        })
+        result = self.QueryPrinterStatus()
         if result.HasError():
             self.Logger.error("GetCurrentZOffset failed to query toolhead objects: "+result.GetLoggingErrorStr())
             return False
@@ -1028,14 +1114,15 @@ class MoonrakerCompat:
     #     If the values are known, (currentLayer(int), totalLayers(int)) is returned.
     #          Note that total layers will always be > 0, but current layer can be 0!
     def GetCurrentLayerInfo(self):
+        result = self.QueryPrinterStatus()
+        return self.GetCurrentLayerInfo_WithPrintStatsAndGcodeMoveResult(result)
+
+
+    # Using the result of printer.objects.query with print_stats and gcode_move, this will get the current layer info.
+    # This allows callers that already query these objects to get the layer info without another round trip.
+    # Returns the same values as GetCurrentLayerInfo
+    def GetCurrentLayerInfo_WithPrintStatsAndGcodeMoveResult(self, result):
         try:
-            result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
-            {
-                "objects": {
-                    "print_stats": None,
-                    "gcode_move": None
-                }
-            })
             if result.HasError():
                 self.Logger.error("GetCurrentLayerInfo failed to query toolhead objects: "+result.GetLoggingErrorStr())
                 return (0,0)
@@ -1125,12 +1212,7 @@ class MoonrakerCompat:
         # For moonraker, we have found that if the print_stats reports a state of "printing"
         # but the "print_duration" is still 0, it means we are warming up. print_duration is the time actually spent printing
         # so it doesn't increment while the system is heating.
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
-        {
-            "objects": {
-                "print_stats": None
-            }
-        })
+        result = self.QueryPrinterStatus()
         # Use the common helper function.
         return self.CheckIfPrinterIsWarmingUp_WithPrintStats(result)
 
@@ -1138,13 +1220,7 @@ class MoonrakerCompat:
     # ! Interface Function ! The entire interface must change if the function is changed.
     # Returns the current hotend temp and bed temp as a float in celsius if they are available, otherwise None.
     def GetTemps(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
-        {
-            "objects": {
-                "extruder": None,       # Needed for temps
-                "heater_bed": None,     # Needed for temps
-            }
-        })
+        result = self.QueryPrinterStatus()
         # Validate
         if result.HasError():
             self.Logger.error("MoonrakerCommandHandler failed GetTemps() query. "+result.GetLoggingErrorStr())
@@ -1189,7 +1265,8 @@ class MoonrakerCompat:
 
 
     def _InitPrintStateForFreshConnect(self):
-        # Get the current state
+        # Get the current state, anything cached from before the connect is stale.
+        self.InvalidatePrinterStatus()
         stats = self._GetCurrentPrintStats()
         if stats is None:
             self.Logger.error("Moonraker client init sync failed to get the printer state.")
@@ -1207,12 +1284,7 @@ class MoonrakerCompat:
     # Queries moonraker for the current printer stats.
     # Returns null if the call falls or the resulting object DOESN'T contain at least: filename, state, total_duration, print_duration
     def _GetCurrentPrintStats(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
-        {
-            "objects": {
-                "print_stats": None
-            }
-        })
+        result = self.QueryPrinterStatus()
         # Validate
         if result.HasError():
             self.Logger.error("Moonraker client failed _GetCurrentPrintStats. "+result.GetLoggingErrorStr())
@@ -27,19 +27,8 @@ class MoonrakerCommandHandler:
     # Or one of the CommandHandler.c_CommandError_... ints can be returned, which will be sent as the result.
     #
     def GetCurrentJobStatus(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
-        {
-            "objects": {
-                "print_stats": None,    # Needed for many things, including GetPrintTimeRemainingEstimateInSeconds_WithPrintStatsAndVirtualSdCardResult
-                "gcode_move": None,     # Needed for GetPrintTimeRemainingEstimateInSeconds_WithPrintStatsAndVirtualSdCardResult to get the current speed
-                "virtual_sdcard": None, # Needed for many things, including GetPrintTimeRemainingEstimateInSeconds_WithPrintStatsAndVirtualSdCardResult
-                "extruder": None,       # Needed for temps
-                "heater_bed": None,     # Needed for temps
-                # "webhooks": None,
-                # "extruder": None,
-                # "bed_mesh": None,
-            }
-        })
+        # This shares the printer status query with the notification logic, so the result must not be modified.
+        result = MoonrakerClient.Get().GetMoonrakerCompat().QueryPrinterStatus()
         # Validate
         if result.HasError():
             self.Logger.error("MoonrakerCommandHandler failed GetCurrentJobStatus() query. "+result.GetLoggingErrorStr())
@@ -85,7 +74,7 @@ class MoonrakerCommandHandler:
         # Note this is similar to how we also do it for notifications.
         currentLayerInt = None
         totalLayersInt = None
-        currentLayerRaw, totalLayersRaw = MoonrakerClient.Get().GetMoonrakerCompat().GetCurrentLayerInfo()
+        currentLayerRaw, totalLayersRaw = MoonrakerClient.Get().GetMoonrakerCompat().GetCurrentLayerInfo_WithPrintStatsAndGcodeMoveResult(result)
         if totalLayersRaw is not None and totalLayersRaw > 0 and currentLayerRaw is not None and currentLayerRaw >= 0:
             currentLayerInt = int(currentLayerRaw)
             totalLayersInt = int(totalLayersRaw)
@@ -15,6 +15,7 @@ from octoeverywhere.commandhandler import CommandHandler
 from octoeverywhere.octoeverywhereimpl import OctoEverywhere
 from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.Proto.ServerHost import ServerHost
+from octoeverywhere.WebStream.octowebstreamworkerpool import OctoWebStreamWorkerPool
 from octoeverywhere.localip import LocalIpHelper
 from octoeverywhere.compat import Compat
 
@@ -129,6 +130,9 @@ class MoonrakerHost:
             # Init compression
             Compression.Init(self.Logger, localStorageDir)
 
+            # Setup the web stream worker pool. It can be disabled in the config, so each web stream uses its own thread.
+            OctoWebStreamWorkerPool.Init(self.Logger, self.Config.GetIntIfInRange(Config.RelaySection, Config.RelayWebStreamWorkerPoolSizeKey, OctoWebStreamWorkerPool.c_DefaultMaxWorkers, 0, 256))
+
             # Init the mdns client
             MDns.Init(self.Logger, localStorageDir)
 
@@ -174,7 +178,7 @@ class MoonrakerHost:
 
             # Setup the snapshot helper
             self.MoonrakerWebcamHelper = MoonrakerWebcamHelper(self.Logger, self.Config)
-            WebcamHelper.Init(self.Logger, self.MoonrakerWebcamHelper, localStorageDir)
+            WebcamHelper.Init(self.Logger, self.MoonrakerWebcamHelper, localStorageDir, self.Config.GetIntIfInRange(Config.WebcamSection, Config.WebcamSnapshotCacheFreshnessMsKey, WebcamHelper.c_DefaultSnapshotCacheFreshnessMs, 0, 60000))
 
             # Setup our smart pause helper
             SmartPause.Init(self.Logger)
@@ -347,6 +351,9 @@ class MoonrakerHost:
         # Also allow the database logic to ensure our public keys exist and are updated.
         self.MoonrakerDatabase.EnsureOctoEverywhereDatabaseEntry()
 
+        # Warm up the file metadata cache, so notifications don't need to wait on a metadata query.
+        FileMetadataCache.Get().KickOffWarmUp()
+
     #
     # MoonrakerClient ConnectionStatusHandler Interface - Called by the MoonrakerClient when it gets a message that the webcam settings have changed.
     #
@@ -0,0 +1,132 @@
+import logging
+
+
+#
+# A streaming parser for multipart http bodies, like mjpeg webcam streams.
+#
+# The parser works on bytes in a single growable buffer, so the headers are never decoded to strings and the frame data is never copied
+# more than once. Each call to ReadPart returns the length of the next full part, which is always at the start of the buffer, so the caller
+# can wrap it in a memoryview. Any data read past the end of a part is kept and used as the start of the next part, so no frames are dropped.
+#
+# If the part has a content-length header, we read exactly the rest of the part. If not, we search for the next boundary.
+#
+# Note that the caller must release any memoryview of the buffer before calling ReadPart again, since the buffer can't be resized while it's exported.
+#
+class MultipartStreamParser:
+
+    # The size we read while looking for the headers. We want to read enough that hopefully we get all of the headers in one read.
+    # 3/24/24 - After a lot of testing, it seems most times we get the full headers in 120 chars.
+    c_HeaderReadSizeBytes = 120
+
+    # If we can't find the end of the headers in this many bytes, we assume this isn't a normal multipart stream.
+    c_MaxHeaderSearchSizeBytes = 5 * 1024
+
+    # The max size we read at once when searching for a boundary in parts without a content-length header.
+    c_BoundarySearchReadSizeBytes = 64 * 1024
+
+    # The max size of a part without a content-length, before we give up and return what we have.
+    c_MaxPartWithoutContentLengthBytes = 10 * 1024 * 1024
+
+    c_EndOfHeaders = b"\r\n\r\n"
+    c_ContentLengthHeader = b"content-length:"
+
+
+    def __init__(self, logger:logging.Logger, boundaryStr:str) -> None:
+        self.Logger = logger
+        self.BoundaryStr = boundaryStr
+        boundary = boundaryStr.encode("utf-8")
+        self.DashBoundary = b"--" + boundary
+        # According the the RFC, the part should start with '--' + boundary string. However, we have also seen \r\n--<str> and also
+        # no dashes at all. These are in order of how common they are, for perf.
+        self.ValidPartStarts = (self.DashBoundary, boundary, b"\r\n" + self.DashBoundary)
+
+        # The buffer holds the current part at the start, followed by any data read past it.
+        self.Buffer = bytearray()
+        self.PartLength = 0
+
+        # Set if we didn't find any headers, which means this stream can't be parsed as parts.
+        self.HeadersNotFound = False
+        self.MissingBoundaryWarningCounter = 0
+        self.PartsWithoutContentLength = 0
+
+
+    # Reads the next part from the stream.
+    # readFunc(size) must block until size bytes are read and return None at the end of the stream.
+    # readAvailableFunc(size) must return up to size bytes, whatever is available, and None at the end of the stream.
+    # Returns the length of the part at the start of Buffer, 0 if the stream is done.
+    def ReadPart(self, readFunc, readAvailableFunc) -> int:
+        # Drop the last part, keeping anything we read past it.
+        if self.PartLength > 0:
+            del self.Buffer[:self.PartLength]
+            self.PartLength = 0
+
+        # First, find the end of the headers.
+        headerEnd = self.Buffer.find(MultipartStreamParser.c_EndOfHeaders)
+        while headerEnd == -1:
+            if len(self.Buffer) >= MultipartStreamParser.c_MaxHeaderSearchSizeBytes:
+                # We didn't find headers, so return what we have and tell the caller to stop using the parser.
+                self.HeadersNotFound = True
+                return self._SetPart(len(self.Buffer))
+            # Only search the new data, backing up enough to find an end of headers split across reads.
+            searchStart = max(0, len(self.Buffer) - 3)
+            data = readFunc(MultipartStreamParser.c_HeaderReadSizeBytes)
+            if data is None:
+                return self._SetPart(len(self.Buffer))
+            self.Buffer += data
+            headerEnd = self.Buffer.find(MultipartStreamParser.c_EndOfHeaders, searchStart)
+        headerSize = headerEnd + len(MultipartStreamParser.c_EndOfHeaders)
+
+        # Validate the part starts with what we expect. This might fire once or twice, and that's fine.
+        if self.Buffer.startswith(self.ValidPartStarts) is False:
+            # Always report the first time we find this, otherwise, report only occasionally.
+            if self.MissingBoundaryWarningCounter % 120 == 0:
+                self.Logger.warn("We read a web stream body frame, but it didn't start with the expected boundary header. expected:'"+self.BoundaryStr+"' got:^^"+bytes(self.Buffer[:40]).decode(errors="ignore")+"^^")
+            self.MissingBoundaryWarningCounter += 1
+
+        # Look for the content length. Only the headers are lowered, which are small.
+        contentLength = self._GetContentLength(headerEnd)
+        if contentLength is not None:
+            # We have a content-length, add two bytes for the \r\n at the end of this part.
+            partEnd = headerSize + contentLength + 2
+            while len(self.Buffer) < partEnd:
+                data = readFunc(partEnd - len(self.Buffer))
+                if data is None:
+                    # We hit the end of the body, return what we have.
+                    return self._SetPart(len(self.Buffer))
+                self.Buffer += data
+            return self._SetPart(partEnd)
+
+        # There's no content length, so the part ends where the next boundary starts.
+        self.PartsWithoutContentLength += 1
+        searchStart = headerSize
+        while True:
+            boundaryStart = self.Buffer.find(self.DashBoundary, searchStart)
+            if boundaryStart != -1:
+                return self._SetPart(boundaryStart)
+            if len(self.Buffer) > MultipartStreamParser.c_MaxPartWithoutContentLengthBytes:
+                self.Logger.warn(f"Multipart stream part without a content-length grew too large without finding a boundary. Size: {len(self.Buffer)}")
+                return self._SetPart(len(self.Buffer))
+            # Back up enough to find a boundary split across reads.
+            searchStart = max(headerSize, len(self.Buffer) - len(self.DashBoundary) + 1)
+            data = readAvailableFunc(MultipartStreamParser.c_BoundarySearchReadSizeBytes)
+            if data is None:
+                return self._SetPart(len(self.Buffer))
+            self.Buffer += data
+
+
+    def _GetContentLength(self, headerEnd:int):
+        headers = bytes(self.Buffer[:headerEnd]).lower()
+        i = headers.find(MultipartStreamParser.c_ContentLengthHeader)
+        if i == -1:
+            return None
+        valueStart = i + len(MultipartStreamParser.c_ContentLengthHeader)
+        valueEnd = headers.find(b"\r\n", valueStart)
+        try:
+            return int(headers[valueStart:] if valueEnd == -1 else headers[valueStart:valueEnd])
+        except ValueError:
+            return None
+
+
+    def _SetPart(self, length:int) -> int:
+        self.PartLength = length
+        return length
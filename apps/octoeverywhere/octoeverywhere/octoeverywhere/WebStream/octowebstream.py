@@ -36,11 +36,18 @@ class OctoWebStream(threading.Thread):
         self.OpenedTime = time.time()
         self.ClosedDueToRequestConnectionError = False
 
+        # If a worker pool is passed, the stream doesn't use it's own thread. Instead it's scheduled on the pool
+        # when it has messages to process.
+        self.WorkerPool = args[3] if len(args) > 3 else None
+        self.PoolScheduleLock = threading.Lock()
+        self.IsScheduledOnPool = False
+        self.IsDone = False
+
         # Vars for high pri streams
+        # The priority gate is shared by all streams in the session.
         self.IsHighPriStream = False
-        self.HighPriLock = threading.Lock()
-        self.ActiveHighPriStreamCount = 0
-        self.ActiveHighPriStreamStart = time.time()
+        self.MsgPriority = MessagePriority.MessagePriority.Normal
+        self.PriorityGate = self.OctoSession.WebStreamPriorityGate
 
 
     # Called for all messages for this stream id.
@@ -63,9 +70,18 @@ class OctoWebStream(threading.Thread):
             self.HasSentCloseMessage = True
             # Call close.
             self.Close()
-        else:
+        elif self.WorkerPool is None:
             # Otherwise, put the message into the queue, so the thread will pick it up.
             self.MsgQueue.put(webStreamMsg)
+        else:
+            # If we are running on the worker pool, put the message in the queue and make sure we are scheduled.
+            # This is done under lock, so the worker can't miss a message as it's finishing up.
+            with self.PoolScheduleLock:
+                self.MsgQueue.put(webStreamMsg)
+                if self.IsScheduledOnPool or self.IsDone:
+                    return
+                self.IsScheduledOnPool = True
+            self.WorkerPool.Schedule(self)
 
 
     # Closes the web stream and all related elements.
@@ -99,7 +115,9 @@ class OctoWebStream(threading.Thread):
         self.OctoSession.WebStreamClosed(self.Id)
 
         # Put an empty message on the queue to wake it up to exit.
-        self.MsgQueue.put(None)
+        # When running on the worker pool, there's no thread waiting on the queue.
+        if self.WorkerPool is None:
+            self.MsgQueue.put(None)
 
         # Ensure we have sent the close message
         self.ensureCloseMessageSent()
@@ -122,6 +140,13 @@ class OctoWebStream(threading.Thread):
         self.ClosedDueToRequestConnectionError = True
 
 
+    # Called by the session to start the stream.
+    # If we are using the worker pool there's nothing to do, we will be scheduled when the first message arrives.
+    def Start(self):
+        if self.WorkerPool is None:
+            self.start()
+
+
     # This is our main thread, where we will process all incoming messages.
     def run(self):
         # Enable the profiler if needed- it will do nothing if not enabled.
@@ -149,48 +174,85 @@ class OctoWebStream(threading.Thread):
                 # We get this exception on the timeout.
                 pass
 
-            # Check that we aren't closed
-            if self.IsClosed is True:
+            # Process it, this returns true if the stream is done.
+            if self.processMessage(webStreamMsg):
                 return
 
-            # Check that we got a message and this wasn't just a timeout
-            if webStreamMsg is None:
-                continue
-
-            # Handle the message.
-            if webStreamMsg.IsOpenMsg():
-                self.initFromOpenMessage(webStreamMsg)
-
-            # Ensure we have an open message.
-            if self.OpenWebStreamMsg is None:
-                # Throw so we reset the connection.
-                raise Exception("Web stream ["+str(self.Id)+"] got a non open message before it's open message.")
-
-            # Don't pass it to the helper if there's nothing more.
-            if webStreamMsg.IsControlFlagsOnly():
-                continue
-
-            # Allow the helper to process the message
-            # We should only ever have one, but just for safety, check both.
-            returnValue = True
-            if self.HttpHelper is not None:
-                returnValue = self.HttpHelper.IncomingServerMessage(webStreamMsg)
-            if self.WsHelper is not None:
-                returnValue = self.WsHelper.IncomingServerMessage(webStreamMsg)
-
-            # If process server message returns true, we should close the stream.
-            if returnValue is True:
-                self.Close()
-                return
 
-            # When the http helper sends messages, it can indicate that the close flag has been set.
-            # In such a case, self.HasSentCloseMessage will be true. We don't want to rely on the client
-            # returning the correct returnValue, so if we see that we will call close to make sure things
-            # are going down. Since Close() is guarded against multiple entries, this is totally fine.
-            if self.HasSentCloseMessage is True and self.IsClosed is False:
-                self.Logger.warn("Web stream "+str(self.Id)+" processed a message and has sent a close message, but didn't call close on the web stream. Closing now.")
-                self.Close()
-                return
+    # Used when the stream is running on the worker pool.
+    # This is called on a pooled worker thread when the stream has been scheduled. It processes all of the queued messages
+    # and then returns, so the worker can be used for other streams. If more messages arrive, the stream is scheduled again.
+    def RunPendingMessages(self):
+        with DebugProfiler(self.Logger, DebugProfilerFeatures.WebStream):
+            try:
+                while True:
+                    webStreamMsg:WebStreamMsg.WebStreamMsg = None
+                    with self.PoolScheduleLock:
+                        if self.MsgQueue.empty() or self.IsDone:
+                            # We are out of work, so the next incoming message needs to schedule us again.
+                            self.IsScheduledOnPool = False
+                            return
+                        webStreamMsg = self.MsgQueue.get_nowait()
+                    if self.processMessage(webStreamMsg):
+                        with self.PoolScheduleLock:
+                            self.IsDone = True
+                            self.IsScheduledOnPool = False
+                        return
+            except Exception as e:
+                with self.PoolScheduleLock:
+                    self.IsDone = True
+                    self.IsScheduledOnPool = False
+                Sentry.Exception("Exception in web stream ["+str(self.Id)+"] pooled run.", e)
+                traceback.print_exc()
+                self.OctoSession.OnSessionError(0)
+
+
+    # Processes a single message from the queue. The message can be None if the queue read timed out.
+    # Returns true if the stream is done and no more messages should be processed.
+    def processMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        # Check that we aren't closed
+        if self.IsClosed is True:
+            return True
+
+        # Check that we got a message and this wasn't just a timeout
+        if webStreamMsg is None:
+            return False
+
+        # Handle the message.
+        if webStreamMsg.IsOpenMsg():
+            self.initFromOpenMessage(webStreamMsg)
+
+        # Ensure we have an open message.
+        if self.OpenWebStreamMsg is None:
+            # Throw so we reset the connection.
+            raise Exception("Web stream ["+str(self.Id)+"] got a non open message before it's open message.")
+
+        # Don't pass it to the helper if there's nothing more.
+        if webStreamMsg.IsControlFlagsOnly():
+            return False
+
+        # Allow the helper to process the message
+        # We should only ever have one, but just for safety, check both.
+        returnValue = True
+        if self.HttpHelper is not None:
+            returnValue = self.HttpHelper.IncomingServerMessage(webStreamMsg)
+        if self.WsHelper is not None:
+            returnValue = self.WsHelper.IncomingServerMessage(webStreamMsg)
+
+        # If process server message returns true, we should close the stream.
+        if returnValue is True:
+            self.Close()
+            return True
+
+        # When the http helper sends messages, it can indicate that the close flag has been set.
+        # In such a case, self.HasSentCloseMessage will be true. We don't want to rely on the client
+        # returning the correct returnValue, so if we see that we will call close to make sure things
+        # are going down. Since Close() is guarded against multiple entries, this is totally fine.
+        if self.HasSentCloseMessage is True and self.IsClosed is False:
+            self.Logger.warn("Web stream "+str(self.Id)+" processed a message and has sent a close message, but didn't call close on the web stream. Closing now.")
+            self.Close()
+            return True
+        return False
 
 
     def initFromOpenMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
@@ -203,7 +265,8 @@ class OctoWebStream(threading.Thread):
         self.OpenWebStreamMsg = webStreamMsg
 
         # Check if this is high pri, if so, tell them system a high pri is active
-        if self.OpenWebStreamMsg.MsgPriority() < MessagePriority.MessagePriority.Normal:
+        self.MsgPriority = self.OpenWebStreamMsg.MsgPriority()
+        if self.PriorityGate.IsHighPri(self.MsgPriority):
             self.IsHighPriStream = True
             self.highPriStreamStarted()
 
@@ -241,7 +304,8 @@ class OctoWebStream(threading.Thread):
 
 
     # Called by the helpers to send messages to the server.
-    def SendToOctoStream(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int, isCloseFlagSet = False, silentlyFail = False):
+    # If the optional onSentCallback is set, it's called with the buffer once it has been sent. If the message isn't sent, it's never called.
+    def SendToOctoStream(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int, isCloseFlagSet = False, silentlyFail = False, onSentCallback = None):
         # Make sure we aren't closed. If we are, don't allow the message to be sent.
         with self.StateLock:
             if self.IsClosed is True:
@@ -263,7 +327,7 @@ class OctoWebStream(threading.Thread):
 
         # Send now
         try:
-            self.OctoSession.Send(buffer, msgStartOffsetBytes, msgSize)
+            self.OctoSession.Send(buffer, msgStartOffsetBytes, msgSize, onSentCallback)
         except Exception as e:
             Sentry.Exception("Web stream "+str(self.Id)+ " failed to send a message to the OctoStream.", e)
 
@@ -299,33 +363,30 @@ class OctoWebStream(threading.Thread):
             Sentry.Exception("Exception thrown while trying to send close message for web stream "+str(self.Id), e)
             self.OctoSession.OnSessionError(0)
 
-    # Called by the OctoStreamHttpHelper if the request is normal pri.
-    # If a high pri request is active, this should block until it's complete or for a little while.
+    # Called by the OctoStreamHttpHelper before the request is made.
+    # If this stream isn't high pri and a high pri stream is active, this blocks until the high pri streams are done.
     def BlockIfHighPriStreamActive(self):
-        # Check the counter, don't worry about taking the lock, worst case
-        # this logic would allow one request through or not block one.
-
-        # If there are no high pri requests, don't block.
-        if self.ActiveHighPriStreamCount == 0:
-            return
-        # As a sanity check, if the high pri request started more than 5 seconds ago
-        # don't block.
-        timeSinceStartSec = time.time() - self.ActiveHighPriStreamStart
-        if timeSinceStartSec > 5.0:
-            return
-
-        # We should block this request
-        # TODO - this would be better if we blocked on a event or something, but for now this is fine.
-        # Note that the http will call this function before the request and on each response read loop, so the delays add up.
-        time.sleep(0.1)
+        # Don't hold a pooled worker while waiting at the gate.
+        if self.PriorityGate.ShouldWaitForRequestStart(self.MsgPriority):
+            self.DetachFromWorkerPool()
+        self.PriorityGate.WaitForRequestStart(self.MsgPriority)
+
+    # Called before the stream blocks for a while, like when it's sending a long response body.
+    # If the stream is running on a pooled worker, the worker leaves the pool and becomes this stream's thread until the stream
+    # is done running, so long lived streams can't take all of the pool's workers.
+    def DetachFromWorkerPool(self):
+        if self.WorkerPool is not None:
+            self.WorkerPool.DetachCurrentWorker()
+
+    # Called by the OctoStreamHttpHelper for each message it sends.
+    # If this stream isn't high pri and a high pri stream is active, this will throttle the stream to its bandwidth share.
+    def ThrottleIfHighPriStreamActive(self, byteCount:int):
+        self.PriorityGate.WaitForBandwidth(self.MsgPriority, byteCount)
 
     # Called when a high pri stream is started
     def highPriStreamStarted(self):
-        with self.HighPriLock:
-            self.ActiveHighPriStreamCount += 1
-            self.ActiveHighPriStreamStart = time.time()
+        self.PriorityGate.HighPriStreamStarted()
 
     # Called when a high pri stream is ended.
     def highPriStreamEnded(self):
-        with self.HighPriLock:
-            self.ActiveHighPriStreamCount -= 1
+        self.PriorityGate.HighPriStreamEnded()
@@ -8,11 +8,13 @@ import octoflatbuffers
 
 from .octoheaderimpl import HeaderHelper
 from .octoheaderimpl import BaseProtocol
+from .multipartstreamparser import MultipartStreamParser
 from ..octohttprequest import OctoHttpRequest
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from ..Webcam.webcamhelper import WebcamHelper
 from ..commandhandler import CommandHandler
 from ..compression import Compression, CompressionContext
+from ..bufferpool import BufferPool
 from ..sentry import Sentry
 from ..compat import Compat
 from ..Proto import HttpHeader
@@ -34,9 +36,25 @@ class MsgBuilderContext:
 
     def __init__(self):
         self.Builder:octoflatbuffers.Builder = None
+        self.RentedBuffer:bytearray = None
 
+    # The builder's buffer is rented from the buffer pool, since these can be big and are created for every message.
+    # The buffer should be given back to the pool with ReturnBuffer once the message has been sent.
     def CreateBuilder(self, knownBodySizeBytes = 0):
-        self.Builder = octoflatbuffers.Builder(knownBodySizeBytes + self.c_MsgStreamOverheadSize)
+        self.RentedBuffer = BufferPool.Get().Rent(knownBodySizeBytes + self.c_MsgStreamOverheadSize)
+        self.Builder = octoflatbuffers.Builder(0)
+        # Set our buffer and use clear to reset the builder's head to the end of it. The builder writes every byte it uses, so the buffer doesn't need to be zeroed.
+        self.Builder.Bytes = self.RentedBuffer
+        self.Builder.Clear()
+
+    # Returns true if the builder had to grow the buffer, because the size guess was too small.
+    def DidBufferGrow(self) -> bool:
+        return self.Builder is not None and self.Builder.Bytes is not self.RentedBuffer
+
+    # Used as the send complete callback, this returns the buffer to the pool.
+    @staticmethod
+    def ReturnBuffer(buffer:bytearray):
+        BufferPool.Get().Return(buffer)
 
 
 #
@@ -58,11 +76,11 @@ class OctoWebStreamHttpHelper:
         self.CompressionContext = CompressionContext(self.Logger)
 
         # Vars for response reading
-        self.BodyReadTempBuffer:bytearray = None
+        self.MultipartParser:MultipartStreamParser = None
         self.ChunkedBodyHasNoContentLengthHeaders = False
         self.CompressionType:DataCompression.DataCompression = None
         self.CompressionTimeSec = -1
-        self.MissingBoundaryWarningCounter = 0
+        self.MultipartReadCounter = 0
         self.IsUsingFullBodyBuffer = False
         self.IsUsingCustomBodyStreamCallbacks = False
 
@@ -293,6 +311,8 @@ class OctoWebStreamHttpHelper:
             boundaryStr:str = None
             # Pull out the content type value, so we can use it to figure out if we want to compress this data or not
             contentTypeLower:str =None
+            # If the body is already encoded by the server, like a gzipped asset, we don't want to compress it again.
+            contentEncodingLower:str = None
             headers = octoHttpResult.Headers
             for name, value in headers.items():
                 nameLower = name.lower()
@@ -314,6 +334,9 @@ class OctoWebStreamHttpHelper:
                             self.Logger.error("We found a boundary stream, but didn't find the boundary string. "+ contentTypeLower)
                             continue
 
+                elif nameLower == "content-encoding":
+                    contentEncodingLower = value.strip().lower()
+
                 elif nameLower == "location":
                     # We have noticed that some proxy servers aren't setup correctly to forward the x-forwarded-for and such headers.
                     # So when the web server responds back with a 301 or 302, the location header might not have the correct hostname, instead an ip like 127.0.0.1.
@@ -322,7 +345,8 @@ class OctoWebStreamHttpHelper:
             # We also look at the content-type to determine if we should add compression to this request or not.
             # general rule of thumb is that compression is quite cheap but really helps with text, so we should compress when we
             # can.
-            compressBody = self.shouldCompressBody(contentTypeLower, octoHttpResult, contentLength)
+            self.CompressionContext.SetPolicyInfo(contentTypeLower, uri)
+            compressBody = self.shouldCompressBody(contentTypeLower, contentEncodingLower, octoHttpResult, contentLength)
 
             # If the content length is known, tell the compression system, which will help performance.
             if contentLength is not None:
@@ -345,12 +369,19 @@ class OctoWebStreamHttpHelper:
             isFirstResponse = True
             isLastMessage = False
             messageCount = 0
+            lastMsgSizeBytes = 0
             # Continue as long as the stream isn't closed and we haven't sent the close message.
             # We don't check th body read sizes here, because we don't want to duplicate that logic check.
             while self.IsClosed is False and isLastMessage is False:
 
+                # If the body didn't fit in the first message, this can be a long lived stream like a webcam stream or a download.
+                # Move the stream off of the worker pool (if it's on it), so it doesn't hold a pooled worker while the body is sent.
+                if isFirstResponse is False:
+                    self.WebStream.DetachFromWorkerPool()
+
                 # Before we process the response, make sure we shouldn't defer for a high pri request
-                self.checkForDelayIfNotHighPri()
+                if lastMsgSizeBytes > 0:
+                    self.checkForDelayIfNotHighPri(lastMsgSizeBytes)
 
                 # This is an interesting check. If we are spinning to deliver a http body, and we detect that what we are compressing
                 # is larger than the OG body, we will disable compression for all future messages. We do this because any files that's already
@@ -495,7 +526,7 @@ class OctoWebStreamHttpHelper:
                 # Send the message.
                 # If this is the last, we need to make sure to set that we have set the closed flag.
                 serviceSendStartSec = time.time()
-                self.WebStream.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes, isLastMessage, True)
+                self.WebStream.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes, isLastMessage, True, MsgBuilderContext.ReturnBuffer)
                 thisServiceSendTimeSec = time.time() - serviceSendStartSec
                 self.ServiceUploadTimeSec += thisServiceSendTimeSec
                 if thisServiceSendTimeSec > self.ServiceUploadTimeHighWaterMarkSec:
@@ -503,14 +534,16 @@ class OctoWebStreamHttpHelper:
 
                 # Do a debug check to see if our pre-allocated flatbuffer size was too small.
                 # If this fires often, we should increase the c_MsgStreamOverheadSize size.
+                # Note that the buffer might have been returned to the pool by now, but we only use its length.
                 finalFullBufferBytes = len(buffer)
-                if finalFullBufferBytes > lastBodyReadLength + builderContext.c_MsgStreamOverheadSize and self.Logger.isEnabledFor(logging.DEBUG):
+                if builderContext.DidBufferGrow() and self.Logger.isEnabledFor(logging.DEBUG):
                     delta = msgSizeBytes - (lastBodyReadLength + builderContext.c_MsgStreamOverheadSize)
                     self.Logger.warn(f"The flatbuffer internal buffer had to be resized from the guess we set. Flatbuffer full buffer size: {finalFullBufferBytes}, last body read length: {lastBodyReadLength}; overage delta: {delta}")
 
                 # Clear this flag
                 isFirstResponse = False
                 messageCount += 1
+                lastMsgSizeBytes = msgSizeBytes
 
             # Log about it - only if debug is enabled. Otherwise, we don't want to waste time making the log string.
             responseWriteDone = time.time()
@@ -727,7 +760,7 @@ class OctoWebStreamHttpHelper:
 
     # Based on the content-type header, this determines if we would apply compression or not.
     # Returns true or false
-    def shouldCompressBody(self, contentTypeLower:str, octoHttpResult:OctoHttpRequest.Result, contentLengthOpt:int):
+    def shouldCompressBody(self, contentTypeLower:str, contentEncodingLower:str, octoHttpResult:OctoHttpRequest.Result, contentLengthOpt:int):
         # Compression isn't too expensive in terms of cpu cost but for text, it drastically
         # cuts the size down (ike a 75% reduction.) So we are quite liberal with our compression.
 
@@ -754,9 +787,17 @@ class OctoWebStreamHttpHelper:
         #   - Anything that's xml
         #   - Anything that's svg
         #   - Anything that's a application/octet-stream - moonraker sends unknown file types as these.
-        return (contentTypeLower.find("text/") != -1 or contentTypeLower.find("javascript") != -1
+        if (contentTypeLower.find("text/") != -1 or contentTypeLower.find("javascript") != -1
                 or contentTypeLower.find("json") != -1 or contentTypeLower.find("xml") != -1
-                or contentTypeLower.find("svg") != -1 or contentTypeLower.find("application/octet-stream") != -1)
+                or contentTypeLower.find("svg") != -1 or contentTypeLower.find("application/octet-stream") != -1) is False:
+            return False
+
+        # If the body is already encoded by the server, like a gzipped asset, compressing it again is a waste of time.
+        if contentEncodingLower is not None and contentEncodingLower not in ("", "identity"):
+            return False
+
+        # Finally, let the compression policy decide based on what it has learned about this kind of content.
+        return self.CompressionContext.ShouldCompress()
 
 
     # Reads data from the response body, puts it in a data vector, and returns the offset.
@@ -789,6 +830,8 @@ class OctoWebStreamHttpHelper:
         # Some requests like snapshot requests will already have a fully read body. In this case we use the existing body buffer instead of reading from the body.
         finalDataBuffer = None
         finalDataBufferMv_CanBeNone = None
+        finalDataBufferSliceMv_CanBeNone = None
+        compressedDataMv_CanBeNone = None
         try:
             bodyReadStartSec = time.time()
             if self.IsUsingFullBodyBuffer:
@@ -810,8 +853,9 @@ class OctoWebStreamHttpHelper:
                         # We create a memory view from the buffer, which is a zero copy operation and zero copy slicing.
                         # This allows us to pass the buffer around without copying it, but we do have to be sure to release the
                         # memory views when we are done.
-                        finalDataBufferMv_CanBeNone = memoryview(self.BodyReadTempBuffer)
-                        finalDataBuffer = finalDataBufferMv_CanBeNone[0:readLength]
+                        finalDataBufferMv_CanBeNone = memoryview(self.MultipartParser.Buffer)
+                        finalDataBufferSliceMv_CanBeNone = finalDataBufferMv_CanBeNone[0:readLength]
+                        finalDataBuffer = finalDataBufferSliceMv_CanBeNone
                 else:
                     if self.UnknownBodyChunkReadContext is not None or (responseHandlerContext is None and self.shouldDoUnknownBodyChunkRead(contentTypeLower_NoneIfNotKnown, contentLength_NoneIfNotKnown)):
                         # According to the HTTP 1.1 spec, if there's no content length and no boundary string, then the body is chunk based transfer encoding.
@@ -874,6 +918,10 @@ class OctoWebStreamHttpHelper:
             elif shouldCompress:
                 compressionResult = Compression.Get().Compress(self.CompressionContext, finalDataBuffer)
                 finalDataBuffer = compressionResult.Bytes
+                # The compressed data can be a view of the compression context's pooled buffer, which is only valid until the next compress.
+                # That's fine, since it's copied into the flatbuffer below.
+                if isinstance(finalDataBuffer, memoryview):
+                    compressedDataMv_CanBeNone = finalDataBuffer
                 # Init and update the total compression time if needed.
                 if self.CompressionTimeSec < 0:
                     self.CompressionTimeSec = 0
@@ -893,140 +941,43 @@ class OctoWebStreamHttpHelper:
 
             return (originalBufferSize, len(finalDataBuffer), builderContext.Builder.CreateByteVector(finalDataBuffer))
         finally:
-            # If we used a memory view, release it.
-            # This also means that the finalDataBuffer is a memory view.
+            # If we used memory views, release them.
+            if compressedDataMv_CanBeNone is not None:
+                compressedDataMv_CanBeNone.release()
+            if finalDataBufferSliceMv_CanBeNone is not None:
+                finalDataBufferSliceMv_CanBeNone.release()
             if finalDataBufferMv_CanBeNone is not None:
-                finalDataBuffer.release()
                 finalDataBufferMv_CanBeNone.release()
 
 
     # Reads a single chunk from the http response.
-    # This function uses the BodyReadTempBuffer to store the data.
+    # This function uses the MultipartParser buffer to store the data, the chunk is always at the start of the buffer.
     # Returns the read size, 0 if the body read is complete.
     def readStreamChunk(self, octoHttpResult:OctoHttpRequest.Result, boundaryStr):
-        frameSize = 0
-        headerSize = 0
-        foundContentLength = False
-
-        # If the temp array isn't setup, do it now.
-        if self.BodyReadTempBuffer is None:
-            self.BodyReadTempBuffer = bytearray(10*1024)
+        # If the parser isn't setup, do it now.
+        if self.MultipartParser is None:
+            self.MultipartParser = MultipartStreamParser(self.Logger, boundaryStr)
 
         # Note. OctoPrint webcam streams have content-length headers in each chunk. However, the standard
-        # says it's not required. So if we can find them use them, but if not we will set the
-        # ChunkedBodyHasNoContentLengthHeaders so that future body reads don't attempt to find the headers again.
-
-        # First, we need to see if we can find the content length header.
-        # We will keep grabbing more and more data in loop until we find the header
-        # If we can't find it after our max size, we declare it's not there (which is fine)
-        # and will use a different read method going forward.
-        c_maxHeaderSearchSizeBytes = 5 * 1024
-        tempBufferFilledSize = 0
+        # says it's not required. The parser will use them if they are there, otherwise it will search for the next boundary.
+        # If the parser can't find headers at all, we set the ChunkedBodyHasNoContentLengthHeaders so that future body reads
+        # don't attempt to parse the body as parts again.
         try:
-            # Loop until found or we have hit the search limit.
-            while foundContentLength is False and tempBufferFilledSize < c_maxHeaderSearchSizeBytes:
-                # Read a small chunk to try to read the header
-                # We want to read enough that hopefully we get all of the headers, but not so much that
-                # we accidentally read two boundary messages at once.
-                # 3/24/24 - After a lot of testing, it seems most times we get the full headers in 120 chars.
-                # So we will target that much, hoping we can do one read and get them.
-                headerBuffer = self.doBodyRead(octoHttpResult, 120)
-
-                # If this returns 0, the body read is complete
-                if headerBuffer is None:
-                    # We should return the length of the buffer we have read so far.
-                    return tempBufferFilledSize
-
-                # Add the header buffer to the temp output
-                self.BodyReadTempBuffer[tempBufferFilledSize:tempBufferFilledSize+len(headerBuffer)] = headerBuffer
-                tempBufferFilledSize += len(headerBuffer)
-
-                # Convert the entire buffer read so far into a string for parsing.
-                # We must use the decode function here, not just str(), because in py3 str() will make a "ToString" the object,
-                # and not actually return us the contents of the buffer as a string.
-                headerStr = self.BodyReadTempBuffer[:tempBufferFilledSize].decode(errors="ignore")
-
-                # Validate the headers starts with what we expect.
-                # According the the RFC, the boundary should start with the boundary string or '--' + boundary string.
-                # However, we have also seen \r\n--<str> and also no boundary string for the first frame as well. So this might fire once or twice, and that's fine.
-                # These are in order of how common they are, for perf.
-                if headerStr.startswith("--"+boundaryStr) is False and headerStr.startswith(boundaryStr) is False and headerStr.startswith("\r\n--"+boundaryStr) is False:
-                    # Always report the first time we find this, otherwise, report only occasionally.
-                    if self.MissingBoundaryWarningCounter % 120 == 0:
-                        # Trim the string to print it.
-                        outputStr = headerStr
-                        if len(outputStr) > 40:
-                            outputStr = outputStr[:40]
-                        self.Logger.warn("We read a web stream body frame, but it didn't start with the expected boundary header. expected:'"+boundaryStr+"' got:^^"+outputStr+"^^")
-                    self.MissingBoundaryWarningCounter += 1
-
-                # Find out how long the headers are. The \r\n\r\n sequence ends the headers.
-                endOfAllHeadersMatch = "\r\n\r\n"
-                endOfHeaderMatch = "\r\n"
-
-                # Try to find headers
-                # This logic checks for errors, and if found, don't stop the logic because of them
-                # This will cause us to loop again and read more. The reason for this is since we read random
-                # chunks, we could read a chunk that splits the content-length header in half, which would cause errors.
-                # So we just allow the system to keep reading until we hit the limit, because the next read would then have the full
-                # header we are looking for.
-                headerSize = headerStr.find(endOfAllHeadersMatch)
-                if headerSize != -1:
-                    # We found at least some headers!
-
-                    # Add 4 bytes for the \r\n\r\n end of header sequence. Also add two bytes for the \r\n at the end of this boundary chunk.
-                    headerSize += 4 + 2
-
-                    # Split out the headers
-                    headers = headerStr.split(endOfHeaderMatch)
-                    for header in headers:
-                        if header.lower().startswith("content-length"):
-                            # We found the content-length header!
-                            p = header.split(':')
-                            if len(p) == 2:
-                                frameSize = int(p[1].strip())
-                                foundContentLength = True
-                            break
-
+            readLength = self.MultipartParser.ReadPart(
+                lambda size: self.doBodyRead(octoHttpResult, size),
+                lambda size: self.doBodyRead(octoHttpResult, size, readAvailableOnly=True))
         except Exception as e:
             Sentry.Exception(self.getLogMsgPrefix()+ " exception thrown in http stream chunk reader", e)
             return 0
 
-        # Check if we found a content length header
-        if foundContentLength is False:
-            # It ok if we didn't find it, since it's not required for boundary chunks
-            # In this case, we will set the flag so future reads don't try again.
-            self.ChunkedBodyHasNoContentLengthHeaders = True
-            # And return the length of whatever we read
-            return tempBufferFilledSize
-
-        # We have a content-length!
-        # Compute how much more we need to read.
-        toRead = (frameSize + headerSize) - tempBufferFilledSize
-        if toRead < 0:
-            # Oops. This means we read into the next chunk.
-            # TODO - we could update this logic to correct itself by appending this chunk data
-            # on the next chunk, but as it stands it won't work.
-            # So just put the stream into the no content-length mode and return what we read.
-            self.Logger.error(self.getLogMsgPrefix()+ " http stream to read size is less than 0. FrameSize:"+str(frameSize) + " HeaderSize:"+str(headerSize) + " Read:"+str(tempBufferFilledSize))
+        if self.MultipartParser.HeadersNotFound:
+            self.Logger.info(self.getLogMsgPrefix()+ " http stream chunk reader couldn't find part headers, falling back to non-part reads.")
             self.ChunkedBodyHasNoContentLengthHeaders = True
-            return tempBufferFilledSize
-
-        # Read the remainder of the chunk.
-        if toRead > 0:
-            data = self.doBodyRead(octoHttpResult, toRead)
-
-            # If we hit the end of the body, return how much we read already.
-            if data is None:
-                return tempBufferFilledSize
+            return readLength
 
-            # Warn if twe didn't read it all
-            if len(data) != toRead:
-                self.Logger.warn(self.getLogMsgPrefix()+" while reading a boundary chunk, doBodyRead didn't return the full size we requested.")
-
-            # Copy this data into the temp buffer
-            self.BodyReadTempBuffer[tempBufferFilledSize:tempBufferFilledSize+len(data)] = data
-            tempBufferFilledSize += len(data)
+        # If the body is done, there's nothing to count.
+        if readLength == 0:
+            return 0
 
         # Update our read rate. This is a metric we send along in the stream if the it's a multipart stream, to know how fast we are reading it.
         # Basically for webcams streamed via http, it's the frame rate.
@@ -1044,18 +995,19 @@ class OctoWebStreamHttpHelper:
             # Note if this spins multiple times, it will be zeroed out. That would mean there's a more than 1s gap in reading.
             if isFirstIncrement is False and self.MultipartReadsPerSecond == 0:
                 self.Logger.warn("Multipart read per second stats hit a period where 0 reads happened for more than second.")
-            self.MultipartReadsPerSecond = self.MissingBoundaryWarningCounter
-            self.MissingBoundaryWarningCounter = 0
+            self.MultipartReadsPerSecond = self.MultipartReadCounter
+            self.MultipartReadCounter = 0
             isFirstIncrement = False
 
         # Now increment our counter, to account for the frame we just processed.
-        self.MissingBoundaryWarningCounter += 1
+        self.MultipartReadCounter += 1
 
-        # Finally, return how much we put into the temp buffer!
-        return tempBufferFilledSize
+        # Finally, return how much we put into the parser buffer!
+        return readLength
 
 
-    def doBodyRead(self, octoHttpResult:OctoHttpRequest.Result, readSize:int):
+    # If readAvailableOnly is set, this will return whatever data is available, up to the read size, rather than blocking until the full size is read.
+    def doBodyRead(self, octoHttpResult:OctoHttpRequest.Result, readSize:int, readAvailableOnly:bool = False):
         try:
             # Ensure there's an actual requests lib Response object to read from
             response = octoHttpResult.ResponseForBodyRead
@@ -1073,7 +1025,11 @@ class OctoWebStreamHttpHelper:
             # So if we pass in a huge value, we will get a big buffer allocated.
             # So if we know the size, we should use it, so that the buffer allocated it the same amount that's returned.
             # Also note, any improvements made here should be updated in ReadAllContentFromStreamResponse as well!
-            data = response.raw.read(readSize)
+            # read1 only exists in newer versions of urllib3, so if it's not there, fall back to the normal read.
+            if readAvailableOnly and hasattr(response.raw, "read1"):
+                data = response.raw.read1(readSize)
+            else:
+                data = response.raw.read(readSize)
 
             # If we got a data buffer return it.
             if data is not None and len(data) > 0:
@@ -1299,15 +1255,14 @@ class OctoWebStreamHttpHelper:
 
 
     # To speed up page load, we will defer lower pri requests while higher priority requests
-    # are executing.
-    def checkForDelayIfNotHighPri(self):
-        # This isn't used at all right now.
-        pass
-        # Allow anything above Normal priority to always execute
-        # if self.WebStreamOpenMsg.MsgPriority() < MessagePriority.MessagePriority.Normal:
-        #     return
-        # # Otherwise, we want to block for a bit if there's a high pri stream processing.
-        # self.WebStream.BlockIfHighPriStreamActive()
+    # are executing. Before the request is made, pass 0 for the byte count and the request will wait until the high pri streams are done.
+    # While the body is being sent, pass the size of the last message sent, and the stream will be throttled to its bandwidth share.
+    # High pri streams are never delayed, the web stream handles that check.
+    def checkForDelayIfNotHighPri(self, lastMsgSizeBytes:int = 0):
+        if lastMsgSizeBytes == 0:
+            self.WebStream.BlockIfHighPriStreamActive()
+        else:
+            self.WebStream.ThrottleIfHighPriStreamActive(lastMsgSizeBytes)
 
     # Formatting helper.
     def _FormatFloat(self, value:float) -> str:
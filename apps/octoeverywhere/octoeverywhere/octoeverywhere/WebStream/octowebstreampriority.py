@@ -0,0 +1,169 @@
+import time
+import threading
+
+from ..Proto import MessagePriority
+
+
+#
+# A priority scheduler shared by all of the web streams in an OctoSession.
+#
+# While any high pri stream is active (like a page load or webcam snapshot), normal and lower pri streams are held back.
+#   - Before a lower pri request is made, it waits on the gate until the last high pri stream ends. The waiters are released
+#     by a condition notify, so they resume as soon as the high pri stream is done, not on a fixed sleep interval.
+#     Each request waits at most c_MaxRequestStartWaitSec, so a steady flow of high pri streams can't hold it back forever.
+#   - While a lower pri stream is sending a body, it's limited by a token bucket for its priority class. The bucket refill rate is a share
+#     of the measured throughput of the session, so lower pri streams still make progress but leave most of the bandwidth to high pri streams.
+#
+# When no high pri stream is active, nothing is ever blocked and the only cost is a counter check.
+#
+class OctoWebStreamPriorityGate:
+
+    # As a sanity check, if high pri streams have been active for longer than this, we stop holding back lower pri streams.
+    # This is measured from when the first high pri stream started, so new high pri streams don't extend it.
+    c_MaxHighPriBlockSec = 5.0
+
+    # The max time a lower pri request will wait to start, measured from when that request started waiting.
+    c_MaxRequestStartWaitSec = 0.5
+
+    # The share of the measured session throughput each priority class gets while a high pri stream is active.
+    c_BandwidthShareByPriority = {
+        MessagePriority.MessagePriority.Normal: 0.25,
+        MessagePriority.MessagePriority.Low: 0.15,
+        MessagePriority.MessagePriority.Background: 0.10,
+    }
+
+    # The max amount of tokens a bucket can hold, in seconds of its refill rate. This allows small bursts.
+    c_BucketBurstSec = 0.25
+
+    # The lowest throughput we will estimate, so lower pri streams never fully stall on a slow or quiet connection.
+    c_MinThroughputBytesPerSec = 256 * 1024
+
+    # How often the throughput estimate is updated.
+    c_ThroughputWindowSec = 1.0
+
+
+    def __init__(self) -> None:
+        self.Condition = threading.Condition()
+        self.ActiveHighPriStreamCount = 0
+        self.ActiveHighPriStreamStart = time.time()
+
+        # Throughput tracking, across all streams.
+        self.ThroughputBytesPerSec = float(OctoWebStreamPriorityGate.c_MinThroughputBytesPerSec)
+        self.ThroughputWindowBytes = 0
+        self.ThroughputWindowStart = time.time()
+
+        # Token buckets, keyed by priority class. The value is [tokens, lastRefillTimeSec]
+        self.Buckets = {}
+
+
+    # Returns true if the priority is one that never gets blocked.
+    @staticmethod
+    def IsHighPri(priority:int) -> bool:
+        return priority < MessagePriority.MessagePriority.Normal
+
+
+    # Called when a high pri stream is started.
+    def HighPriStreamStarted(self) -> None:
+        with self.Condition:
+            # Only the first high pri stream starts the high pri period.
+            if self.ActiveHighPriStreamCount <= 0:
+                self.ActiveHighPriStreamStart = time.time()
+            self.ActiveHighPriStreamCount += 1
+
+
+    # Called when a high pri stream is ended.
+    # If this was the last high pri stream, all waiting lower pri streams are released.
+    def HighPriStreamEnded(self) -> None:
+        with self.Condition:
+            self.ActiveHighPriStreamCount -= 1
+            if self.ActiveHighPriStreamCount <= 0:
+                self.ActiveHighPriStreamCount = 0
+                # Reset the buckets, so the next high pri period starts fresh.
+                self.Buckets.clear()
+                self.Condition.notify_all()
+
+
+    # Returns true if WaitForRequestStart would currently block a request of this priority.
+    def ShouldWaitForRequestStart(self, priority:int) -> bool:
+        return self.ActiveHighPriStreamCount > 0 and OctoWebStreamPriorityGate.IsHighPri(priority) is False
+
+
+    # Called before a request is made.
+    # If the stream isn't high pri and a high pri stream is active, this blocks until the high pri streams are done,
+    # or until the request has waited for c_MaxRequestStartWaitSec.
+    def WaitForRequestStart(self, priority:int) -> None:
+        # Quick check without the lock, worst case we let one request through.
+        if self.ActiveHighPriStreamCount == 0 or OctoWebStreamPriorityGate.IsHighPri(priority):
+            return
+        deadlineSec = time.time() + OctoWebStreamPriorityGate.c_MaxRequestStartWaitSec
+        with self.Condition:
+            while self._ShouldHoldBack():
+                remainingSec = deadlineSec - time.time()
+                if remainingSec <= 0:
+                    return
+                self.Condition.wait(min(remainingSec, self._GetRemainingBlockSec()))
+
+
+    # Called by the stream for every message it sends, with the size of that message.
+    # High pri streams are never blocked, but their bytes count towards the throughput estimate.
+    # Lower pri streams take tokens from their priority class bucket and will block if it's empty, until it refills or the high pri streams end.
+    def WaitForBandwidth(self, priority:int, byteCount:int) -> None:
+        if byteCount <= 0:
+            return
+        self._RecordBytes(byteCount)
+
+        # Quick check without the lock.
+        if self.ActiveHighPriStreamCount == 0 or OctoWebStreamPriorityGate.IsHighPri(priority):
+            return
+
+        with self.Condition:
+            share = OctoWebStreamPriorityGate.c_BandwidthShareByPriority.get(priority, OctoWebStreamPriorityGate.c_BandwidthShareByPriority[MessagePriority.MessagePriority.Background])
+            while self._ShouldHoldBack():
+                rateBytesPerSec = self.ThroughputBytesPerSec * share
+                tokens = self._RefillBucket(priority, rateBytesPerSec)
+                if tokens >= byteCount:
+                    self.Buckets[priority][0] = tokens - byteCount
+                    return
+                # Wait for the deficit to refill, or to be woken up when the high pri streams end.
+                waitSec = min((byteCount - tokens) / rateBytesPerSec, self._GetRemainingBlockSec())
+                self.Condition.wait(waitSec)
+                # If the message is larger than the bucket can ever hold, let it through once the bucket is full.
+                burstBytes = rateBytesPerSec * OctoWebStreamPriorityGate.c_BucketBurstSec
+                if byteCount > burstBytes and self._RefillBucket(priority, rateBytesPerSec) >= burstBytes:
+                    self.Buckets[priority][0] = 0.0
+                    return
+
+
+    # Must be called under the lock.
+    def _ShouldHoldBack(self) -> bool:
+        return self.ActiveHighPriStreamCount > 0 and self._GetRemainingBlockSec() > 0
+
+
+    def _GetRemainingBlockSec(self) -> float:
+        return OctoWebStreamPriorityGate.c_MaxHighPriBlockSec - (time.time() - self.ActiveHighPriStreamStart)
+
+
+    # Must be called under the lock. Returns the current token count for the bucket.
+    def _RefillBucket(self, priority:int, rateBytesPerSec:float) -> float:
+        now = time.time()
+        bucket = self.Buckets.get(priority, None)
+        if bucket is None:
+            # New buckets start full.
+            bucket = [rateBytesPerSec * OctoWebStreamPriorityGate.c_BucketBurstSec, now]
+            self.Buckets[priority] = bucket
+        bucket[0] = min(rateBytesPerSec * OctoWebStreamPriorityGate.c_BucketBurstSec, bucket[0] + (now - bucket[1]) * rateBytesPerSec)
+        bucket[1] = now
+        return bucket[0]
+
+
+    def _RecordBytes(self, byteCount:int) -> None:
+        # This isn't locked, since being slightly off isn't a big deal.
+        self.ThroughputWindowBytes += byteCount
+        now = time.time()
+        elapsedSec = now - self.ThroughputWindowStart
+        if elapsedSec >= OctoWebStreamPriorityGate.c_ThroughputWindowSec:
+            measured = self.ThroughputWindowBytes / elapsedSec
+            # Smooth the estimate, so one quiet window doesn't starve the buckets.
+            self.ThroughputBytesPerSec = max(OctoWebStreamPriorityGate.c_MinThroughputBytesPerSec, (self.ThroughputBytesPerSec + measured) / 2.0)
+            self.ThroughputWindowBytes = 0
+            self.ThroughputWindowStart = now
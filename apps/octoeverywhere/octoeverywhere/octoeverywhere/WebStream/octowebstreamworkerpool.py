@@ -0,0 +1,190 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from ..sentry import Sentry
+
+
+#
+# A bounded pool of worker threads used to run web streams.
+#
+# By default, each web stream gets its own OS thread, which means a page load with 60 assets will create 60+ threads.
+# When the pool is enabled, web streams don't own a thread. Each stream keeps its own message queue and is scheduled
+# on the pool when it has pending messages. A pooled worker then runs the stream until its queue is empty.
+#
+# Workers are created on demand up to the max size and exit after being idle for a while, so the thread count (and the stack memory)
+# stays flat no matter how many concurrent streams there are. If all workers are busy, streams wait in the run queue.
+#
+# Long lived streams, like webcam streams and large downloads, and streams waiting at the priority gate would hold a worker
+# for their whole lifetime, so a few of them could take every worker and stall all other requests. Instead, before a stream
+# blocks for a while it detaches its worker from the pool. The thread becomes a dedicated thread for that stream and exits
+# when the stream is done running, and a new worker is started if other streams are waiting to run.
+# Websocket streams only use a worker while they forward a message, since the local websocket runs on its own thread.
+#
+class OctoWebStreamWorkerPool:
+
+    # The default max number of workers. 0 disables the pool, so each web stream uses its own thread.
+    c_DefaultMaxWorkers = 8
+
+    # How long a worker will wait for work before it exits.
+    c_WorkerIdleTimeoutSec = 30.0
+
+    # How often the pool stats will be logged, if debug logging is enabled.
+    c_StatsLogIntervalSec = 60.0
+
+    _Instance = None
+
+
+    # If Init is never called, the pool is disabled and each web stream uses its own thread.
+    # A maxWorkers value of 0 also disables the pool.
+    @staticmethod
+    def Init(logger:logging.Logger, maxWorkers:int = c_DefaultMaxWorkers):
+        if maxWorkers <= 0:
+            logger.info("Web stream worker pool is disabled, web streams will use a thread per stream.")
+            OctoWebStreamWorkerPool._Instance = None
+            return
+        OctoWebStreamWorkerPool._Instance = OctoWebStreamWorkerPool(logger, maxWorkers)
+
+
+    # Returns None if the pool isn't enabled.
+    @staticmethod
+    def Get():
+        return OctoWebStreamWorkerPool._Instance
+
+
+    def __init__(self, logger:logging.Logger, maxWorkers:int) -> None:
+        self.Logger = logger
+        self.MaxWorkers = maxWorkers
+        self.Condition = threading.Condition()
+        # The run queue holds tuples of (stream, enqueueTimeSec)
+        self.RunQueue = deque()
+        self.WorkerCount = 0
+        self.IdleWorkerCount = 0
+        self.WorkerIdCounter = 0
+        # Set on each worker thread, and cleared when the worker is detached from the pool.
+        self.WorkerState = threading.local()
+
+        # Stats
+        self.PeakWorkerCount = 0
+        self.PeakQueueDepth = 0
+        self.JobsRun = 0
+        self.TotalWaitSec = 0.0
+        self.MaxWaitSec = 0.0
+        self.DetachedThreadCount = 0
+        self.PeakDetachedThreadCount = 0
+        self.LastStatsLogSec = time.time()
+
+
+    # Schedules the stream to run on the pool.
+    # The stream's RunPendingMessages function will be called on a worker thread.
+    def Schedule(self, stream) -> None:
+        with self.Condition:
+            self.RunQueue.append((stream, time.time()))
+            if len(self.RunQueue) > self.PeakQueueDepth:
+                self.PeakQueueDepth = len(self.RunQueue)
+            # If there's an idle worker, wake it up. Otherwise, start a new worker if we have room.
+            if self.IdleWorkerCount > 0:
+                self.IdleWorkerCount -= 1
+                self.Condition.notify()
+            elif self.WorkerCount < self.MaxWorkers:
+                self._StartWorker_UnderLock()
+
+
+    # Called by a stream running on a worker before it blocks for a while, like when it's sending a long response body.
+    # The calling thread is removed from the pool, so it keeps running the stream without holding one of the pool's workers.
+    # It's safe to call from any thread, if the thread isn't a pool worker this does nothing.
+    def DetachCurrentWorker(self) -> None:
+        if getattr(self.WorkerState, "IsPoolWorker", False) is False:
+            return
+        self.WorkerState.IsPoolWorker = False
+        with self.Condition:
+            self.WorkerCount -= 1
+            self.DetachedThreadCount += 1
+            if self.DetachedThreadCount > self.PeakDetachedThreadCount:
+                self.PeakDetachedThreadCount = self.DetachedThreadCount
+            # If streams are waiting to run, start a worker to replace this one.
+            if len(self.RunQueue) > 0 and self.WorkerCount < self.MaxWorkers:
+                self._StartWorker_UnderLock()
+
+
+    # Returns a dict of the current stats.
+    def GetStats(self) -> dict:
+        with self.Condition:
+            return {
+                "QueueDepth": len(self.RunQueue),
+                "PeakQueueDepth": self.PeakQueueDepth,
+                "WorkerCount": self.WorkerCount,
+                "IdleWorkerCount": self.IdleWorkerCount,
+                "PeakWorkerCount": self.PeakWorkerCount,
+                "MaxWorkers": self.MaxWorkers,
+                "JobsRun": self.JobsRun,
+                "AvgWaitMs": 0.0 if self.JobsRun == 0 else (self.TotalWaitSec / self.JobsRun) * 1000.0,
+                "MaxWaitMs": self.MaxWaitSec * 1000.0,
+                "DetachedThreadCount": self.DetachedThreadCount,
+                "PeakDetachedThreadCount": self.PeakDetachedThreadCount,
+            }
+
+
+    def _StartWorker_UnderLock(self) -> None:
+        self.WorkerCount += 1
+        self.WorkerIdCounter += 1
+        if self.WorkerCount > self.PeakWorkerCount:
+            self.PeakWorkerCount = self.WorkerCount
+        t = threading.Thread(target=self._WorkerThread, name=f"OctoWebStreamWorker-{self.WorkerIdCounter}")
+        t.daemon = True
+        t.start()
+
+
+    def _WorkerThread(self) -> None:
+        self.WorkerState.IsPoolWorker = True
+        try:
+            while True:
+                stream = None
+                with self.Condition:
+                    # Wait for work, or exit if we have been idle for too long.
+                    # Note that Schedule takes the idle count when it notifies us, so we only remove ourselves on a timeout.
+                    while len(self.RunQueue) == 0:
+                        self.IdleWorkerCount += 1
+                        if self.Condition.wait(OctoWebStreamWorkerPool.c_WorkerIdleTimeoutSec) is False:
+                            self.IdleWorkerCount -= 1
+                            if len(self.RunQueue) == 0:
+                                self.WorkerCount -= 1
+                                return
+                    stream, enqueueTimeSec = self.RunQueue.popleft()
+                    waitSec = time.time() - enqueueTimeSec
+                    self.JobsRun += 1
+                    self.TotalWaitSec += waitSec
+                    if waitSec > self.MaxWaitSec:
+                        self.MaxWaitSec = waitSec
+
+                # Run the stream outside of the lock.
+                # RunPendingMessages handles its own errors, this is just a safety net so the worker count stays correct.
+                try:
+                    stream.RunPendingMessages()
+                except Exception as e:
+                    Sentry.Exception("Web stream worker pool stream run threw.", e)
+                self._LogStatsIfNeeded()
+
+                # If the stream detached this thread from the pool, the thread was only kept for that stream.
+                if self.WorkerState.IsPoolWorker is False:
+                    with self.Condition:
+                        self.DetachedThreadCount -= 1
+                    return
+        except Exception as e:
+            Sentry.Exception("Web stream worker pool thread threw.", e)
+            with self.Condition:
+                if self.WorkerState.IsPoolWorker:
+                    self.WorkerCount -= 1
+                else:
+                    self.DetachedThreadCount -= 1
+
+
+    def _LogStatsIfNeeded(self) -> None:
+        if self.Logger.isEnabledFor(logging.DEBUG) is False:
+            return
+        now = time.time()
+        if now - self.LastStatsLogSec < OctoWebStreamWorkerPool.c_StatsLogIntervalSec:
+            return
+        self.LastStatsLogSec = now
+        self.Logger.debug(f"Web stream worker pool stats: {self.GetStats()}")
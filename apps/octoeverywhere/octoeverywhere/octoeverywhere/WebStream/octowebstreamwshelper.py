@@ -11,6 +11,7 @@ from ..compat import Compat
 from ..websocketimpl import Client
 from ..localip import LocalIpHelper
 from ..compression import Compression, CompressionContext
+from ..compressionpolicy import CompressionPolicy
 from .octoheaderimpl import HeaderHelper
 from ..octohttprequest import OctoHttpRequest
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
@@ -188,6 +189,9 @@ class OctoWebStreamWsHelper:
         if uri is None:
             raise Exception(self.getLogMsgPrefix()+" AttemptConnection failed to create a URI")
 
+        # Let the compression policy know what this websocket is, so it can learn how well the messages compress.
+        self.CompressionContext.SetPolicyInfo(CompressionPolicy.c_WebsocketContentType, uri)
+
         # Increment the connection attempt.
         self.ConnectionAttempt += 1
 
@@ -383,7 +387,8 @@ class OctoWebStreamWsHelper:
 
 
             # Figure out if we should compress the data.
-            usingCompression = len(buffer) >= Compression.MinSizeToCompress
+            # The compression policy might also tell us to skip it, if the messages on this websocket don't compress well.
+            usingCompression = len(buffer) >= Compression.MinSizeToCompress and self.CompressionContext.ShouldCompress()
             originalDataSize = 0
             compressionResult = None
             if usingCompression:
@@ -0,0 +1,144 @@
+import time
+
+
+# A helper class that splits a continuous stream of concatenated jpeg images (like ffmpeg's image2pipe output) into single frames.
+#
+# The splitter keeps one reusable bytearray as a buffer with a read cursor, so we don't rebuild the buffer on every read.
+# All of the scanning is done with bytearray.find, which runs in native code, and we remember where the last scan stopped
+# so no byte is ever scanned twice. A single call to Feed can return multiple frames, if the pipe read contained more than one image.
+#
+# This class isn't thread safe, it's expected to be used by a single capture thread.
+class JpegFrameSplitter:
+
+    # The jpeg start of image and end of image markers.
+    c_JpegStartOfImage = b"\xff\xd8"
+    c_JpegEndOfImage = b"\xff\xd9"
+
+    # If the buffer holds more than this many bytes of unframed data, we assume the stream is corrupt and reset.
+    # A normal 1080p frame is around 100-300kb, so this gives us plenty of room.
+    c_MaxPendingBytes = 2 * 1024 * 1024
+
+    # Once the read cursor passes this many bytes, the consumed data is dropped from the front of the buffer.
+    # Deleting from the front of a bytearray is cheap in cpython, but we still batch it up to avoid doing it every frame.
+    c_CompactThresholdBytes = 256 * 1024
+
+    # How often the frames per second stat is updated.
+    c_FpsWindowSec = 2.0
+
+
+    # The start sequence is the expected header of every frame. If a frame doesn't start with it, the frame is dropped.
+    def __init__(self, startSequence:bytes = c_JpegStartOfImage) -> None:
+        self.StartSequence = bytes(startSequence)
+        self.StartSequenceLen = len(self.StartSequence)
+
+        # The buffer and cursors.
+        # ReadIndex is the start of the current unconsumed frame, ScanIndex is where the next end marker search will start.
+        self.Buffer = bytearray()
+        self.ReadIndex = 0
+        self.ScanIndex = 0
+
+        # Stats
+        self.FramesTotal = 0
+        self.FramesDropped = 0
+        self.BytesScanned = 0
+        self.BufferResets = 0
+        self.FramesPerSecond = 0.0
+        self.FpsWindowStartSec = time.time()
+        self.FpsWindowFrames = 0
+
+
+    # Adds newly read data to the splitter and returns a list of all of the complete frames found, in stream order.
+    # The list will be empty if no complete frame is ready yet.
+    def Feed(self, data) -> list:
+        frames = []
+        if data is None or len(data) == 0:
+            return frames
+
+        # Fast path - if there's no pending data and the read is exactly one full image, we can return it without any copies.
+        if self.ReadIndex == len(self.Buffer):
+            self._ResetBuffer()
+            end = data.find(JpegFrameSplitter.c_JpegEndOfImage)
+            if end != -1 and end + 2 == len(data) and self._HasStartSequence(data, 0):
+                self.BytesScanned += len(data)
+                self._OnFrame()
+                frames.append(data)
+                return frames
+            # Otherwise, fall through to the normal path. We already scanned up to the end marker we found, or the full buffer.
+            self.Buffer += data
+            self.ScanIndex = end if end != -1 else max(0, len(data) - 1)
+            self.BytesScanned += self.ScanIndex
+        else:
+            self.Buffer += data
+
+        # Pull as many frames as we can from the buffer.
+        self._ExtractFrames(frames)
+
+        # Drop consumed data from the front of the buffer if needed.
+        if self.ReadIndex == len(self.Buffer):
+            self._ResetBuffer()
+        elif self.ReadIndex > JpegFrameSplitter.c_CompactThresholdBytes:
+            del self.Buffer[:self.ReadIndex]
+            self.ScanIndex -= self.ReadIndex
+            self.ReadIndex = 0
+
+        # If there's too much unframed data, the stream is most likely corrupt, so reset and try to recover.
+        if len(self.Buffer) - self.ReadIndex > JpegFrameSplitter.c_MaxPendingBytes:
+            self.BufferResets += 1
+            self._ResetBuffer()
+        return frames
+
+
+    # Returns the number of bytes buffered that are not part of a complete frame yet.
+    def GetPendingBytes(self) -> int:
+        return len(self.Buffer) - self.ReadIndex
+
+
+    # Clears any pending data, used when the stream is restarted.
+    def Reset(self) -> None:
+        self._ResetBuffer()
+
+
+    def _ExtractFrames(self, frames:list) -> None:
+        buffLen = len(self.Buffer)
+        while True:
+            end = self.Buffer.find(JpegFrameSplitter.c_JpegEndOfImage, self.ScanIndex)
+            if end == -1:
+                # Back up one byte, so we catch an end marker that's split across two reads.
+                newScanIndex = max(self.ReadIndex, buffLen - 1)
+                self.BytesScanned += max(0, newScanIndex - self.ScanIndex)
+                self.ScanIndex = newScanIndex
+                return
+            frameEnd = end + 2
+            self.BytesScanned += frameEnd - self.ScanIndex
+            start = self.ReadIndex
+            self.ReadIndex = frameEnd
+            self.ScanIndex = frameEnd
+            # Ensure the frame starts where it should. If not, we got out of sync with the stream, so we drop it.
+            # The next frame will start right after this end marker, so we resync automatically.
+            if self._HasStartSequence(self.Buffer, start) is False:
+                self.FramesDropped += 1
+                continue
+            self._OnFrame()
+            frames.append(self.Buffer[start:frameEnd])
+
+
+    def _HasStartSequence(self, buffer, offset:int) -> bool:
+        return buffer.startswith(self.StartSequence, offset)
+
+
+    def _OnFrame(self) -> None:
+        self.FramesTotal += 1
+        self.FpsWindowFrames += 1
+        now = time.time()
+        elapsedSec = now - self.FpsWindowStartSec
+        if elapsedSec >= JpegFrameSplitter.c_FpsWindowSec:
+            self.FramesPerSecond = self.FpsWindowFrames / elapsedSec
+            self.FpsWindowFrames = 0
+            self.FpsWindowStartSec = now
+
+
+    def _ResetBuffer(self) -> None:
+        # Clearing the bytearray keeps the object around, so we don't need to allocate a new one.
+        self.Buffer.clear()
+        self.ReadIndex = 0
+        self.ScanIndex = 0
@@ -14,6 +14,7 @@ from enum import Enum
 from octoeverywhere.sentry import Sentry
 
 from .webcamutil import WebcamUtil
+from .jpegframesplitter import JpegFrameSplitter
 from ..octohttprequest import OctoHttpRequest
 from .webcamsettingitem import WebcamSettingItem
 from .webcamstreaminstance import WebcamStreamInstance
@@ -609,17 +610,18 @@ class QuickCam_RTSP:
     # Adds a ton of logging useful for debugging.
     c_DebugLogging = False
 
+    # The max number of frames we will hold from a single read. If we get more than this, we are behind and drop the oldest.
+    c_MaxPendingFrames = 2
+
 
     def __init__(self, logger:logging.Logger):
         self.Logger = logger
         self.Process:subprocess.Popen = None
 
         # Image getting stuff
-        self.Buffer = bytearray()
-        self.SearchedIndex = 0
-        self.JpegStartSequence = bytearray([0xff, 0xd8, 0xff, 0xfe, 0x00, 0x10])
-        self.JpegStartSequenceLen = len(self.JpegStartSequence)
-        self.JpegEndSequence = bytearray([0xff, 0xd9])
+        # ffmpeg's image2pipe jpegs always start with the SOI marker followed by a comment segment.
+        self.FrameSplitter = JpegFrameSplitter(bytes([0xff, 0xd8, 0xff, 0xfe, 0x00, 0x10]))
+        self.PendingFrames = []
         self.PipeSelect = selectors.DefaultSelector()
         self.TimeSinceLastImg = time.time()
 
@@ -682,6 +684,10 @@ class QuickCam_RTSP:
     # This can return None to indicate there's no image but the connection is still good, this allows the host to check if we should still be running.
     # To indicate connection is closed or needs to be closed, this should throw.
     def GetImage(self) -> bytearray:
+        # If a previous read produced more than one frame, hand those out first.
+        if len(self.PendingFrames) > 0:
+            return self.PendingFrames.pop(0)
+
         while True:
             # Wait on the pipe, which will signal us when there's data to be read.
             # We timeout after 5 seconds, which is plenty of time for the stream to be ready.
@@ -703,83 +709,24 @@ class QuickCam_RTSP:
                     self.Logger.debug("RTSP read empty buffer from stdin.")
                 continue
 
-            # If there's no pending buffered data do a quick exit if we were able to read the entire buffer in our first read.
-            # If the full buffer is only one jpeg images, we don't need to do any scanning and can just return it.
-            if self.Buffer is None:
-                if self._CheckIfFullJpeg(buffer):
-                    self._ResetLocalBuffer(True)
-                    if QuickCam_RTSP.c_DebugLogging:
-                        self.Logger.debug("RTSP fast path image received.")
-                    return buffer
-
-            # Append this buffer to the current pending buffer.
-            if self.Buffer is None:
-                self.Buffer = buffer
-            else:
-                self.Buffer += buffer
-
-            # Ensure the buffer is long enough to check.
-            buffLen = len(self.Buffer)
-            if buffLen <= self.JpegStartSequenceLen:
-                continue
-
-            # Check if the buffer is a full image now
-            if self._CheckIfFullJpeg(self.Buffer):
-                img = self.Buffer
-                self._ResetLocalBuffer(True)
-                if QuickCam_RTSP.c_DebugLogging:
-                    self.Logger.debug("RTSP second quick path image received.")
-                return img
-
-            # Scan the buffer for the jpeg end sequence.
-            newImageStart = -1
-            while self.SearchedIndex < buffLen - self.JpegStartSequenceLen:
-                if self.Buffer[self.SearchedIndex] == self.JpegEndSequence[0] and self.Buffer[self.SearchedIndex+1] == self.JpegEndSequence[1]:
-                    newImageStart = self.SearchedIndex + 2
-                    break
-                self.SearchedIndex += 1
-
-            # See if we found a complete image.
-            if newImageStart != -1:
-                # Get the image and check it's a full image.
-                imgBuffer = self.Buffer[:newImageStart]
-                if self._CheckIfFullJpeg(imgBuffer) is False:
-                    # If we don't have a correct buffer, we got off in out counting.
-                    # So reset the buffer and continue. Note after we reset the buffer, we might
-                    # hit this, since we could have a partial image in the Buffer
-                    self._ResetLocalBuffer()
-                    if QuickCam_RTSP.c_DebugLogging:
-                        self.Logger.debug("RTSP we found a jpeg end sequence, but the buffer didn't start with a jpeg start sequence.")
-                    continue
-                # Take the image off the buffer.
-                self.Buffer = self.Buffer[newImageStart:]
-                self.SearchedIndex = 0
-                self.TimeSinceLastImg = time.time()
-                # Ensure the buffer isn't too long.
-                self._ResetLocalBufferIfOverLimit()
+            # Let the splitter find all of the complete frames in this read.
+            frames = self.FrameSplitter.Feed(buffer)
+            if len(frames) == 0:
                 if QuickCam_RTSP.c_DebugLogging:
-                    self.Logger.debug("RTSP slow path image received.")
-                return imgBuffer
+                    self.Logger.debug(f"We got a new buffer with no image match. Pending bytes: {self.FrameSplitter.GetPendingBytes()}")
+                continue
 
-            # If we didn't find anything, check the limit.
+            self.TimeSinceLastImg = time.time()
             if QuickCam_RTSP.c_DebugLogging:
-                self.Logger.debug("We got a new buffer with no image match.")
-            self._ResetLocalBufferIfOverLimit()
-
-
-    def _ResetLocalBufferIfOverLimit(self):
-        # A normal image is around 37,000, so if the buffer is too long, reset it so
-        # we can try to recover the buffer.
-        if self.Buffer is not None and len(self.Buffer) > 50000:
-            self.Logger.info("Quick cam rtsp buffer reset. This means we are running behind.")
-            self._ResetLocalBuffer()
+                self.Logger.debug(f"RTSP {len(frames)} image(s) received. fps: {self.FrameSplitter.FramesPerSecond:.1f}, bytes scanned: {self.FrameSplitter.BytesScanned}, frames dropped: {self.FrameSplitter.FramesDropped}")
 
-
-    def _ResetLocalBuffer(self, hasNewImage:bool = False):
-        self.SearchedIndex = 0
-        self.Buffer = None
-        if hasNewImage:
-            self.TimeSinceLastImg = time.time()
+            # If we are running so far behind that many frames came in at once, only keep the most recent ones.
+            # Old frames are only adding latency at that point.
+            if len(frames) > QuickCam_RTSP.c_MaxPendingFrames:
+                self.Logger.info("Quick cam rtsp skipped frames. This means we are running behind.")
+                frames = frames[-QuickCam_RTSP.c_MaxPendingFrames:]
+            self.PendingFrames = frames
+            return self.PendingFrames.pop(0)
 
 
     # Reads the error stream from ffmpeg.
@@ -812,17 +759,6 @@ class QuickCam_RTSP:
                 Sentry.Exception("RTSP error reader thread failed.", e)
 
 
-    # Checks if the buffer is only one image, from start to end.
-    def _CheckIfFullJpeg(self, buffer:bytearray) -> bool:
-        if buffer is None or len(buffer) <= self.JpegStartSequenceLen:
-            return False
-        if buffer[:self.JpegStartSequenceLen] != self.JpegStartSequence:
-            return False
-        if buffer[-2:] != self.JpegEndSequence:
-            return False
-        return True
-
-
     # Allows us to using the with: scope.
     def __enter__(self):
         return self
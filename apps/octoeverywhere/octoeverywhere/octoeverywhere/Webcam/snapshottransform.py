@@ -0,0 +1,256 @@
+import io
+import math
+import logging
+import threading
+from collections import OrderedDict
+
+from ..snapshotresizeparams import SnapshotResizeParams
+
+try:
+    # On some systems this package will install but the import will fail due to a missing system .so.
+    # Since most setups don't use this package, we will import it with a try catch and if it fails we
+    # won't use it.
+    from PIL import Image
+    from PIL import ImageFile
+except Exception as _:
+    Image = None
+    ImageFile = None
+
+
+# The plan for transforming snapshots of a given size with a given set of settings.
+# All of the sizes and boxes are computed once from the source image size, so the plan can be reused for every snapshot from the same camera.
+class SnapshotTransformPlan:
+
+    def __init__(self) -> None:
+        # The single PIL transpose operation that does all of the flips and 90 degree rotations, or None.
+        self.TransposeOp = None
+        # If the rotation isn't a multiple of 90, the PIL counter clockwise rotation to apply after the transpose.
+        self.FallbackRotation = 0
+        # The image size after the transpose.
+        self.TransposedSize = None
+        # The size to request from the jpeg decoder, in the source orientation, or None to do a full size decode.
+        self.DraftSize = None
+        # The final output size and the box of the transposed image it's taken from, or None if there's no resize or crop.
+        self.OutputSize = None
+        self.SourceBox = None
+
+
+    # True if the plan doesn't change the image.
+    def IsNoOp(self) -> bool:
+        return self.TransposeOp is None and self.FallbackRotation == 0 and self.OutputSize is None
+
+
+#
+# Applies the flip, rotate, resize, and crop transforms to snapshots.
+#
+# All of the transforms are combined into the fewest PIL operations.
+#   - The flips and 90 degree rotations are combined into a single transpose.
+#   - The resize and crop are combined into a single resize, by resizing only the box of the image we will keep.
+#   - If the image will be scaled down, the jpeg decoder is asked to decode at a reduced size, which is much cheaper than a full decode.
+#
+# The plans are cached per setting and source image size, since they are the same for every snapshot from a camera.
+#
+class SnapshotTransformer:
+
+    # The max number of plans we will cache.
+    c_MaxPlans = 8
+
+    # The jpeg quality used when we re-encode the image.
+    c_JpegQuality = 95
+
+    # The transpose matrices that map the centered image (x, y) coordinates, with y pointing down.
+    # These are used to find the single transpose that matches any set of flips and rotations.
+    c_FlipHMatrix = ((-1, 0), (0, 1))
+    c_FlipVMatrix = ((1, 0), (0, -1))
+    c_RotateClockwise90Matrix = ((0, -1), (1, 0))
+    c_IdentityMatrix = ((1, 0), (0, 1))
+
+
+    def __init__(self, logger:logging.Logger, useDraft:bool = True) -> None:
+        self.Logger = logger
+        self.UseDraft = useDraft
+        self.Lock = threading.Lock()
+        self.Plans = OrderedDict()
+
+
+    # Returns true if the image lib was loaded, so we can transform images.
+    @staticmethod
+    def IsSupported() -> bool:
+        return Image is not None
+
+
+    # Transforms the snapshot and returns the jpeg buffer.
+    # If there's nothing to do, the original snapshot is returned, to preserve quality.
+    # This will throw on failures.
+    def Transform(self, snapshot, flipH:bool, flipV:bool, rotation:int, snapshotResizeParams:SnapshotResizeParams = None):
+        if Image is None:
+            raise Exception("Can't manipulate image because the Image rotation lib failed to import.")
+
+        # We noticed that on some under powered or otherwise bad systems the image returned
+        # by mjpeg is truncated. We aren't sure why this happens, but setting this flag allows us to sill
+        # manipulate the image even though we didn't get the whole thing. Otherwise, we would use the raw snapshot
+        # buffer, which is still an incomplete image.
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+        # Opening the image only reads the header, the image isn't decoded until it's used.
+        pilImage = Image.open(io.BytesIO(snapshot))
+        plan = self.GetPlan(flipH, flipV, rotation, snapshotResizeParams, pilImage.size)
+        if plan.IsNoOp():
+            return snapshot
+
+        # If we are scaling down, let the jpeg decoder do most of the work.
+        if plan.DraftSize is not None and pilImage.format == "JPEG":
+            pilImage.draft(pilImage.mode, plan.DraftSize)
+
+        if plan.TransposeOp is not None:
+            pilImage = pilImage.transpose(plan.TransposeOp)
+        if plan.FallbackRotation != 0:
+            pilImage = pilImage.rotate(plan.FallbackRotation)
+
+        if plan.OutputSize is not None:
+            # The box was planned for the full size image, so scale it to the decoded size.
+            scaleX = float(pilImage.width) / float(plan.TransposedSize[0])
+            scaleY = float(pilImage.height) / float(plan.TransposedSize[1])
+            box = (plan.SourceBox[0] * scaleX, plan.SourceBox[1] * scaleY, plan.SourceBox[2] * scaleX, plan.SourceBox[3] * scaleY)
+            pilImage = pilImage.resize(plan.OutputSize, box=box)
+
+        buffer = io.BytesIO()
+        pilImage.save(buffer, format="JPEG", quality=SnapshotTransformer.c_JpegQuality)
+        result = buffer.getvalue()
+        buffer.close()
+        return result
+
+
+    # Returns the cached plan for these settings and source size, or builds it.
+    def GetPlan(self, flipH:bool, flipV:bool, rotation:int, snapshotResizeParams:SnapshotResizeParams, sourceSize) -> SnapshotTransformPlan:
+        key = (bool(flipH), bool(flipV), rotation, None if snapshotResizeParams is None else snapshotResizeParams.GetCacheKey(), sourceSize)
+        with self.Lock:
+            plan = self.Plans.get(key, None)
+            if plan is not None:
+                self.Plans.move_to_end(key)
+                return plan
+        plan = self._BuildPlan(flipH, flipV, rotation, snapshotResizeParams, sourceSize)
+        with self.Lock:
+            self.Plans[key] = plan
+            while len(self.Plans) > SnapshotTransformer.c_MaxPlans:
+                self.Plans.popitem(last=False)
+        return plan
+
+
+    def _BuildPlan(self, flipH:bool, flipV:bool, rotation:int, snapshotResizeParams:SnapshotResizeParams, sourceSize) -> SnapshotTransformPlan:
+        plan = SnapshotTransformPlan()
+        sourceWidth, sourceHeight = sourceSize
+
+        # Note the order of the flips and the rotates are important!
+        # The flips are applied first, then the clockwise rotation.
+        matrix = SnapshotTransformer.c_IdentityMatrix
+        if flipH:
+            matrix = SnapshotTransformer._Multiply(SnapshotTransformer.c_FlipHMatrix, matrix)
+        if flipV:
+            matrix = SnapshotTransformer._Multiply(SnapshotTransformer.c_FlipVMatrix, matrix)
+        rotation = rotation % 360
+        if rotation % 90 == 0:
+            for _ in range(rotation // 90):
+                matrix = SnapshotTransformer._Multiply(SnapshotTransformer.c_RotateClockwise90Matrix, matrix)
+        else:
+            # Our rotation is clockwise while PIL is counter clockwise.
+            plan.FallbackRotation = 360 - rotation
+        plan.TransposeOp = SnapshotTransformer._GetTransposeOp(matrix)
+
+        # If the transpose swaps the axes, the size is swapped.
+        isSwapped = matrix[0][0] == 0
+        width, height = (sourceHeight, sourceWidth) if isSwapped else (sourceWidth, sourceHeight)
+        plan.TransposedSize = (width, height)
+
+        if snapshotResizeParams is None:
+            return plan
+
+        # Figure out the resize, without editing the params passed to us.
+        size = snapshotResizeParams.Size
+        resizeToHeight = snapshotResizeParams.ResizeToHeight
+        resizeToWidth = snapshotResizeParams.ResizeToWidth
+        cropSquare = snapshotResizeParams.CropSquareCenterNoPadding
+
+        # If we want to scale and crop to center, we will use the resize to get the image scale (preserving the aspect ratio).
+        # We will use the smallest side to scale to the desired outcome.
+        # We will only do the crop resize if the source image is larger than or equal to the desired size.
+        if cropSquare:
+            if height >= size and width >= size:
+                resizeToHeight = height < width
+                resizeToWidth = not resizeToHeight
+            else:
+                cropSquare = False
+
+        resizeWidth = width
+        resizeHeight = height
+        if resizeToHeight and height > size:
+            resizeHeight = size
+            resizeWidth = int((float(size) / float(height)) * float(width))
+        if resizeToWidth and width > size:
+            resizeHeight = int((float(size) / float(width)) * float(height))
+            resizeWidth = size
+
+        # Now if we want to crop square, figure out the box of the resized image we will keep.
+        left, upper, right, lower = (0, 0, resizeWidth, resizeHeight)
+        if cropSquare:
+            if resizeToHeight:
+                # Crop the width - use floor to ensure if there's a remainder we float left.
+                centerX = math.floor(float(resizeWidth) / 2.0)
+                halfWidth = math.floor(float(size) / 2.0)
+                left, upper, right, lower = (centerX - halfWidth, 0, (size - halfWidth) + centerX, size)
+            else:
+                # Crop the height - use floor to ensure if there's a remainder we float left.
+                centerY = math.floor(float(resizeHeight) / 2.0)
+                halfHeight = math.floor(float(size) / 2.0)
+                left, upper, right, lower = (0, centerY - halfHeight, size, (size - halfHeight) + centerY)
+            # Sanity check bounds
+            if left < 0 or left > right or right > resizeWidth or upper < 0 or upper > lower or lower > resizeHeight:
+                self.Logger.error("Failed to crop image. height: "+str(resizeHeight)+", width: "+str(resizeWidth)+", size: "+str(size))
+                left, upper, right, lower = (0, 0, resizeWidth, resizeHeight)
+
+        # If there's no resize or crop, we are done.
+        if (left, upper, right, lower) == (0, 0, width, height):
+            return plan
+
+        # Map the box we keep back to the full size transposed image.
+        scaleX = float(width) / float(resizeWidth)
+        scaleY = float(height) / float(resizeHeight)
+        plan.SourceBox = (left * scaleX, upper * scaleY, right * scaleX, lower * scaleY)
+        plan.OutputSize = (right - left, lower - upper)
+
+        # If we are scaling down, ask the decoder for an image that's at least the resized size, in the source orientation.
+        if self.UseDraft and (resizeWidth < width or resizeHeight < height):
+            plan.DraftSize = (resizeHeight, resizeWidth) if isSwapped else (resizeWidth, resizeHeight)
+        return plan
+
+
+    @staticmethod
+    def _Multiply(a, b):
+        return (
+            (a[0][0] * b[0][0] + a[0][1] * b[1][0], a[0][0] * b[0][1] + a[0][1] * b[1][1]),
+            (a[1][0] * b[0][0] + a[1][1] * b[1][0], a[1][0] * b[0][1] + a[1][1] * b[1][1]),
+        )
+
+
+    # Returns the PIL transpose op that matches the matrix, or None if it's the identity.
+    @staticmethod
+    def _GetTransposeOp(matrix):
+        if matrix == SnapshotTransformer.c_IdentityMatrix:
+            return None
+        # In pillow ~9.1.0 these constants moved.
+        # pylint: disable=no-member
+        try:
+            t = Image.Transpose
+        except Exception:
+            t = Image
+        ops = {
+            ((-1, 0), (0, 1)): t.FLIP_LEFT_RIGHT,
+            ((1, 0), (0, -1)): t.FLIP_TOP_BOTTOM,
+            ((0, 1), (-1, 0)): t.ROTATE_90,
+            ((-1, 0), (0, -1)): t.ROTATE_180,
+            ((0, -1), (1, 0)): t.ROTATE_270,
+            ((0, 1), (1, 0)): t.TRANSPOSE,
+            ((0, -1), (-1, 0)): t.TRANSVERSE,
+        }
+        # pylint: enable=no-member
+        return ops[matrix]
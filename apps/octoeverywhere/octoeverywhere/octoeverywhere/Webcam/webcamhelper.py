@@ -1,6 +1,9 @@
 import logging
 import os
 import json
+import time
+import threading
+from collections import OrderedDict
 from typing import List
 
 from ..sentry import Sentry
@@ -8,6 +11,27 @@ from .webcamutil import WebcamUtil
 from .quickcam import QuickCamManager
 from ..octohttprequest import OctoHttpRequest
 from .webcamsettingitem import WebcamSettingItem
+from ..Proto.DataCompression import DataCompression
+
+
+# Holds the most recent snapshot for a single camera, and the transformed variants made from it.
+class SnapshotCacheEntry:
+
+    def __init__(self) -> None:
+        self.Body:bytes = None
+        self.Headers = None
+        self.Url:str = None
+        self.DidFallback = False
+        self.TimeSec = 0.0
+        # Set while a snapshot is being taken, so other callers can wait on it rather than making their own camera request.
+        self.FetchEvent:threading.Event = None
+        # Maps a variant key -> the transformed image buffer, in LRU order.
+        self.Variants = OrderedDict()
+
+
+    # Each caller gets its own result and headers, since they might be edited. The body is a bytes object, so it can be shared.
+    def BuildResult(self) -> OctoHttpRequest.Result:
+        return OctoHttpRequest.Result(200, self.Headers.copy(), self.Url, self.DidFallback, fullBodyBuffer=self.Body)
 
 # The point of this class is to abstract the logic that needs to be done to reliably get a webcam snapshot and stream from many types of
 # printer setups. The main entry point is GetSnapshot() which will try a number of ways to get a snapshot from whatever camera system is
@@ -27,13 +51,23 @@ class WebcamHelper:
     # A header we apply to all snapshot and webcam streams so the client can get the correct transforms the user has setup.
     c_OeWebcamTransformHeaderKey = "x-oe-webcam-transform"
 
+    # How long a snapshot can be reused by other callers before a new one is taken.
+    # Notifications, Gadget, and remote requests often all ask for a snapshot at the same time, like when a print ends.
+    c_DefaultSnapshotCacheFreshnessMs = 1000
+
+    # If a caller is waiting on a snapshot that's being taken by someone else, this is the max time it will wait before taking its own.
+    c_SnapshotFetchWaitTimeoutSec = 15.0
+
+    # The max number of transformed snapshots we will hold per camera.
+    c_MaxSnapshotVariantsPerCamera = 4
+
     # Logic for a static singleton
     _Instance = None
 
 
     @staticmethod
-    def Init(logger:logging.Logger, webcamPlatformHelperInterface, pluginDataFolderPath):
-        WebcamHelper._Instance = WebcamHelper(logger, webcamPlatformHelperInterface, pluginDataFolderPath)
+    def Init(logger:logging.Logger, webcamPlatformHelperInterface, pluginDataFolderPath, snapshotCacheFreshnessMs:int = c_DefaultSnapshotCacheFreshnessMs):
+        WebcamHelper._Instance = WebcamHelper(logger, webcamPlatformHelperInterface, pluginDataFolderPath, snapshotCacheFreshnessMs)
         QuickCamManager.Init(logger, webcamPlatformHelperInterface)
 
 
@@ -42,10 +76,18 @@ class WebcamHelper:
         return WebcamHelper._Instance
 
 
-    def __init__(self, logger:logging.Logger, webcamPlatformHelperInterface, pluginDataFolderPath:str):
+    def __init__(self, logger:logging.Logger, webcamPlatformHelperInterface, pluginDataFolderPath:str, snapshotCacheFreshnessMs:int = c_DefaultSnapshotCacheFreshnessMs):
         self.Logger = logger
         self.WebcamPlatformHelperInterface = webcamPlatformHelperInterface
 
+        # The snapshot cache, keyed by the camera settings.
+        self.SnapshotCacheFreshnessSec = max(0, snapshotCacheFreshnessMs) / 1000.0
+        self.SnapshotCacheLock = threading.Lock()
+        self.SnapshotCache = {}
+        self.SnapshotCacheHits = 0
+        self.SnapshotCacheCoalesced = 0
+        self.SnapshotCacheMisses = 0
+
         # Init local webcam settings stuffs.
         self.SettingsFilePath = os.path.join(pluginDataFolderPath, "webcam-settings.json")
         self.DefaultCameraName:str = None
@@ -152,7 +194,107 @@ class WebcamHelper:
     #
     # On failure, this returns None. Returning None will fail out the request.
     # On success, this will return a valid OctoHttpRequest that's fully filled out. The stream will always already be fully read, and will be FullBodyBuffer var.
+    #
+    # Snapshots are cached per camera for a short time, so if many callers ask for a snapshot at once, they share one camera request.
+    # If a snapshot is already being taken, other callers will wait for it rather than making their own request.
     def GetSnapshot(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
+        cacheKey = self._GetSnapshotCacheKey(cameraIndex)
+        if cacheKey is None:
+            return self._GetSnapshotUncached(cameraIndex)
+
+        isFetcher = False
+        with self.SnapshotCacheLock:
+            entry = self.SnapshotCache.get(cacheKey, None)
+            if entry is None:
+                entry = SnapshotCacheEntry()
+                self.SnapshotCache[cacheKey] = entry
+            if entry.Body is not None and time.time() - entry.TimeSec < self.SnapshotCacheFreshnessSec:
+                self.SnapshotCacheHits += 1
+                return entry.BuildResult()
+            fetchEvent = entry.FetchEvent
+            if fetchEvent is None:
+                fetchEvent = threading.Event()
+                entry.FetchEvent = fetchEvent
+                isFetcher = True
+
+        # If someone else is taking the snapshot, wait for it.
+        if isFetcher is False:
+            waitStartSec = time.time()
+            fetchEvent.wait(WebcamHelper.c_SnapshotFetchWaitTimeoutSec)
+            with self.SnapshotCacheLock:
+                if entry.Body is not None and entry.TimeSec >= waitStartSec:
+                    self.SnapshotCacheCoalesced += 1
+                    return entry.BuildResult()
+            # If the other snapshot failed or took too long, take our own.
+            return self._GetSnapshotUncached(cameraIndex)
+
+        # We are taking the snapshot.
+        try:
+            result = self._GetSnapshotUncached(cameraIndex)
+            if result is not None and result.StatusCode == 200 and result.FullBodyBuffer is not None and result.BodyBufferCompressionType == DataCompression.None_:
+                # Make sure the body is an immutable bytes object, since it will be shared by all callers.
+                body = bytes(result.FullBodyBuffer)
+                result.SetFullBodyBuffer(body)
+                with self.SnapshotCacheLock:
+                    self.SnapshotCacheMisses += 1
+                    entry.Body = body
+                    entry.Headers = result.Headers.copy()
+                    entry.Url = result.Url
+                    entry.DidFallback = result.DidFallback
+                    entry.TimeSec = time.time()
+                    entry.Variants.clear()
+            return result
+        finally:
+            with self.SnapshotCacheLock:
+                entry.FetchEvent = None
+            fetchEvent.set()
+
+
+    # Returns a cached transformed variant of a snapshot returned by GetSnapshot, or None if there isn't one.
+    # The variant key should include everything that changes the output, like the rotation and the SnapshotResizeParams cache key.
+    def GetSnapshotVariant(self, snapshot, variantKey):
+        with self.SnapshotCacheLock:
+            entry = self._GetSnapshotCacheEntryForBody_UnderLock(snapshot)
+            if entry is None:
+                return None
+            variant = entry.Variants.get(variantKey, None)
+            if variant is not None:
+                entry.Variants.move_to_end(variantKey)
+            return variant
+
+
+    # Caches a transformed variant of a snapshot returned by GetSnapshot.
+    # If the snapshot is no longer the most recent one for its camera, the variant isn't cached.
+    def SetSnapshotVariant(self, snapshot, variantKey, variant) -> None:
+        with self.SnapshotCacheLock:
+            entry = self._GetSnapshotCacheEntryForBody_UnderLock(snapshot)
+            if entry is None:
+                return
+            entry.Variants[variantKey] = variant
+            entry.Variants.move_to_end(variantKey)
+            while len(entry.Variants) > WebcamHelper.c_MaxSnapshotVariantsPerCamera:
+                entry.Variants.popitem(last=False)
+
+
+    def _GetSnapshotCacheEntryForBody_UnderLock(self, snapshot) -> SnapshotCacheEntry:
+        if snapshot is None:
+            return None
+        for entry in self.SnapshotCache.values():
+            if entry.Body is snapshot:
+                return entry
+        return None
+
+
+    # Returns the cache key for the camera, or None if there's no camera.
+    # The key includes the urls and the transforms, so if the settings change, the old snapshot isn't used.
+    def _GetSnapshotCacheKey(self, cameraIndex:int = None):
+        obj = self._GetWebcamSettingObj(cameraIndex)
+        if obj is None:
+            return None
+        return (obj.Name, obj.SnapshotUrl, obj.StreamUrl, obj.FlipH, obj.FlipV, obj.Rotation)
+
+
+    def _GetSnapshotUncached(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
         # Wrap the entire result in the _EnsureJpegHeaderInfo function, so ensure the returned snapshot can be used by all image processing libs.
         # Wrap the entire result in the add transform function, so on success the header gets added.
         return self._AddOeWebcamTransformHeader(self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(cameraIndex)), cameraIndex)
@@ -0,0 +1,116 @@
+import threading
+
+
+#
+# A shared pool of reusable bytearrays, grouped in power of two size classes.
+#
+# Big file downloads and websocket floods allocate a large buffer for every message, for the compressed output and the flatbuffer message.
+# Allocating and freeing these big buffers over and over causes a lot of allocator churn, so instead the buffers are rented from this pool
+# and returned once they are no longer used.
+#
+# Rented buffers are not zeroed, so the renter must only use the parts it has written. Returning a buffer is optional, if a buffer is never
+# returned it's just cleaned up by the GC. But a buffer must never be used after it's returned.
+#
+class BufferPool:
+
+    # The smallest and largest size classes. Buffers larger than the max size class are allocated and not pooled.
+    c_MinClassSizeBytes = 16 * 1024
+    c_MaxClassSizeBytes = 4 * 1024 * 1024
+
+    # The max number of free buffers we will hold per size class.
+    c_MaxBuffersPerClass = 4
+
+    # The max number of bytes we will hold in free buffers across all size classes.
+    # We want to keep this low, since some of the devices we run on have very little memory.
+    c_MaxPooledBytes = 8 * 1024 * 1024
+
+    _Instance = None
+    _InstanceLock = threading.Lock()
+
+
+    # The pool doesn't need any setup, so it's created the first time it's used.
+    @staticmethod
+    def Get():
+        if BufferPool._Instance is None:
+            with BufferPool._InstanceLock:
+                if BufferPool._Instance is None:
+                    BufferPool._Instance = BufferPool()
+        return BufferPool._Instance
+
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # Maps class size -> list of free bytearrays
+        self.Pools = {}
+        self.PooledBytes = 0
+
+        # Stats
+        self.RentCount = 0
+        self.HitCount = 0
+        self.ReturnCount = 0
+        self.DropCount = 0
+
+
+    # Returns the size class a buffer of this size would be in, or None if it's too large to be pooled.
+    @staticmethod
+    def GetClassSize(sizeBytes:int) -> int:
+        if sizeBytes > BufferPool.c_MaxClassSizeBytes:
+            return None
+        classSize = BufferPool.c_MinClassSizeBytes
+        while classSize < sizeBytes:
+            classSize *= 2
+        return classSize
+
+
+    # Returns a bytearray that is at least the requested size.
+    # If the size can be pooled, the buffer will be the size of the class, so it might be larger than requested.
+    def Rent(self, minSizeBytes:int) -> bytearray:
+        classSize = BufferPool.GetClassSize(minSizeBytes)
+        if classSize is None:
+            return bytearray(minSizeBytes)
+        with self.Lock:
+            self.RentCount += 1
+            pool = self.Pools.get(classSize, None)
+            if pool is not None and len(pool) > 0:
+                self.HitCount += 1
+                self.PooledBytes -= classSize
+                return pool.pop()
+        return bytearray(classSize)
+
+
+    # Returns a buffer to the pool.
+    # Buffers that aren't an exact class size, or that don't fit in the pool, are dropped.
+    def Return(self, buffer:bytearray) -> None:
+        if buffer is None or isinstance(buffer, bytearray) is False:
+            return
+        size = len(buffer)
+        if size < BufferPool.c_MinClassSizeBytes or BufferPool.GetClassSize(size) != size:
+            return
+        with self.Lock:
+            pool = self.Pools.get(size, None)
+            if pool is None:
+                pool = []
+                self.Pools[size] = pool
+            if len(pool) >= BufferPool.c_MaxBuffersPerClass or self.PooledBytes + size > BufferPool.c_MaxPooledBytes:
+                self.DropCount += 1
+                return
+            # Make sure the same buffer isn't returned twice, which would let it be rented twice.
+            for b in pool:
+                if b is buffer:
+                    return
+            self.ReturnCount += 1
+            self.PooledBytes += size
+            pool.append(buffer)
+
+
+    # Returns a dict of the current stats.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "RentCount": self.RentCount,
+                "HitCount": self.HitCount,
+                "ReturnCount": self.ReturnCount,
+                "DropCount": self.DropCount,
+                "PooledBytes": self.PooledBytes,
+                "FreeBuffers": {size: len(pool) for size, pool in self.Pools.items()},
+            }
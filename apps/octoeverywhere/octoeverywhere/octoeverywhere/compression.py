@@ -9,12 +9,16 @@ import subprocess
 import multiprocessing
 
 from .sentry import Sentry
+from .bufferpool import BufferPool
+from .compressionpolicy import CompressionPolicy
 from .zstandarddictionary import ZStandardDictionary
 
 from .Proto.DataCompression import DataCompression
 
 
 # A return type for the compression operation.
+# Note that Bytes can be a memoryview of a buffer owned by the compression context, which is only valid until the next
+# compress call or until the context is closed. So the caller must use or copy the bytes before then.
 class CompressionResult:
     def __init__(self, b: bytes, duration:float, compressionType: DataCompression) -> None:
         self.Bytes = b
@@ -40,10 +44,18 @@ class CompressionContext:
 
         # Compression - can't be shared to be thread safe
         self.Compressor = None
+        self.CompressorLevel:int = None
         self.StreamWriter = None
-        self.CompressionByteBuffer:bytes = None
+        # The first chunk of compressed output is held as-is, since most of the time there's only one.
+        # If there's more than one chunk, they are copied into a pooled buffer, which is reused for every compress call.
+        self.CompressionFirstChunk:bytes = None
+        self.CompressionByteBuffer:bytearray = None
+        self.CompressionByteBufferLen = 0
         # The compression is more efficient if we know the size of the data of the og data.
         self.CompressionTotalSizeOfDataBytes:int = CompressionContext.TOTAL_SIZE_UNKNOWN
+        # The keys the compression policy uses to learn about this data, set if known.
+        self.PolicyContentTypeKey:str = None
+        self.PolicyPathKey:str = None
 
         # Decompression - can't be shared to be thread safe
         self.Decompressor = None
@@ -69,6 +81,7 @@ class CompressionContext:
         # We use a lock to ensure we don't leak any of the resources, especially the rented ones.
         streamWriter = None
         compressor = None
+        compressionByteBuffer = None
         streamReader = None
         decompressor = None
 
@@ -79,7 +92,10 @@ class CompressionContext:
             compressor = self.Compressor
             self.StreamWriter = None
             self.Compressor = None
+            compressionByteBuffer = self.CompressionByteBuffer
+            self.CompressionFirstChunk = None
             self.CompressionByteBuffer = None
+            self.CompressionByteBufferLen = 0
 
             streamReader = self.StreamReader
             decompressor = self.Decompressor
@@ -91,7 +107,9 @@ class CompressionContext:
         if streamWriter is not None:
             streamWriter.__exit__(exc_type, exc_value, traceback)
         if compressor is not None:
-            Compression.Get().ReturnZStandardCompressor(compressor)
+            Compression.Get().ReturnZStandardCompressor(compressor, self.CompressorLevel)
+        if compressionByteBuffer is not None:
+            BufferPool.Get().Return(compressionByteBuffer)
         if streamReader is not None:
             streamReader.__exit__(exc_type, exc_value, traceback)
         if decompressor is not None:
@@ -105,15 +123,45 @@ class CompressionContext:
         self.CompressionTotalSizeOfDataBytes = totalSizeBytes
 
 
+    # Sets what this data is, so the compression policy can learn about it and pick the best compression settings.
+    # The url can be a full url or just a path.
+    def SetPolicyInfo(self, contentTypeLower:str, url:str):
+        self.PolicyContentTypeKey, self.PolicyPathKey = CompressionPolicy.GetKeys(contentTypeLower, url)
+
+
+    # Returns true if the compression policy thinks this data is worth compressing.
+    def ShouldCompress(self) -> bool:
+        return Compression.Get().Policy.ShouldCompress(self.PolicyContentTypeKey, self.PolicyPathKey)
+
+
     # This is the callback from stream_writer that get called when it has data to write.
     def write(self, data):
-        # A bytearray is a better option if we are continuously appending data, since we can allocate a bigger buffer
-        # and copy into it. But 99% of the time we are only doing one compress callback at a time, in which case it's
+        # 99% of the time we are only doing one compress callback at a time, in which case it's
         # better to just take the buffer given to us and use it.
-        if self.CompressionByteBuffer is None:
-            self.CompressionByteBuffer = data
-        else:
-            self.CompressionByteBuffer += data
+        if self.CompressionFirstChunk is None and self.CompressionByteBufferLen == 0:
+            self.CompressionFirstChunk = data
+            return
+        # If there's more than one callback, we copy the chunks into the pooled buffer, which is better than appending bytes objects,
+        # since that allocates a new buffer for every chunk.
+        if self.CompressionFirstChunk is not None:
+            firstChunk = self.CompressionFirstChunk
+            self.CompressionFirstChunk = None
+            self._AppendToCompressionByteBuffer(firstChunk, len(firstChunk) + len(data))
+        self._AppendToCompressionByteBuffer(data)
+
+
+    def _AppendToCompressionByteBuffer(self, data, sizeHintBytes:int = 0):
+        newLen = self.CompressionByteBufferLen + len(data)
+        if self.CompressionByteBuffer is None or len(self.CompressionByteBuffer) < newLen:
+            # Grow the buffer by renting a bigger one, and return the old one.
+            oldBuffer = self.CompressionByteBuffer
+            newBuffer = BufferPool.Get().Rent(max(newLen, sizeHintBytes))
+            if oldBuffer is not None:
+                newBuffer[0:self.CompressionByteBufferLen] = oldBuffer[0:self.CompressionByteBufferLen]
+                BufferPool.Get().Return(oldBuffer)
+            self.CompressionByteBuffer = newBuffer
+        self.CompressionByteBuffer[self.CompressionByteBufferLen:newLen] = data
+        self.CompressionByteBufferLen = newLen
 
 
     # Compresses the data.
@@ -125,7 +173,8 @@ class CompressionContext:
             if self.IsClosed:
                 raise Exception("The compression context is closed, we can't compress data")
             if self.Compressor is None:
-                self.Compressor = Compression.Get().RentZStandardCompressor()
+                self.CompressorLevel = Compression.Get().Policy.GetZStandardLevel(self.PolicyContentTypeKey, self.PolicyPathKey)
+                self.Compressor = Compression.Get().RentZStandardCompressor(self.CompressorLevel)
                 if self.Compressor is None:
                     raise Exception("CompressionContext failed to rent a compressor")
 
@@ -153,10 +202,15 @@ class CompressionContext:
         self.StreamWriter.flush()
 
         # Capture the buffer of the written data.
-        if self.CompressionByteBuffer is None:
+        # If there was more than one chunk, we return a view of the pooled buffer, which is reused on the next compress call.
+        if self.CompressionFirstChunk is not None:
+            resultBuffer = self.CompressionFirstChunk
+            self.CompressionFirstChunk = None
+        elif self.CompressionByteBufferLen > 0:
+            resultBuffer = memoryview(self.CompressionByteBuffer)[0:self.CompressionByteBufferLen]
+            self.CompressionByteBufferLen = 0
+        else:
             raise Exception("CompressionContext failed to get a buffer of the compressed data")
-        resultBuffer = self.CompressionByteBuffer
-        self.CompressionByteBuffer = None
 
         # Done
         return CompressionResult(resultBuffer, time.time() - startSec, DataCompression.ZStandard)
@@ -249,7 +303,8 @@ class Compression:
     def __init__(self, logger: logging.Logger, localFileStoragePath:str) -> None:
         self.Logger = logger
         self.LocalFileStoragePath = localFileStoragePath
-        self.ZStandardCompressorPool = []
+        # The compressor pools are keyed by the compression level, since the level is set when the compressor is created.
+        self.ZStandardCompressorPools = {}
         self.ZStandardCompressorPoolLock = threading.Lock()
         self.ZStandardCompressorCreatedCount = 0
 
@@ -267,6 +322,9 @@ class Compression:
         else:
             self.ZStandardThreadCount = cpuCores - 2
 
+        # The policy that learns which data is worth compressing and how hard.
+        self.Policy = CompressionPolicy()
+
         # Always init the zstandard singleton, even if we aren't using zstandard.
         ZStandardDictionary.Init(logger)
 
@@ -306,17 +364,20 @@ class Compression:
 
 
     # Given a buffer of data, compress it using the best available compression library.
+    # The result is reported to the compression policy, so it can learn from it.
     def Compress(self, compressionContext:CompressionContext, data: bytes) -> CompressionResult:
         # If we have zstandard lib, use that, since it's better.
         if self.CanUseZStandardLib:
             # If we are training, submit the data to be sampled.
             # ZStandardDictionary.Get().SubmitData(data)
-            return compressionContext.Compress(data)
-
-        # If we can't use zStandard lib, fallback to zlib
-        startSec = time.time()
-        compressed = zlib.compress(data, 3)
-        return CompressionResult(compressed, time.time() - startSec, DataCompression.Zlib)
+            result = compressionContext.Compress(data)
+        else:
+            # If we can't use zStandard lib, fallback to zlib
+            startSec = time.time()
+            compressed = zlib.compress(data, self.Policy.GetZlibLevel())
+            result = CompressionResult(compressed, time.time() - startSec, DataCompression.Zlib)
+        self.Policy.RecordResult(compressionContext.PolicyContentTypeKey, compressionContext.PolicyPathKey, len(data), len(result.Bytes), result.CompressionTimeSec)
+        return result
 
 
     # Given a buffer of data and the compression type, decompresses it.
@@ -338,13 +399,17 @@ class Compression:
 
     # Returns a compressor or None if it fails to load.
     # The compressor warps the zstandard lib context, they are reusable but not thread safe.
-    def RentZStandardCompressor(self):
+    # If no level is passed, the default level is used.
+    def RentZStandardCompressor(self, level:int = None):
         if self.CanUseZStandardLib is False:
             return None
+        if level is None:
+            level = CompressionPolicy.c_ZStandardDefaultLevel
         try:
             with self.ZStandardCompressorPoolLock:
-                if len(self.ZStandardCompressorPool) > 0:
-                    return self.ZStandardCompressorPool.pop()
+                pool = self.ZStandardCompressorPools.get(level, None)
+                if pool is not None and len(pool) > 0:
+                    return pool.pop()
 
                 # Report how many we have created for leak detection.
                 self.ZStandardCompressorCreatedCount += 1
@@ -354,18 +419,24 @@ class Compression:
                 #pylint: disable=import-outside-toplevel
                 import zstandard as zstd
                 # We must use the pre-trained dict, since the service uses it as well and it must match.
-                return zstd.ZstdCompressor(threads=self.ZStandardThreadCount, dict_data=ZStandardDictionary.Get().PreTrainedDict)
+                return zstd.ZstdCompressor(level=level, threads=self.ZStandardThreadCount, dict_data=ZStandardDictionary.Get().PreTrainedDict)
         except Exception as e:
             self.Logger.error(f"Failed to rent zstandard compressor. Error: {e}")
         return None
 
 
-    # Puts the compressor back into the pool
-    def ReturnZStandardCompressor(self, compressor):
+    # Puts the compressor back into the pool for its level.
+    def ReturnZStandardCompressor(self, compressor, level:int = None):
         if compressor is None:
             return
+        if level is None:
+            level = CompressionPolicy.c_ZStandardDefaultLevel
         with self.ZStandardCompressorPoolLock:
-            self.ZStandardCompressorPool.append(compressor)
+            pool = self.ZStandardCompressorPools.get(level, None)
+            if pool is None:
+                pool = []
+                self.ZStandardCompressorPools[level] = pool
+            pool.append(compressor)
 
 
     # Returns a decompressor or None if it fails to load.
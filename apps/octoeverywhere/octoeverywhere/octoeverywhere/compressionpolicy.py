@@ -0,0 +1,218 @@
+import os
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+# Holds the learned compression stats for a single policy key.
+class CompressionPolicyStats:
+
+    def __init__(self) -> None:
+        self.Samples = 0
+        # The smoothed compressed size / original size ratio.
+        self.Ratio = 1.0
+        # The smoothed compression throughput.
+        self.BytesPerSec = 0.0
+        # Used to occasionally re-probe keys we are passing through.
+        self.SkippedCount = 0
+
+
+#
+# An adaptive policy that decides if and how hard we compress data.
+#
+# The policy learns the compression ratio and the time spent compressing from the recent compression results, both per content type and per path
+# prefix (including the file extension, so for example gcode files and thumbnails under the same prefix are tracked separately.)
+#   - Content that doesn't compress, like jpegs or already gzipped assets, is switched to a raw pass-through. Keys that are passed through are
+#     still compressed once in a while, so if the content changes, we will pick it back up.
+#   - The zstandard level is picked based on the measured CPU budget. If we are spending more time compressing than the budget allows, the level
+#     is lowered, and if there's plenty of headroom, it's raised. The budget scales with the core count, so low core printers are kept light.
+#
+# The compression level doesn't need to be known by the server, so it's free to change per compression context.
+#
+class CompressionPolicy:
+
+    # The zstandard level range. Level 3 is the zstandard default, which is what we used before the policy existed.
+    c_ZStandardMinLevel = 1
+    c_ZStandardDefaultLevel = 3
+    c_ZStandardMaxLevel = 6
+    # Systems with this many cores or less will never go above the default level.
+    c_LowCoreCountMax = 3
+
+    # The zlib levels we will use, zlib is only used if zstandard can't be loaded.
+    c_ZlibMinLevel = 1
+    c_ZlibDefaultLevel = 3
+
+    # The share of one core per core we allow to be spent on compression, and the max share.
+    # For example, a 1 core system gets 10% of the core, a 4 core system gets 40% of one core.
+    c_CpuBudgetPerCore = 0.10
+    c_CpuBudgetMax = 0.50
+
+    # How often the CPU usage is measured and the level is adjusted.
+    c_CpuWindowSec = 5.0
+
+    # If the ratio is higher than this, the data isn't worth compressing.
+    c_PassThroughRatio = 0.95
+    # If the ratio is higher than this, the data doesn't compress well, so we only use the min level.
+    c_PoorRatio = 0.80
+    # The number of samples needed before a key's stats are used.
+    c_MinSamples = 3
+    # When a key is being passed through, every Nth request is compressed anyway to re-learn the ratio.
+    c_ReprobeInterval = 25
+    # The weight given to a new sample.
+    c_SmoothingFactor = 0.2
+
+    # The max number of keys we will track.
+    c_MaxKeys = 200
+
+    # File extensions we know never compress well, these are always passed through.
+    c_IncompressibleExtensions = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".gz", ".tgz", ".zip", ".3mf", ".7z", ".br", ".zst", ".mp4", ".webm", ".woff2")
+
+    # The content type key used for websocket messages.
+    c_WebsocketContentType = "websocket"
+
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # Maps key -> CompressionPolicyStats, in LRU order.
+        self.Stats = OrderedDict()
+
+        cpuCores = multiprocessing.cpu_count()
+        self.CpuBudget = min(CompressionPolicy.c_CpuBudgetMax, cpuCores * CompressionPolicy.c_CpuBudgetPerCore)
+        self.MaxLevel = CompressionPolicy.c_ZStandardDefaultLevel if cpuCores <= CompressionPolicy.c_LowCoreCountMax else CompressionPolicy.c_ZStandardMaxLevel
+        self.CurrentLevel = CompressionPolicy.c_ZStandardDefaultLevel
+
+        # CPU usage tracking.
+        self.CpuWindowStartSec = time.time()
+        self.CpuWindowCompressionSec = 0.0
+        self.LastCpuUsage = 0.0
+
+        # Stats
+        self.PassThroughCount = 0
+        self.LevelChanges = 0
+
+
+    # Returns the content type and path keys for a content type header and url.
+    # The content type is lowered and the params are removed. The path key is the first two path segments plus the file extension, if any.
+    @staticmethod
+    def GetKeys(contentTypeLower:str, url:str):
+        contentTypeKey = None
+        if contentTypeLower is not None:
+            contentTypeKey = "type:" + contentTypeLower.split(";", 1)[0].strip()
+        pathKey = None
+        if url is not None:
+            path = url
+            if url.find("://") != -1:
+                path = urlparse(url).path
+            else:
+                path = url.split("?", 1)[0]
+            segments = [s for s in path.split("/") if len(s) > 0]
+            _, ext = os.path.splitext(segments[-1] if len(segments) > 0 else "")
+            pathKey = "path:/" + "/".join(segments[:2]) + "*" + ext.lower()
+        return (contentTypeKey, pathKey)
+
+
+    # Returns true if the data for these keys should be compressed, false if it should be passed through.
+    def ShouldCompress(self, contentTypeKey:str, pathKey:str) -> bool:
+        if pathKey is not None and pathKey.endswith(CompressionPolicy.c_IncompressibleExtensions):
+            with self.Lock:
+                self.PassThroughCount += 1
+            return False
+        with self.Lock:
+            stats = self._GetDecidingStats_UnderLock(contentTypeKey, pathKey)
+            if stats is None or stats.Ratio < CompressionPolicy.c_PassThroughRatio:
+                return True
+            stats.SkippedCount += 1
+            if stats.SkippedCount % CompressionPolicy.c_ReprobeInterval == 0:
+                return True
+            self.PassThroughCount += 1
+            return False
+
+
+    # Returns the zstandard level to use for these keys.
+    def GetZStandardLevel(self, contentTypeKey:str, pathKey:str) -> int:
+        with self.Lock:
+            stats = self._GetDecidingStats_UnderLock(contentTypeKey, pathKey)
+            if stats is not None and stats.Ratio > CompressionPolicy.c_PoorRatio:
+                # This data doesn't compress well, so a higher level won't buy much.
+                return CompressionPolicy.c_ZStandardMinLevel
+            return self.CurrentLevel
+
+
+    # Returns the zlib level to use, which only follows the CPU budget.
+    def GetZlibLevel(self) -> int:
+        if self.CurrentLevel < CompressionPolicy.c_ZStandardDefaultLevel:
+            return CompressionPolicy.c_ZlibMinLevel
+        return CompressionPolicy.c_ZlibDefaultLevel
+
+
+    # Called with the result of every compression.
+    def RecordResult(self, contentTypeKey:str, pathKey:str, originalSize:int, compressedSize:int, durationSec:float) -> None:
+        if originalSize <= 0:
+            return
+        ratio = compressedSize / originalSize
+        bytesPerSec = originalSize / max(durationSec, 0.000001)
+        with self.Lock:
+            for key in (contentTypeKey, pathKey):
+                if key is None:
+                    continue
+                stats = self.Stats.get(key, None)
+                if stats is None:
+                    stats = CompressionPolicyStats()
+                    stats.Ratio = ratio
+                    stats.BytesPerSec = bytesPerSec
+                    self.Stats[key] = stats
+                    while len(self.Stats) > CompressionPolicy.c_MaxKeys:
+                        self.Stats.popitem(last=False)
+                else:
+                    a = CompressionPolicy.c_SmoothingFactor
+                    stats.Ratio = (stats.Ratio * (1.0 - a)) + (ratio * a)
+                    stats.BytesPerSec = (stats.BytesPerSec * (1.0 - a)) + (bytesPerSec * a)
+                    self.Stats.move_to_end(key)
+                stats.Samples += 1
+            self.CpuWindowCompressionSec += durationSec
+            self._UpdateLevelIfNeeded_UnderLock()
+
+
+    # Returns a dict of the current stats.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Level": self.CurrentLevel,
+                "MaxLevel": self.MaxLevel,
+                "CpuBudget": self.CpuBudget,
+                "LastCpuUsage": self.LastCpuUsage,
+                "LevelChanges": self.LevelChanges,
+                "PassThroughCount": self.PassThroughCount,
+                "Keys": {k: {"Samples": s.Samples, "Ratio": round(s.Ratio, 3), "MBps": round(s.BytesPerSec / (1024 * 1024), 2)} for k, s in self.Stats.items()},
+            }
+
+
+    # The path key is more specific, so if it has enough samples, it's used. Otherwise, we fall back to the content type.
+    def _GetDecidingStats_UnderLock(self, contentTypeKey:str, pathKey:str) -> CompressionPolicyStats:
+        for key in (pathKey, contentTypeKey):
+            if key is None:
+                continue
+            stats = self.Stats.get(key, None)
+            if stats is not None and stats.Samples >= CompressionPolicy.c_MinSamples:
+                return stats
+        return None
+
+
+    def _UpdateLevelIfNeeded_UnderLock(self) -> None:
+        now = time.time()
+        elapsedSec = now - self.CpuWindowStartSec
+        if elapsedSec < CompressionPolicy.c_CpuWindowSec:
+            return
+        self.LastCpuUsage = self.CpuWindowCompressionSec / elapsedSec
+        self.CpuWindowCompressionSec = 0.0
+        self.CpuWindowStartSec = now
+        newLevel = self.CurrentLevel
+        if self.LastCpuUsage > self.CpuBudget:
+            newLevel = max(CompressionPolicy.c_ZStandardMinLevel, self.CurrentLevel - 1)
+        elif self.LastCpuUsage < self.CpuBudget * 0.25:
+            newLevel = min(self.MaxLevel, self.CurrentLevel + 1)
+        if newLevel != self.CurrentLevel:
+            self.CurrentLevel = newLevel
+            self.LevelChanges += 1
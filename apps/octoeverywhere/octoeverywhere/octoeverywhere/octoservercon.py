@@ -385,10 +385,10 @@ class OctoServerCon:
                 runForTimeChecker.Stop()
 
 
-    def SendMsg(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int):
+    def SendMsg(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int, onSentCallback = None):
         # When we send any message, consider it user activity.
         self.LastUserActivityTime = datetime.now()
-        self.Ws.Send(buffer, msgStartOffsetBytes, msgSize, True)
+        self.Ws.Send(buffer, msgStartOffsetBytes, msgSize, True, onSentCallback)
 
 
     def GetWsId(self, ws):
@@ -10,6 +10,8 @@ import logging
 #
 
 from .WebStream import octowebstream
+from .WebStream.octowebstreampriority import OctoWebStreamPriorityGate
+from .WebStream.octowebstreamworkerpool import OctoWebStreamWorkerPool
 from .octohttprequest import OctoHttpRequest
 from .localip import LocalIpHelper
 from .octostreammsgbuilder import OctoStreamMsgBuilder
@@ -35,6 +37,7 @@ class OctoSession:
         self.ActiveWebStreams = {}
         self.ActiveWebStreamsLock = threading.Lock()
         self.IsAcceptingStreams = True
+        self.WebStreamPriorityGate = OctoWebStreamPriorityGate()
 
         self.Logger = logger
         self.SessionId = sessionId
@@ -56,9 +59,10 @@ class OctoSession:
         self.OctoStream.OnSessionError(self.SessionId, backoffModifierSec)
 
 
-    def Send(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int):
+    # If the optional onSentCallback is set, it's called with the buffer once it has been sent.
+    def Send(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int, onSentCallback = None):
         # The message is already encoded, pass it along to the socket.
-        self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSize)
+        self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSize, onSentCallback)
 
 
     def HandleSummonRequest(self, msg):
@@ -194,11 +198,12 @@ class OctoSession:
                     return
 
                 # Create the new stream object now.
-                localStream = octowebstream.OctoWebStream(name="OctoWebStreamPumper", args=(self.Logger, streamId, self, ))
+                # If the worker pool is enabled, the stream will run on it, otherwise it gets its own thread.
+                localStream = octowebstream.OctoWebStream(name="OctoWebStreamPumper", args=(self.Logger, streamId, self, OctoWebStreamWorkerPool.Get(), ))
                 # Set it in the map
                 self.ActiveWebStreams[streamId] = localStream
-                # Start it's main worker thread
-                localStream.start()
+                # Start it's main worker thread, or get it ready to be scheduled on the pool.
+                localStream.Start()
 
         # If we get here, we know we must have a localStream
         localStream.OnIncomingServerMessage(webStreamMsg)
@@ -17,3 +17,9 @@ class SnapshotResizeParams:
         self.ResizeToWidth = resizeToWidth
         # If set to True, the size will be used for the height and width, and the image will remain uniform, but cropped to center.
         self.CropSquareCenterNoPadding = cropSquareCenterNoPadding
+
+
+    # Returns a hashable key for these params, used to cache the transformed snapshots.
+    # Note this must be taken before the params are used, since the crop logic updates the resize flags.
+    def GetCacheKey(self):
+        return (self.Size, self.ResizeToHeight, self.ResizeToWidth, self.CropSquareCenterNoPadding)
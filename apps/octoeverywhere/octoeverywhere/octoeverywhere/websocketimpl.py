@@ -231,22 +231,23 @@ class Client:
         self._Close()
 
 
-    def Send(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, isData:bool = True):
+    def Send(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, isData:bool = True, onSentCallback = None):
         if isData:
-            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_BINARY)
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_BINARY, onSentCallback)
         else:
-            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_TEXT)
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_TEXT, onSentCallback)
 
 
     # Sends a buffer, with an optional message start offset and size.
     # If the message start offset and size are not provided, it's assumed the buffer starts at 0 and the size is the full buffer.
     # Providing a bytearray with room in the front allows the system to avoid copying the buffer.
-    def SendWithOptCode(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY):
+    # If the optional onSentCallback is set, it's called with the buffer from the send thread once the buffer has been sent and is no longer used.
+    def SendWithOptCode(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY, onSentCallback = None):
         try:
             # Make sure we have a buffer, this is invalid and it will also shutdown our send thread.
             if buffer is None:
                 raise Exception("We tired to send a message to the websocket with a None buffer.")
-            self.SendQueue.put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode))
+            self.SendQueue.put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode, onSentCallback))
         except Exception as e:
             # If any exception happens during sending, we want to report the error
             # and shutdown the entire websocket.
@@ -266,6 +267,12 @@ class Client:
                 # The frame masking was only need back when websockets were used over the internet without SSL.
                 # Our server, OctoPrint, and Moonraker all accept unmasked frames, so its safe to do this for all WS.
                 self.Ws.send(context.Buffer, context.OptCode, False, context.MsgStartOffsetBytes, context.MsgSize)
+                if context.OnSentCallback is not None:
+                    # A callback error shouldn't take down the websocket, since the message was sent.
+                    try:
+                        context.OnSentCallback(context.Buffer)
+                    except Exception as e:
+                        Sentry.Exception("Websocket client exception in send callback.", e)
         except Exception as e:
             # If any exception happens during sending, we want to report the error
             # and shutdown the entire websocket.
@@ -332,8 +339,9 @@ class Client:
 
 
 class SendQueueContext():
-    def __init__(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY) -> None:
+    def __init__(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY, onSentCallback = None) -> None:
         self.Buffer = buffer
         self.MsgStartOffsetBytes = msgStartOffsetBytes
         self.MsgSize = msgSize
         self.OptCode = optCode
+        self.OnSentCallback = onSentCallback
@@ -20,4 +20,6 @@ cp -pr /work/klipper/*/klippy/* /apps/vanilla-klipper/klippy/
 cp -p /work/klipper/*/scripts/klippy-requirements.txt /apps/vanilla-klipper/
 
 cd /apps/vanilla-klipper
+# klippy.patch holds every local change to klippy/, regenerate it (diff against
+# upstream, paths relative to this folder) whenever klippy/ is edited
 patch -p0 < klippy.patch
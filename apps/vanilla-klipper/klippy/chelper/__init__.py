@@ -185,6 +185,8 @@ defs_serialqueue = """
         , uint64_t notify_id);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_wire_frequency(struct serialqueue *sq
         , double frequency);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -835,23 +835,10 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
     serialqueue_send_one(sq, cq, qm);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
-void __visible
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+// Remove the first message from the receive queue (sq->lock must be held)
+static void
+pull_message(struct serialqueue *sq, struct pull_queue_message *pqm)
 {
-    pthread_mutex_lock(&sq->lock);
-    // Wait for message to be available
-    while (list_empty(&sq->receive_queue)) {
-        if (pollreactor_is_exit(sq->pr))
-            goto exit;
-        sq->receive_waiting = 1;
-        int ret = pthread_cond_wait(&sq->cond, &sq->lock);
-        if (ret)
-            report_errno("pthread_cond_wait", ret);
-    }
-
-    // Remove message from queue
     struct queue_message *qm = list_first_entry(
         &sq->receive_queue, struct queue_message, node);
     list_del(&qm->node);
@@ -866,13 +853,54 @@ serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
         debug_queue_add(&sq->old_receive, qm);
     else
         message_free(qm);
+}
 
+// Wait for a message to be available (sq->lock must be held).  Returns
+// non-zero if the serialqueue is exiting.
+static int
+wait_receive(struct serialqueue *sq)
+{
+    while (list_empty(&sq->receive_queue)) {
+        if (pollreactor_is_exit(sq->pr))
+            return -1;
+        sq->receive_waiting = 1;
+        int ret = pthread_cond_wait(&sq->cond, &sq->lock);
+        if (ret)
+            report_errno("pthread_cond_wait", ret);
+    }
+    return 0;
+}
+
+// Return a message read from the serial port (or wait for one if none
+// available)
+void __visible
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    pthread_mutex_lock(&sq->lock);
+    if (wait_receive(sq))
+        pqm->len = -1;
+    else
+        pull_message(sq, pqm);
     pthread_mutex_unlock(&sq->lock);
-    return;
+}
 
-exit:
-    pqm->len = -1;
+// Return up to 'max' messages read from the serial port (or wait for
+// one if none available).  Returns the number of messages stored in
+// 'q', or -1 if the serialqueue is exiting.
+int __visible
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *q
+                       , int max)
+{
+    pthread_mutex_lock(&sq->lock);
+    if (wait_receive(sq)) {
+        pthread_mutex_unlock(&sq->lock);
+        return -1;
+    }
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue))
+        pull_message(sq, &q[count++]);
     pthread_mutex_unlock(&sq->lock);
+    return count;
 }
 
 void __visible
@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, time, collections, multiprocessing, os
+import util
 from . import bus, bulk_sensor
 
 # ADXL345 registers
@@ -259,6 +260,20 @@ class ADXL345:
             samples[count] = (round(ptime, 6), x, y, z)
             count += 1
         del samples[count:]
+    def _convert_sample_columns(self, times, columns):
+        # Vectorized version of _convert_samples()
+        np = util.load_numpy()
+        xlow, ylow, zlow, xzhigh, yzhigh = [c.astype(np.int32)
+                                            for c in columns]
+        valid = (yzhigh & 0x80) == 0
+        self.last_error_count += len(valid) - int(np.count_nonzero(valid))
+        rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+              - ((yzhigh & 0x40) << 7))
+        raw_xyz = (rx[valid], ry[valid], rz[valid])
+        return [np.round(times[valid], 6)] + [
+            np.round(raw_xyz[pos] * scale, 6) for pos, scale in self.axes_map]
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing ADXL345 device ID prevents treating
@@ -291,8 +306,15 @@ class ADXL345:
         self.ffreader.note_end()
         logging.info("ADXL345 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        if util.load_numpy() is not None:
+            times, columns = self.ffreader.pull_sample_columns()
+            samples = []
+            if len(times):
+                columns = self._convert_sample_columns(times, columns)
+                samples = list(zip(*[c.tolist() for c in columns]))
+        else:
+            samples = self.ffreader.pull_samples()
+            self._convert_samples(samples)
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
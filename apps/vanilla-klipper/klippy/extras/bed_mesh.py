@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, json, collections
+import util
 from . import probe
 
 PROFILE_VERSION = 1
@@ -16,6 +17,10 @@ PROFILE_OPTIONS = {
 class BedMeshError(Exception):
     pass
 
+# Interpolation weights are reused when the same mesh layout is rebuilt
+INTERP_WEIGHTS_CACHE = {}
+INTERP_WEIGHTS_CACHE_SIZE = 16
+
 # PEP 485 isclose()
 def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
     return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
@@ -34,6 +39,26 @@ def constrain(val, min_val, max_val):
 def lerp(t, v0, v1):
     return (1. - t) * v0 + t * v1
 
+# Apply separable interpolation weights to a probed z matrix.  Weights
+# are lists of (probe index, weight) pairs for each mesh index on an axis.
+def apply_interp_weights(z_matrix, x_weights, y_weights):
+    np = util.load_numpy()
+    if np is not None:
+        x_mat = np.zeros((len(x_weights), len(z_matrix[0])))
+        for i, weights in enumerate(x_weights):
+            for pt, w in weights:
+                x_mat[i, pt] = w
+        y_mat = np.zeros((len(y_weights), len(z_matrix)))
+        for i, weights in enumerate(y_weights):
+            for pt, w in weights:
+                y_mat[i, pt] = w
+        return y_mat.dot(np.array(z_matrix)).dot(x_mat.T).tolist()
+    # Interpolate X along the probed rows, then Y along each column
+    rows = [[sum([row[pt] * w for pt, w in weights])
+             for weights in x_weights] for row in z_matrix]
+    return [[sum([rows[pt][i] * w for pt, w in weights])
+             for i in range(len(x_weights))] for weights in y_weights]
+
 # retreive commma separated pair from config
 def parse_config_pair(config, option, default, minval=None, maxval=None):
     pair = config.getintlist(option, (default, default))
@@ -1276,6 +1301,15 @@ class MoveSplitter:
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        self.skip_distance = None
+    def _update_skip_distance(self):
+        # Find how far along the move the mesh stays within split_delta_z
+        # of the last split, check points before that can't split the move
+        t_start = self.distance_checked / self.total_move_length
+        max_dev = self.split_delta_z / self.z_factor - 1e-9
+        t_limit = self.z_mesh.calc_deviation_limit(
+            self.prev_pos, self.next_pos, t_start, max_dev)
+        self.skip_distance = t_limit * self.total_move_length
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         offset = self.fade_offset
@@ -1296,11 +1330,16 @@ class MoveSplitter:
                 # X and/or Y axis move, traverse if necessary
                 while self.distance_checked + self.move_check_distance \
                         < self.total_move_length:
+                    if self.skip_distance is None:
+                        self._update_skip_distance()
                     self.distance_checked += self.move_check_distance
+                    if self.distance_checked < self.skip_distance:
+                        continue
                     self._set_next_move(self.distance_checked)
                     next_z = self._calc_z_offset(self.current_pos)
                     if abs(next_z - self.z_offset) >= self.split_delta_z:
                         self.z_offset = next_z
+                        self.skip_distance = None
                         return self.current_pos[0], self.current_pos[1], \
                             self.current_pos[2] + self.z_offset, \
                             self.current_pos[3]
@@ -1321,6 +1360,8 @@ class ZMesh:
     def __init__(self, params, name):
         self.profile_name = name or "adaptive-%X" % (id(self),)
         self.probed_matrix = self.mesh_matrix = None
+        # Flat list of bilinear coefficients (z00, dx, dy, dxy) per cell
+        self.cell_coeffs = None
         self.mesh_params = params
         self.mesh_offsets = [0., 0.]
         logging.debug('bed_mesh: probe/mesh parameters:')
@@ -1401,10 +1442,17 @@ class ZMesh:
             print_func(msg)
         else:
             print_func("bed_mesh: Z Mesh not generated")
-    def build_mesh(self, z_matrix):
+    def build_mesh(self, z_matrix, mesh_matrix=None):
         self.probed_matrix = z_matrix
-        self._sample(z_matrix)
-        self.print_mesh(logging.debug)
+        if mesh_matrix is not None:
+            # Previously interpolated mesh for the same probed points
+            self.mesh_matrix = [list(line) for line in mesh_matrix]
+        else:
+            self._sample(z_matrix)
+        self._build_cell_coeffs()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # Formatting a dense mesh is slower than building it
+            self.print_mesh(logging.debug)
     def set_zero_reference(self, xpos, ypos):
         offset = self.calc_z(xpos, ypos)
         logging.info(
@@ -1415,6 +1463,7 @@ class ZMesh:
             for yidx in range(len(matrix)):
                 for xidx in range(len(matrix[yidx])):
                     matrix[yidx][xidx] -= offset
+        self._build_cell_coeffs()
     def set_mesh_offsets(self, offsets):
         for i, o in enumerate(offsets):
             if o is not None:
@@ -1425,15 +1474,101 @@ class ZMesh:
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
         if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
+            xidx, tx = self._get_cell_index(
+                x + self.mesh_offsets[0] - self.mesh_x_min,
+                self.mesh_x_dist, self.mesh_x_count)
+            yidx, ty = self._get_cell_index(
+                y + self.mesh_offsets[1] - self.mesh_y_min,
+                self.mesh_y_dist, self.mesh_y_count)
+            i = (yidx * (self.mesh_x_count - 1) + xidx) * 4
+            z00, zx, zy, zxy = self.cell_coeffs[i:i+4]
+            return z00 + zx * tx + (zy + zxy * tx) * ty
         else:
             # No mesh table generated, no z-adjustment
             return 0.
+    def calc_deviation_limit(self, start_pos, end_pos, t_start, max_dev):
+        # Return the fraction of the move from start_pos to end_pos up to
+        # which the mesh z stays within max_dev of the z at t_start.  Along
+        # a line the bilinear surface is a quadratic in t within each cell,
+        # so it is bounded analytically between cell crossings.
+        if self.mesh_matrix is None:
+            return 1.
+        x_dist, y_dist = self.mesh_x_dist, self.mesh_y_dist
+        x_cnt, y_cnt = self.mesh_x_count, self.mesh_y_count
+        x0 = start_pos[0] + self.mesh_offsets[0] - self.mesh_x_min
+        y0 = start_pos[1] + self.mesh_offsets[1] - self.mesh_y_min
+        dx = end_pos[0] - start_pos[0]
+        dy = end_pos[1] - start_pos[1]
+        crossings = (self._get_grid_crossings(x0, dx, x_dist, x_cnt, t_start)
+                     + self._get_grid_crossings(y0, dy, y_dist, y_cnt,
+                                                t_start))
+        crossings.sort()
+        crossings.append(1.)
+        coeffs = self.cell_coeffs
+        z_ref = None
+        ta = t_start
+        for tb in crossings:
+            if tb <= ta:
+                continue
+            tm = .5 * (ta + tb)
+            xidx, tx = self._get_cell_index(x0 + dx * tm, x_dist, x_cnt)
+            yidx, ty = self._get_cell_index(y0 + dy * tm, y_dist, y_cnt)
+            # Cell parameters as linear functions of t (tx = tx0 + tx1 * t)
+            tx1 = dx / x_dist if 0. < tx < 1. else 0.
+            ty1 = dy / y_dist if 0. < ty < 1. else 0.
+            tx0 = tx - tx1 * tm
+            ty0 = ty - ty1 * tm
+            i = (yidx * (x_cnt - 1) + xidx) * 4
+            z00, zx, zy, zxy = coeffs[i:i+4]
+            # z(t) = q0 + q1 * t + q2 * t^2
+            q0 = z00 + zx * tx0 + zy * ty0 + zxy * tx0 * ty0
+            q1 = zx * tx1 + zy * ty1 + zxy * (tx0 * ty1 + tx1 * ty0)
+            q2 = zxy * tx1 * ty1
+            za = q0 + (q1 + q2 * ta) * ta
+            zb = q0 + (q1 + q2 * tb) * tb
+            if z_ref is None:
+                z_ref = za
+            z_min, z_max = min(za, zb), max(za, zb)
+            if q2:
+                tv = -q1 / (2. * q2)
+                if ta < tv < tb:
+                    zv = q0 + (q1 + q2 * tv) * tv
+                    z_min, z_max = min(z_min, zv), max(z_max, zv)
+            if z_max - z_ref >= max_dev or z_ref - z_min >= max_dev:
+                return ta
+            ta = tb
+        return 1.
+    def _get_grid_crossings(self, c0, dc, dist, cnt, t_start):
+        # Return the move fractions where a mesh grid line is crossed
+        if isclose(dc, 0., abs_tol=1e-10):
+            return []
+        c1 = c0 + dc
+        first = max(0, int(math.ceil(min(c0, c1) / dist)))
+        last = min(cnt - 1, int(math.floor(max(c0, c1) / dist)))
+        crossings = [(idx * dist - c0) / dc for idx in range(first, last + 1)]
+        return [t for t in crossings if t_start < t < 1.]
+    def _get_cell_index(self, coord, dist, cnt):
+        # Return the cell index and position within the cell for a
+        # coordinate relative to the mesh minimum
+        c = coord / dist
+        idx = int(math.floor(c))
+        if idx < 0:
+            return 0, 0.
+        elif idx > cnt - 2:
+            return cnt - 2, 1.
+        return idx, min(c - idx, 1.)
+    def _build_cell_coeffs(self):
+        tbl = self.mesh_matrix
+        coeffs = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0 = tbl[yidx]
+            row1 = tbl[yidx + 1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00, z10 = row0[xidx], row0[xidx + 1]
+                z01, z11 = row1[xidx], row1[xidx + 1]
+                coeffs.extend((z00, z10 - z00, z01 - z00,
+                               z11 - z10 - z01 + z00))
+        self.cell_coeffs = coeffs
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -1451,52 +1586,16 @@ class ZMesh:
             return round(avg_z, 2)
         else:
             return 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
         xpts, ypts = self._get_lagrange_coords()
-        # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
-                continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_matrix[i][j] = self._calc_lagrange(xpts, x, i, 0)
-        # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_matrix[j][i] = self._calc_lagrange(ypts, y, i, 1)
+        x_weights = self._get_axis_weights(
+            'lagrange', xpts, self.get_x_coordinate, self.mesh_x_count)
+        y_weights = self._get_axis_weights(
+            'lagrange', ypts, self.get_y_coordinate, self.mesh_y_count)
+        self.mesh_matrix = apply_interp_weights(z_matrix, x_weights,
+                                                y_weights)
     def _get_lagrange_coords(self):
         xpts = []
         ypts = []
@@ -1505,9 +1604,42 @@ class ZMesh:
         for j in range(self.mesh_params['y_count']):
             ypts.append(self.get_y_coordinate(j * self.y_mult))
         return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
+    def _sample_bicubic(self, z_matrix):
+        # should work for any number of probe points above 3x3
+        xpts, ypts = self._get_lagrange_coords()
+        x_weights = self._get_axis_weights(
+            'bicubic', xpts, self.get_x_coordinate, self.mesh_x_count)
+        y_weights = self._get_axis_weights(
+            'bicubic', ypts, self.get_y_coordinate, self.mesh_y_count)
+        self.mesh_matrix = apply_interp_weights(z_matrix, x_weights,
+                                                y_weights)
+    def _get_axis_weights(self, algo, pts, cfunc, mesh_cnt):
+        # The interpolated mesh is linear in the probed points, so each
+        # axis is described by a weight matrix of shape (mesh_cnt, probe_cnt)
+        tension = self.mesh_params['tension']
+        key = (algo, tuple(pts), mesh_cnt, tension)
+        weights = INTERP_WEIGHTS_CACHE.get(key)
+        if weights is not None:
+            return weights
+        probe_cnt = len(pts)
+        mult = (mesh_cnt - 1) // (probe_cnt - 1)
+        weights = []
+        for i in range(mesh_cnt):
+            if i % mult == 0:
+                # Probed point
+                weights.append([(i // mult, 1.)])
+            elif algo == 'lagrange':
+                weights.append(self._calc_lagrange_weights(pts, cfunc(i)))
+            else:
+                weights.append(self._calc_bicubic_weights(
+                    i, mult, mesh_cnt, tension))
+        if len(INTERP_WEIGHTS_CACHE) >= INTERP_WEIGHTS_CACHE_SIZE:
+            INTERP_WEIGHTS_CACHE.clear()
+        INTERP_WEIGHTS_CACHE[key] = weights
+        return weights
+    def _calc_lagrange_weights(self, lpts, c):
         pt_cnt = len(lpts)
-        total = 0.
+        weights = []
         for i in range(pt_cnt):
             n = 1.
             d = 1.
@@ -1516,111 +1648,35 @@ class ZMesh:
                     continue
                 n *= (c - lpts[j])
                 d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_matrix[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_matrix[i*self.y_mult][vec]
-            total += z * n / d
-        return total
-    def _sample_bicubic(self, z_matrix):
-        # should work for any number of probe points above 3x3
-        x_mult = self.x_mult
-        y_mult = self.y_mult
-        c = self.mesh_params['tension']
-        self.mesh_matrix = \
-            [[0. if ((i % x_mult) or (j % y_mult))
-             else z_matrix[j//y_mult][i//x_mult]
-             for i in range(self.mesh_x_count)]
-             for j in range(self.mesh_y_count)]
-        # Interpolate X values
-        for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
-                continue
-            for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_matrix[y][x] = self._cardinal_spline(pts, c)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_matrix[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
+            weights.append((i, n / d))
+        return weights
+    def _calc_bicubic_weights(self, idx, mult, mesh_cnt, tension):
+        # Fetch control points (as probe indices) and t for a mesh index
+        last_pt = mesh_cnt - 1 - mult
+        if idx < mult:
+            ctl_pts = (0, 0, 1, 2)
+            t = idx / float(mult)
+        elif idx > last_pt:
+            base = last_pt // mult
+            ctl_pts = (base - 1, base, base + 1, base + 1)
+            t = (idx - last_pt) / float(mult)
         else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding x control points")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_matrix
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
-        else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding y control points")
-        return p0, p1, p2, p3, t
-    def _cardinal_spline(self, p, tension):
-        t = p[4]
+            base = idx // mult
+            ctl_pts = (base - 1, base, base + 1, base + 2)
+            t = (idx - base * mult) / float(mult)
+        # Cardinal spline basis functions for each control point
         t2 = t*t
         t3 = t2*t
-        m1 = tension * (p[2] - p[0])
-        m2 = tension * (p[3] - p[1])
-        a = p[1] * (2*t3 - 3*t2 + 1)
-        b = p[2] * (-2*t3 + 3*t2)
-        c = m1 * (t3 - 2*t2 + t)
-        d = m2 * (t3 - t2)
-        return a + b + c + d
+        h00 = 2*t3 - 3*t2 + 1
+        h01 = -2*t3 + 3*t2
+        h10 = t3 - 2*t2 + t
+        h11 = t3 - t2
+        basis = (-tension * h10, h00 - tension * h11,
+                 h01 + tension * h10, tension * h11)
+        weights = collections.OrderedDict()
+        for pt, w in zip(ctl_pts, basis):
+            weights[pt] = weights.get(pt, 0.) + w
+        return list(weights.items())
 
 
 class ProfileManager:
@@ -1630,6 +1686,8 @@ class ProfileManager:
         self.gcode = self.printer.lookup_object('gcode')
         self.bedmesh = bedmesh
         self.profiles = {}
+        # Interpolated mesh matrices of loaded profiles
+        self.mesh_cache = {}
         self.incompatible_profiles = []
         # Fetch stored profiles from Config
         stored_profs = config.get_prefix_sections(self.name)
@@ -1703,6 +1761,7 @@ class ProfileManager:
         profile['points'] = probed_matrix
         profile['mesh_params'] = collections.OrderedDict(mesh_params)
         self.profiles = profiles
+        self.mesh_cache.pop(prof_name, None)
         self.bedmesh.update_status()
         self.gcode.respond_info(
             "Bed Mesh state has been saved to profile [%s]\n"
@@ -1717,10 +1776,14 @@ class ProfileManager:
         probed_matrix = profile['points']
         mesh_params = profile['mesh_params']
         z_mesh = ZMesh(mesh_params, prof_name)
+        mesh_matrix = self.mesh_cache.get(prof_name)
         try:
-            z_mesh.build_mesh(probed_matrix)
+            z_mesh.build_mesh(probed_matrix, mesh_matrix)
         except BedMeshError as e:
             raise self.gcode.error(str(e))
+        if mesh_matrix is None:
+            self.mesh_cache[prof_name] = [
+                list(line) for line in z_mesh.mesh_matrix]
         self.bedmesh.set_mesh(z_mesh)
     def remove_profile(self, prof_name):
         if prof_name in self.profiles:
@@ -1729,6 +1792,7 @@ class ProfileManager:
             profiles = dict(self.profiles)
             del profiles[prof_name]
             self.profiles = profiles
+            self.mesh_cache.pop(prof_name, None)
             self.bedmesh.update_status()
             self.gcode.respond_info(
                 "Profile [%s] removed from storage for this session.\n"
@@ -3,7 +3,8 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, struct
+import logging, threading, struct, array, sys
+import util
 
 # This "bulk sensor" module facilitates the processing of sensor chip
 # measurements that do not require the host to respond with low
@@ -200,15 +201,56 @@ class ClockSyncRegression:
 
 MAX_BULK_MSG_SIZE = 51
 
+# Decode a buffer of fixed size samples into one sequence per field
+class SampleDecoder:
+    # struct format code to (numpy type, array module type code)
+    FIELD_TYPES = {'b': ('i1', 'b'), 'B': ('u1', 'B'), 'h': ('i2', 'h'),
+                   'H': ('u2', 'H'), 'i': ('i4', 'i'), 'I': ('u4', 'I')}
+    def __init__(self, unpack_fmt):
+        self.unpack = struct.Struct(unpack_fmt)
+        byteorder, codes = '@', unpack_fmt
+        if unpack_fmt[:1] in '@=<>!':
+            byteorder, codes = unpack_fmt[:1], unpack_fmt[1:]
+        self.field_count = len(self.unpack.unpack(b'\0' * self.unpack.size))
+        self.np_dtype = self.array_code = None
+        if (len(codes) != self.field_count
+                or any([c not in self.FIELD_TYPES for c in codes])):
+            # Unsupported format, decode with struct
+            return
+        np_order = {'<': '<', '>': '>', '!': '>'}.get(byteorder, '=')
+        np = util.load_numpy()
+        if np is not None:
+            self.np_dtype = np.dtype([
+                ('f%d' % (i,), np_order + self.FIELD_TYPES[c][0])
+                for i, c in enumerate(codes)])
+        elif len(set(codes)) == 1:
+            code = self.FIELD_TYPES[codes[0]][1]
+            if array.array(code).itemsize == struct.calcsize('=' + codes[0]):
+                self.array_code = code
+                native = {'little': '<', 'big': '>'}[sys.byteorder]
+                self.array_swap = np_order not in ('=', native)
+    def decode(self, data):
+        if self.np_dtype is not None:
+            samples = util.load_numpy().frombuffer(data, dtype=self.np_dtype)
+            return [samples[name] for name in self.np_dtype.names]
+        if self.array_code is not None:
+            samples = array.array(self.array_code)
+            samples.frombytes(data)
+            if self.array_swap:
+                samples.byteswap()
+            count = self.field_count
+            return [samples[i::count] for i in range(count)]
+        fields = list(zip(*self.unpack.iter_unpack(data)))
+        return fields or [()] * self.field_count
+
 # Read sensor_bulk_data and calculate timestamps for devices that take
 # samples at a fixed frequency (and produce fixed data size samples).
 class FixedFreqReader:
     def __init__(self, mcu, chip_clock_smooth, unpack_fmt):
         self.mcu = mcu
         self.clock_sync = ClockSyncRegression(mcu, chip_clock_smooth)
-        unpack = struct.Struct(unpack_fmt)
-        self.unpack_from = unpack.unpack_from
-        self.bytes_per_sample = unpack.size
+        self.decoder = SampleDecoder(unpack_fmt)
+        self.bytes_per_sample = self.decoder.unpack.size
         self.samples_per_block = MAX_BULK_MSG_SIZE // self.bytes_per_sample
         self.last_sequence = self.max_query_duration = 0
         self.last_overflows = 0
@@ -264,34 +306,54 @@ class FixedFreqReader:
             self.clock_sync.reset(avg_mcu_clock, chip_clock)
         else:
             self.clock_sync.update(avg_mcu_clock, chip_clock)
-    # Convert sensor_bulk_data responses into list of samples
-    def pull_samples(self):
+    # Convert sensor_bulk_data responses into a vector of sample times
+    # and a vector of values for each sample field
+    def pull_sample_columns(self):
         # Query MCU for sample timing and update clock synchronization
         self._update_clock()
         # Pull sensor_bulk_data messages from local queue
         raw_samples = self.bulk_queue.pull_queue()
         if not raw_samples:
-            return []
-        # Load variables to optimize inner loop below
+            return [], []
         last_sequence = self.last_sequence
         time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
-        unpack_from = self.unpack_from
         bytes_per_sample = self.bytes_per_sample
         samples_per_block = self.samples_per_block
-        # Process every message in raw_samples
-        count = seq = 0
-        samples = [None] * (len(raw_samples) * samples_per_block)
+        # Find the chip clock of the first sample in every message
+        datas = []
+        msg_cdiffs = []
+        counts = []
         for params in raw_samples:
             seq_diff = (params['sequence'] - last_sequence) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence + seq_diff
-            msg_cdiff = seq * samples_per_block - chip_base
             data = params['data']
-            for i in range(len(data) // bytes_per_sample):
-                ptime = time_base + (msg_cdiff + i) * inv_freq
-                udata = unpack_from(data, i * bytes_per_sample)
-                samples[count] = (ptime,) + udata
-                count += 1
-        self.clock_sync.set_last_chip_clock(seq * samples_per_block + i)
-        del samples[count:]
-        return samples
+            count = len(data) // bytes_per_sample
+            datas.append(data[:count * bytes_per_sample])
+            msg_cdiffs.append(seq * samples_per_block - chip_base)
+            counts.append(count)
+        self.clock_sync.set_last_chip_clock(seq * samples_per_block + count - 1)
+        # Decode all samples and calculate their times in one pass
+        columns = self.decoder.decode(b"".join(datas))
+        np = util.load_numpy()
+        if np is not None:
+            counts = np.array(counts)
+            starts = np.cumsum(counts) - counts
+            index = np.arange(counts.sum()) - np.repeat(starts, counts)
+            cdiffs = np.repeat(np.array(msg_cdiffs), counts) + index
+            times = time_base + cdiffs * inv_freq
+        else:
+            times = []
+            for msg_cdiff, count in zip(msg_cdiffs, counts):
+                times.extend([time_base + (msg_cdiff + i) * inv_freq
+                              for i in range(count)])
+        return times, columns
+    # Convert sensor_bulk_data responses into list of samples
+    def pull_samples(self):
+        times, columns = self.pull_sample_columns()
+        if not len(times):
+            return []
+        if util.load_numpy() is not None:
+            times = times.tolist()
+            columns = [c.tolist() for c in columns]
+        return list(zip(times, *columns))
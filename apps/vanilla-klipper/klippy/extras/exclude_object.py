@@ -6,7 +6,92 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
 import logging
-import json
+import json, math
+
+# Maximum number of grid cells per axis in the object index
+MAX_INDEX_CELLS = 64
+
+# Uniform grid over the EXCLUDE_OBJECT_DEFINE polygons, for finding the
+# object at a given XY position
+class ObjectIndex:
+    def __init__(self, objects):
+        self.polygons = []
+        for obj in objects:
+            polygon = self._parse_polygon(obj.get('polygon'))
+            if polygon is not None:
+                xs = [p[0] for p in polygon]
+                ys = [p[1] for p in polygon]
+                bbox = (min(xs), min(ys), max(xs), max(ys))
+                self.polygons.append((obj['name'], polygon, bbox))
+        self.cells = []
+        if not self.polygons:
+            return
+        self.min_x = min([b[0] for n, p, b in self.polygons])
+        self.min_y = min([b[1] for n, p, b in self.polygons])
+        max_x = max([b[2] for n, p, b in self.polygons])
+        max_y = max([b[3] for n, p, b in self.polygons])
+        # Aim for a couple of cells per object along each axis
+        count = min(MAX_INDEX_CELLS,
+                    int(math.ceil(2. * math.sqrt(len(self.polygons)))))
+        self.x_count = self.y_count = count
+        self.cell_x = max((max_x - self.min_x) / count, 1e-6)
+        self.cell_y = max((max_y - self.min_y) / count, 1e-6)
+        self.cells = [[] for i in range(count * count)]
+        for idx, (name, polygon, bbox) in enumerate(self.polygons):
+            x0, y0 = self._get_cell(bbox[0], bbox[1])
+            x1, y1 = self._get_cell(bbox[2], bbox[3])
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    self.cells[y * count + x].append(idx)
+
+    def _parse_polygon(self, polygon):
+        try:
+            polygon = [(float(p[0]), float(p[1])) for p in polygon]
+        except (TypeError, ValueError, IndexError):
+            return None
+        if len(polygon) < 3:
+            return None
+        return polygon
+
+    def _get_cell(self, x, y):
+        cx = int((x - self.min_x) / self.cell_x)
+        cy = int((y - self.min_y) / self.cell_y)
+        return (min(max(cx, 0), self.x_count - 1),
+                min(max(cy, 0), self.y_count - 1))
+
+    def has_polygons(self):
+        return bool(self.polygons)
+
+    def lookup(self, x, y):
+        # Returns the names of all objects containing the point, as
+        # object polygons may overlap
+        if not self.cells:
+            return []
+        cx = (x - self.min_x) / self.cell_x
+        cy = (y - self.min_y) / self.cell_y
+        if cx < 0. or cy < 0.:
+            return []
+        cx = min(int(cx), self.x_count - 1)
+        cy = min(int(cy), self.y_count - 1)
+        names = []
+        for idx in self.cells[cy * self.x_count + cx]:
+            name, polygon, bbox = self.polygons[idx]
+            if x < bbox[0] or x > bbox[2] or y < bbox[1] or y > bbox[3]:
+                continue
+            if self._point_in_polygon(x, y, polygon):
+                names.append(name)
+        return names
+
+    def _point_in_polygon(self, x, y, polygon):
+        # Even-odd ray casting
+        inside = False
+        px, py = polygon[-1]
+        for nx, ny in polygon:
+            if (ny > y) != (py > y):
+                if x < (px - nx) * (y - ny) / (py - ny) + nx:
+                    inside = not inside
+            px, py = nx, ny
+        return inside
 
 class ExcludeObject:
     def __init__(self, config):
@@ -77,6 +162,13 @@ class ExcludeObject:
         self.excluded_objects = []
         self.current_object = None
         self.in_excluded_region = False
+        self.object_index = None
+        self.has_object_markers = False
+
+    def _get_object_index(self):
+        if self.object_index is None:
+            self.object_index = ObjectIndex(self.objects)
+        return self.object_index
 
     def _reset_file(self):
         self._reset_state()
@@ -164,21 +256,46 @@ class ExcludeObject:
             - (self.max_position_extruded - self.last_position_extruded[3])
         self._normal_move(newpos, speed)
 
-    def _test_in_excluded_region(self):
+    def _test_in_excluded_region(self, newpos=None):
+        if (newpos is not None and not self.has_object_markers
+            and self.excluded_objects):
+            # No EXCLUDE_OBJECT_START markers in the file - use the
+            # defined objects the move ends in.  Only skip the move if
+            # all of them are excluded, as the move may belong to any of
+            # the overlapping objects
+            names = self._get_object_index().lookup(newpos[0], newpos[1])
+            in_excluded = bool(names) and all(
+                [name in self.excluded_objects for name in names])
+        else:
+            in_excluded = self.current_object in self.excluded_objects
         # Inside cancelled object
-        return self.current_object in self.excluded_objects \
-            and self.initial_extrusion_moves == 0
+        return in_excluded and self.initial_extrusion_moves == 0
+
+    def _get_objects_by_position(self):
+        index = self._get_object_index()
+        if not index.has_polygons():
+            return []
+        pos = self.toolhead.get_position()
+        return index.lookup(pos[0], pos[1])
 
     def get_status(self, eventtime=None):
+        objects_by_position = self._get_objects_by_position()
+        # The object under the toolhead is only known when exactly one
+        # defined object contains the position
+        current_object_by_position = None
+        if len(objects_by_position) == 1:
+            current_object_by_position = objects_by_position[0]
         status = {
             "objects": self.objects,
             "excluded_objects": self.excluded_objects,
-            "current_object": self.current_object
+            "current_object": self.current_object,
+            "current_object_by_position": current_object_by_position,
+            "objects_by_position": objects_by_position
         }
         return status
 
     def move(self, newpos, speed):
-        move_in_excluded_region = self._test_in_excluded_region()
+        move_in_excluded_region = self._test_in_excluded_region(newpos)
         self.last_speed = speed
 
         if move_in_excluded_region:
@@ -199,6 +316,7 @@ class ExcludeObject:
         if not any(obj["name"] == name for obj in self.objects):
             self._add_object_definition({"name": name})
         self.current_object = name
+        self.has_object_markers = True
         self.was_excluded_at_start = self._test_in_excluded_region()
 
     cmd_EXCLUDE_OBJECT_END_help = "Marks the end the current object"
@@ -273,6 +391,7 @@ class ExcludeObject:
     def _add_object_definition(self, definition):
         self.objects = sorted(self.objects + [definition],
                               key=lambda o: o["name"])
+        self.object_index = None
 
     def _exclude_object(self, name):
         self._register_transform()
@@ -0,0 +1,239 @@
+# Precomputed index of layer, object, and Z offsets in a g-code file
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, struct, bisect, logging
+
+# Sidecar file format (all little endian):
+#   header: magic, version, source size, source mtime, counts
+#   layers: u64 offset per layer start
+#   z changes: u64 offset, f32 z
+#   object names: u16 length, utf-8 name
+#   object events: u64 offset, u16 name index, u8 is_start
+INDEX_MAGIC = b'KGIX'
+INDEX_VERSION = 3
+HEADER_FORMAT = '<4sHQdIIII'
+LAYER_FORMAT = '<Q'
+ZCHANGE_FORMAT = '<Qf'
+OBJECT_EVENT_FORMAT = '<QHB'
+
+class GCodeIndex:
+    def __init__(self, source_size=0, source_mtime=0.):
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self.layer_offsets = []
+        self.z_offsets = []
+        self.z_values = []
+        self.object_names = []
+        # List of (offset, name index, is_start)
+        self.object_events = []
+    def get_layer_count(self):
+        return len(self.layer_offsets)
+    def get_layer(self, file_position):
+        # Number of layers started at or before the file position
+        return bisect.bisect_right(self.layer_offsets, file_position)
+    def get_layer_offset(self, layer):
+        if layer < 1 or layer > len(self.layer_offsets):
+            return None
+        return self.layer_offsets[layer - 1]
+    def get_z(self, file_position):
+        # Last absolute Z move at or before the file position
+        i = bisect.bisect_right(self.z_offsets, file_position)
+        if not i:
+            return None
+        return self.z_values[i - 1]
+    def get_object_ranges(self):
+        # Returns {name: [[start, end], ...]} byte ranges of each object
+        ranges = {}
+        open_starts = {}
+        for offset, name_idx, is_start in self.object_events:
+            name = self.object_names[name_idx]
+            if is_start:
+                open_starts[name] = offset
+            elif name in open_starts:
+                ranges.setdefault(name, []).append(
+                    [open_starts.pop(name), offset])
+        return ranges
+    def is_current(self, source_size, source_mtime):
+        return (self.source_size == source_size
+                and self.source_mtime == source_mtime)
+    # Building the index
+    @classmethod
+    def build(cls, filename):
+        st = os.stat(filename)
+        index = cls(st.st_size, st.st_mtime)
+        layer_markers = {b'SET_PRINT_STATS_INFO': [], b';LAYER_CHANGE': [],
+                         b';LAYER:': []}
+        name_ids = {}
+        last_z = None
+        absolute = True
+        pos = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                offset = pos
+                pos += len(line)
+                line = line.lstrip()
+                if not line:
+                    continue
+                c = line[:1]
+                if c == b';':
+                    for marker in (b';LAYER_CHANGE', b';LAYER:'):
+                        if line.startswith(marker):
+                            layer_markers[marker].append(offset)
+                    continue
+                if c in b'Mm':
+                    # M codes are not indexed
+                    continue
+                cpos = line.find(b';')
+                if cpos >= 0:
+                    line = line[:cpos]
+                uline = line.upper()
+                if c in b'Gg':
+                    parts = uline.split()
+                    cmd = parts[0]
+                    if cmd in (b'G1', b'G0'):
+                        if not absolute:
+                            continue
+                        for part in parts[1:]:
+                            if part[:1] == b'Z':
+                                try:
+                                    z = float(part[1:])
+                                except ValueError:
+                                    break
+                                if z != last_z:
+                                    last_z = z
+                                    index.z_offsets.append(offset)
+                                    index.z_values.append(z)
+                                break
+                    elif cmd == b'G90':
+                        absolute = True
+                    elif cmd == b'G91':
+                        absolute = False
+                elif uline.startswith(b'EXCLUDE_OBJECT_'):
+                    is_start = uline.startswith(b'EXCLUDE_OBJECT_START')
+                    if not is_start and not uline.startswith(
+                            b'EXCLUDE_OBJECT_END'):
+                        continue
+                    name = cls._get_param(uline, b'NAME=')
+                    if name is None:
+                        continue
+                    if name not in name_ids:
+                        name_ids[name] = len(index.object_names)
+                        index.object_names.append(name.decode(
+                            errors='replace'))
+                    index.object_events.append(
+                        (offset, name_ids[name], int(is_start)))
+                elif (uline.startswith(b'SET_PRINT_STATS_INFO')
+                      and b'CURRENT_LAYER=' in uline):
+                    layer_markers[b'SET_PRINT_STATS_INFO'].append(offset)
+        # Slicers often emit more than one kind of layer marker, so use the
+        # one print_stats reports, then the most common slicer comments
+        for marker in (b'SET_PRINT_STATS_INFO', b';LAYER_CHANGE',
+                       b';LAYER:'):
+            if layer_markers[marker]:
+                index.layer_offsets = layer_markers[marker]
+                break
+        return index
+    @staticmethod
+    def _get_param(uline, key):
+        i = uline.find(key)
+        if i < 0:
+            return None
+        value = uline[i + len(key):].split()
+        if not value:
+            return None
+        return value[0].strip(b'"\'')
+    # Sidecar file
+    @staticmethod
+    def get_sidecar_filename(filename):
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, '.' + basename + '.index')
+    def save(self, filename):
+        names = [n.encode() for n in self.object_names]
+        data = [struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION,
+                            self.source_size, self.source_mtime,
+                            len(self.layer_offsets), len(self.z_offsets),
+                            len(names), len(self.object_events))]
+        data.extend([struct.pack(LAYER_FORMAT, o)
+                     for o in self.layer_offsets])
+        data.extend([struct.pack(ZCHANGE_FORMAT, o, z)
+                     for o, z in zip(self.z_offsets, self.z_values)])
+        data.extend([struct.pack('<H', len(n)) + n for n in names])
+        data.extend([struct.pack(OBJECT_EVENT_FORMAT, *e)
+                     for e in self.object_events])
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(b''.join(data))
+        os.rename(tmpname, filename)
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        pos = struct.calcsize(HEADER_FORMAT)
+        (magic, version, source_size, source_mtime, layer_count, z_count,
+         name_count, event_count) = struct.unpack_from(HEADER_FORMAT, data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Unknown gcode index format")
+        index = cls(source_size, source_mtime)
+        index.layer_offsets = [o for o, in struct.iter_unpack(
+            LAYER_FORMAT, data[pos:pos + layer_count * 8])]
+        pos += layer_count * 8
+        size = struct.calcsize(ZCHANGE_FORMAT)
+        zchanges = struct.iter_unpack(ZCHANGE_FORMAT,
+                                      data[pos:pos + z_count * size])
+        for o, z in zchanges:
+            index.z_offsets.append(o)
+            index.z_values.append(round(z, 6))
+        pos += z_count * size
+        for i in range(name_count):
+            length, = struct.unpack_from('<H', data, pos)
+            pos += 2
+            index.object_names.append(
+                data[pos:pos + length].decode(errors='replace'))
+            pos += length
+        size = struct.calcsize(OBJECT_EVENT_FORMAT)
+        index.object_events = list(struct.iter_unpack(
+            OBJECT_EVENT_FORMAT, data[pos:pos + event_count * size]))
+        return index
+
+# Remove sidecars (and partial writes) left behind by g-code files that
+# have since been deleted or renamed
+def remove_stale_sidecars(dirname):
+    try:
+        names = set(os.listdir(dirname))
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith('.'):
+            continue
+        if name.endswith('.index.tmp'):
+            source = None
+        elif name.endswith('.index'):
+            source = name[1:-len('.index')]
+        else:
+            continue
+        if source in names:
+            continue
+        try:
+            os.remove(os.path.join(dirname, name))
+        except OSError:
+            logging.info("Unable to remove gcode index %s", name)
+
+# Load the index for a file from its sidecar, or build (and save) it
+def load_or_build(filename):
+    st = os.stat(filename)
+    sidecar = GCodeIndex.get_sidecar_filename(filename)
+    try:
+        index = GCodeIndex.load(sidecar)
+        if index.is_current(st.st_size, st.st_mtime):
+            return index
+    except (IOError, OSError, ValueError, struct.error):
+        pass
+    # The sidecar is missing or out of date, so the directory has changed
+    # since the last build; the outdated sidecar is replaced by the save
+    remove_stale_sidecars(os.path.dirname(filename))
+    index = GCodeIndex.build(filename)
+    try:
+        index.save(sidecar)
+    except (IOError, OSError):
+        logging.info("Unable to write gcode index %s", sidecar)
+    return index
@@ -17,16 +17,49 @@ class GetStatusWrapper:
         self.printer = printer
         self.eventtime = eventtime
         self.cache = {}
+        # Status of objects a template reads only parts of
+        self.raw_status = {}
+        self.partial_cache = {}
+        self.status_refs = None
+    def _get_status(self, sval, val):
+        status = self.raw_status.get(sval)
+        if status is None:
+            po = self.printer.lookup_object(sval, None)
+            if po is None or not hasattr(po, 'get_status'):
+                raise KeyError(val)
+            if self.eventtime is None:
+                self.eventtime = self.printer.get_reactor().monotonic()
+            self.raw_status[sval] = status = po.get_status(self.eventtime)
+        return status
+    def _copy_fields(self, status, fields):
+        res = {}
+        for field, subfields in fields.items():
+            if field not in status:
+                continue
+            val = status[field]
+            if subfields is not None and type(val) is dict:
+                res[field] = self._copy_fields(val, subfields)
+            else:
+                res[field] = copy.deepcopy(val)
+        return res
     def __getitem__(self, val):
         sval = str(val).strip()
         if sval in self.cache:
             return self.cache[sval]
-        po = self.printer.lookup_object(sval, None)
-        if po is None or not hasattr(po, 'get_status'):
-            raise KeyError(val)
-        if self.eventtime is None:
-            self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        fields = None
+        if self.status_refs is not None:
+            fields = self.status_refs.get(sval)
+        if fields is not None:
+            # Only copy the parts of the status the template reads
+            key = (sval, id(fields))
+            res = self.partial_cache.get(key)
+            if res is None:
+                status = self._get_status(sval, val)
+                self.partial_cache[key] = res = self._copy_fields(
+                    status, fields)
+            return res
+        status = self._get_status(sval, val)
+        self.cache[sval] = res = copy.deepcopy(status)
         return res
     def __contains__(self, val):
         try:
@@ -39,6 +72,54 @@ class GetStatusWrapper:
             if self.__contains__(name):
                 yield name
 
+def _get_const_key(node):
+    if isinstance(node, jinja2.nodes.Getattr):
+        key = node.attr
+    elif (isinstance(node.arg, jinja2.nodes.Const)
+          and isinstance(node.arg.value, str)):
+        key = node.arg.value
+    else:
+        return None
+    if hasattr(dict, key):
+        # Jinja may resolve this to a dict method
+        return None
+    return key
+
+# Determine the parts of the printer status a template reads.  Returns
+# {object: {field: {subfield: ...}}}, where None marks a value that is
+# used as a whole, or returns None if the template uses "printer" other
+# than through printer.<object> lookups.
+def analyze_status_refs(ast):
+    names = [n for n in ast.find_all(jinja2.nodes.Name)
+             if n.name == 'printer']
+    if [n for n in names if n.ctx != 'load']:
+        return None
+    parents = {}
+    for node in ast.find_all((jinja2.nodes.Getattr, jinja2.nodes.Getitem)):
+        parents[id(node.node)] = node
+    refs = {}
+    for name in names:
+        # Follow the chain of constant lookups starting at "printer"
+        path = []
+        node = parents.get(id(name))
+        while node is not None:
+            key = _get_const_key(node)
+            if key is None:
+                break
+            path.append(key.strip() if not path else key)
+            node = parents.get(id(node))
+        if not path:
+            return None
+        # Merge the path into the tree of referenced fields
+        tree = refs
+        for key in path[:-1]:
+            if key in tree and tree[key] is None:
+                break
+            tree = tree.setdefault(key, {})
+        else:
+            tree[path[-1]] = None
+    return refs
+
 # Wrapper around a Jinja2 template
 class TemplateWrapper:
     def __init__(self, printer, env, name, script):
@@ -48,7 +129,9 @@ class TemplateWrapper:
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
         try:
-            self.template = env.from_string(script)
+            ast = env.parse(script)
+            self.status_refs = analyze_status_refs(ast)
+            self.template = env.from_string(ast)
         except jinja2.exceptions.TemplateSyntaxError as e:
             lines = script.splitlines()
             msg = "Error loading template '%s'\nline %s: %s # %s" % (
@@ -63,6 +146,13 @@ class TemplateWrapper:
     def render(self, context=None):
         if context is None:
             context = self.create_template_context()
+        # Templates may be rendered from within other templates
+        status = context.get('printer')
+        if isinstance(status, GetStatusWrapper):
+            prev_refs = status.status_refs
+            status.status_refs = self.status_refs
+        else:
+            status = prev_refs = None
         try:
             return str(self.template.render(context))
         except Exception as e:
@@ -70,6 +160,9 @@ class TemplateWrapper:
                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise self.gcode.error(msg)
+        finally:
+            if status is not None:
+                status.status_refs = prev_refs
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
 
@@ -3,7 +3,8 @@
 # Copyright (C) 2020-2024  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing, traceback
+import collections, importlib, logging, math, multiprocessing, time
+import traceback
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
 MIN_FREQ = 5.
@@ -15,6 +16,24 @@ TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 
 AUTOTUNE_SHAPERS = ['zv', 'mzv', 'ei', '2hump_ei', '3hump_ei']
 
+# Number of test frequencies evaluated together, limits the memory used
+FIT_FREQ_CHUNK = 128
+# Peak memory of a shaper fit: the float64 temporaries of one chunk (each
+# FIT_FREQ_CHUNK x freq bins x impulses) plus the process overhead
+FIT_CHUNK_ARRAYS = 6
+FIT_PROC_OVERHEAD = 32 * 1024 * 1024
+
+def get_available_memory():
+    # Memory available for new processes in bytes, or None if unknown
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
 ######################################################################
 # Frequency response calculation and shaper auto-tuning
 ######################################################################
@@ -74,10 +93,15 @@ class ShaperCalibrate:
     def background_process_exec(self, method, args):
         if self.printer is None:
             return method(*args)
-        import queuelogger
+        return self.background_process_map(method, [args])[0]
+
+    def _start_process(self, method, args):
         parent_conn, child_conn = multiprocessing.Pipe()
+        is_bg = self.printer is not None
         def wrapper():
-            queuelogger.clear_bg_logging()
+            if is_bg:
+                import queuelogger
+                queuelogger.clear_bg_logging()
             try:
                 res = method(*args)
             except:
@@ -90,22 +114,55 @@ class ShaperCalibrate:
         calc_proc = multiprocessing.Process(target=wrapper)
         calc_proc.daemon = True
         calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        return calc_proc, parent_conn
+
+    def background_process_map(self, method, args_list, max_procs=None):
+        # Run method for each entry of args_list in background processes,
+        # running up to one process per cpu core (or max_procs) at once
+        max_procs = min(max_procs or multiprocessing.cpu_count(),
+                        multiprocessing.cpu_count(), len(args_list))
+        max_procs = max(1, max_procs)
+        results = [None] * len(args_list)
+        pending = list(enumerate(args_list))
+        running = []
+        if self.printer is not None:
+            reactor = self.printer.get_reactor()
+            gcode = self.printer.lookup_object("gcode")
+            eventtime = last_report_time = reactor.monotonic()
+        try:
+            while pending or running:
+                while pending and len(running) < max_procs:
+                    idx, args = pending.pop(0)
+                    running.append((idx,) + self._start_process(method, args))
+                # Wait for a process to finish
+                if self.printer is not None:
+                    if eventtime > last_report_time + 5.:
+                        last_report_time = eventtime
+                        gcode.respond_info("Wait for calculations..",
+                                           log=False)
+                    eventtime = reactor.pause(eventtime + .1)
+                else:
+                    time.sleep(.01)
+                for entry in list(running):
+                    idx, calc_proc, parent_conn = entry
+                    if not parent_conn.poll():
+                        if calc_proc.is_alive():
+                            continue
+                        raise self.error("Remote calculation exited")
+                    # Return results
+                    is_err, res = parent_conn.recv()
+                    if is_err:
+                        raise self.error(
+                            "Error in remote calculation: %s" % (res,))
+                    calc_proc.join()
+                    parent_conn.close()
+                    running.remove(entry)
+                    results[idx] = res
+        finally:
+            for idx, calc_proc, parent_conn in running:
+                calc_proc.terminate()
+                parent_conn.close()
+        return results
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -183,51 +240,83 @@ class ShaperCalibrate:
         calibration_data.set_numpy(self.numpy)
         return calibration_data
 
-    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+    def _get_shaper_arrays(self, shaper_cfg, test_freqs, damping_ratio):
+        # Impulse amplitudes and times, one row per test frequency
         np = self.numpy
-
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
+        shapers = [shaper_cfg.init_func(test_freq, damping_ratio)
+                   for test_freq in test_freqs]
+        A = np.array([shaper[0] for shaper in shapers])
+        T = np.array([shaper[1] for shaper in shapers])
+        return A, T
+
+    def _estimate_shapers(self, A, T, test_damping_ratio, test_freqs):
+        # Shaper response at test_freqs for the shapers in each row of A, T
+        np = self.numpy
+        inv_D = 1. / A.sum(axis=1)
 
         omega = 2. * math.pi * test_freqs
         damping = test_damping_ratio * omega
         omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
-
-    def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
-                                       freq_bins, psd):
-        vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
-        # The input shaper can only reduce the amplitude of vibrations by
-        # SHAPER_VIBRATION_REDUCTION times, so all vibrations below that
-        # threshold can be igonred
-        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
-        remaining_vibrations = self.numpy.maximum(
-                vals * psd - vibr_threshold, 0).sum()
-        all_vibrations = self.numpy.maximum(psd - vibr_threshold, 0).sum()
-        return (remaining_vibrations / all_vibrations, vals)
+        W = A[:,None,:] * np.exp(-damping[None,:,None]
+                                 * (T[:,-1:] - T)[:,None,:])
+        S = W * np.sin(omega_d[None,:,None] * T[:,None,:])
+        C = W * np.cos(omega_d[None,:,None] * T[:,None,:])
+        return (np.sqrt(S.sum(axis=2)**2 + C.sum(axis=2)**2)
+                * inv_D[:,None])
+
+    def _get_shapers_smoothing_coeffs(self, A, T, scv):
+        # Smoothing of each shaper, returned as the coefficients of
+        # offset_90 = c90 + k90 * accel and offset_180 = k180 * accel
+        inv_D = 1. / A.sum(axis=1)
+        ts = (A * T).sum(axis=1) * inv_D
+        dt = T - ts[:,None]
+        turn = T >= ts[:,None]
+        c90 = (A * scv * dt * turn).sum(axis=1) * inv_D * math.sqrt(2.)
+        k90 = (A * .5 * dt**2 * turn).sum(axis=1) * inv_D * math.sqrt(2.)
+        k180 = (A * .5 * dt**2).sum(axis=1) * inv_D
+        return c90, k90, k180
+
+    def _find_shapers_max_accel(self, c90, k90, k180):
+        # Highest accel with smoothing within the target.  Smoothing grows
+        # linearly with accel, so it can be calculated directly.  The target
+        # is just some empirically chosen value which produces good
+        # projections for max_accel without much smoothing
+        np = self.numpy
+        TARGET_SMOOTHING = 0.12
+        max_accel = np.minimum((TARGET_SMOOTHING - c90) / k90,
+                               TARGET_SMOOTHING / k180)
+        return np.where(c90 + k90 * 1e-9 <= TARGET_SMOOTHING, max_accel, 0.)
+
+    # Single shaper versions of the above, kept for external scripts
+    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+        np = self.numpy
+        A, T = np.array([shaper[0]]), np.array([shaper[1]])
+        return self._estimate_shapers(A, T, test_damping_ratio,
+                                      np.asarray(test_freqs))[0]
 
     def _get_shaper_smoothing(self, shaper, accel=5000, scv=5.):
-        half_accel = accel * .5
-
-        A, T = shaper
-        inv_D = 1. / sum(A)
-        n = len(T)
-        # Calculate input shaper shift
-        ts = sum([A[i] * T[i] for i in range(n)]) * inv_D
-
-        # Calculate offset for 90 and 180 degrees turn
-        offset_90 = offset_180 = 0.
-        for i in range(n):
-            if T[i] >= ts:
-                # Calculate offset for one of the axes
-                offset_90 += A[i] * (scv + half_accel * (T[i]-ts)) * (T[i]-ts)
-            offset_180 += A[i] * half_accel * (T[i]-ts)**2
-        offset_90 *= inv_D * math.sqrt(2.)
-        offset_180 *= inv_D
-        return max(offset_90, offset_180)
+        np = self.numpy
+        A, T = np.array([shaper[0]]), np.array([shaper[1]])
+        c90, k90, k180 = self._get_shapers_smoothing_coeffs(A, T, scv)
+        return max(float(c90[0] + k90[0] * accel), float(k180[0] * accel))
+
+    def find_shaper_max_accel(self, shaper, scv):
+        np = self.numpy
+        A, T = np.array([shaper[0]]), np.array([shaper[1]])
+        c90, k90, k180 = self._get_shapers_smoothing_coeffs(A, T, scv)
+        return float(self._find_shapers_max_accel(c90, k90, k180)[0])
+
+    def _get_max_fit_procs(self, calibration_data, shaper_cfgs):
+        # Limit the number of fits run at once to the available memory
+        mem_avail = get_available_memory()
+        if mem_avail is None:
+            return None
+        max_impulses = max([len(shaper_cfg.init_func(
+            MAX_SHAPER_FREQ, shaper_defs.DEFAULT_DAMPING_RATIO)[0])
+                            for shaper_cfg in shaper_cfgs])
+        fit_mem = (FIT_FREQ_CHUNK * len(calibration_data.freq_bins)
+                   * max_impulses * 8 * FIT_CHUNK_ARRAYS + FIT_PROC_OVERHEAD)
+        return max(1, mem_avail // fit_mem)
 
     def fit_shaper(self, shaper_cfg, calibration_data, shaper_freqs,
                    damping_ratio, scv, max_smoothing, test_damping_ratios,
@@ -254,37 +343,58 @@ class ShaperCalibrate:
         psd = calibration_data.psd_sum[freq_bins <= max_freq]
         freq_bins = freq_bins[freq_bins <= max_freq]
 
-        best_res = None
-        results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, damping_ratio)
-            shaper_smoothing = self._get_shaper_smoothing(shaper, scv=scv)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
+        # Evaluate all test frequencies at once, from the highest one
+        test_freqs = test_freqs[::-1]
+        A, T = self._get_shaper_arrays(shaper_cfg, test_freqs, damping_ratio)
+        c90, k90, k180 = self._get_shapers_smoothing_coeffs(A, T, scv)
+        smoothing = np.maximum(c90 + k90 * 5000., k180 * 5000.)
+        count = len(test_freqs)
+        stopped = False
+        if max_smoothing:
+            # Stop at the first frequency (after the highest) with too much
+            # smoothing, lower frequencies only increase it
+            over = np.nonzero(smoothing[1:] > max_smoothing)[0]
+            if len(over):
+                count = over[0] + 1
+                stopped = True
+        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+        shaper_vibrations = np.zeros(shape=(count,))
+        shaper_vals = np.zeros(shape=(count, freq_bins.shape[0]))
+        for start in range(0, count, FIT_FREQ_CHUNK):
+            end = min(start + FIT_FREQ_CHUNK, count)
             # Exact damping ratio of the printer is unknown, pessimizing
             # remaining vibrations over possible damping values
             for dr in test_damping_ratios:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper, scv)
-            # The score trying to minimize vibrations, but also accounting
-            # the growth of smoothing. The formula itself does not have any
-            # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
-                                               shaper_vibrations * .2 + .01)
-            results.append(
-                    CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
-                # The current frequency is better for the shaper.
-                best_res = results[-1]
+                vals = self._estimate_shapers(A[start:end], T[start:end],
+                                              dr, freq_bins)
+                remaining_vibrations = np.maximum(
+                        vals * psd - vibr_threshold, 0).sum(axis=1)
+                shaper_vibrations[start:end] = np.maximum(
+                        shaper_vibrations[start:end],
+                        remaining_vibrations / all_vibrations)
+                shaper_vals[start:end] = np.maximum(
+                        shaper_vals[start:end], vals)
+        max_accel = self._find_shapers_max_accel(
+                c90[:count], k90[:count], k180[:count])
+        # The score trying to minimize vibrations, but also accounting
+        # the growth of smoothing. The formula itself does not have any
+        # special meaning, it simply shows good results on real user data
+        smoothing = smoothing[:count]
+        shaper_score = smoothing * (shaper_vibrations**1.5 +
+                                    shaper_vibrations * .2 + .01)
+        results = [CalibrationResult(
+                        name=shaper_cfg.name, freq=freq, vals=vals,
+                        vibrs=vibrs, smoothing=smooth, score=score,
+                        max_accel=accel)
+                   for freq, vals, vibrs, smooth, score, accel in zip(
+                       test_freqs[:count].tolist(), shaper_vals,
+                       shaper_vibrations.tolist(), smoothing.tolist(),
+                       shaper_score.tolist(), max_accel.tolist())]
+        # The first frequency with the least vibrations is the best one
+        best_res = results[int(np.argmin(shaper_vibrations))]
+        if stopped:
+            return best_res
         # Try to find an 'optimal' shapper configuration: the one that is not
         # much worse than the 'best' one, but gives much less smoothing
         selected = best_res
@@ -293,32 +403,6 @@ class ShaperCalibrate:
                 selected = res
         return selected
 
-    def _bisect(self, func):
-        left = right = 1.
-        if not func(1e-9):
-            return 0.
-        while not func(left):
-            right = left
-            left *= .5
-        if right == left:
-            while func(right):
-                right *= 2.
-        while right - left > 1e-8:
-            middle = (left + right) * .5
-            if func(middle):
-                left = middle
-            else:
-                right = middle
-        return left
-
-    def find_shaper_max_accel(self, shaper, scv):
-        # Just some empirically chosen value which produces good projections
-        # for max_accel without much smoothing
-        TARGET_SMOOTHING = 0.12
-        max_accel = self._bisect(lambda test_accel: self._get_shaper_smoothing(
-            shaper, test_accel, scv) <= TARGET_SMOOTHING)
-        return max_accel
-
     def find_best_shaper(self, calibration_data, shapers=None,
                          damping_ratio=None, scv=None, shaper_freqs=None,
                          max_smoothing=None, test_damping_ratios=None,
@@ -326,12 +410,15 @@ class ShaperCalibrate:
         best_shaper = None
         all_shapers = []
         shapers = shapers or AUTOTUNE_SHAPERS
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in shapers:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
-                scv, max_smoothing, test_damping_ratios, max_freq))
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in shapers]
+        # The shaper types are independent, fit them in parallel
+        fitted_shapers = self.background_process_map(self.fit_shaper, [
+            (shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
+             scv, max_smoothing, test_damping_ratios, max_freq)
+            for shaper_cfg in shaper_cfgs],
+            self._get_max_fit_procs(calibration_data, shaper_cfgs))
+        for shaper in fitted_shapers:
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
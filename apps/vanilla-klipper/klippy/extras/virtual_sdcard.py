@@ -3,10 +3,17 @@
 # Copyright (C) 2018-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging, io
+import os, logging, io, multiprocessing
+from . import gcode_index
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+# Size of each read from the gcode file
+READ_BLOCK_SIZE = 64 * 1024
+
+# How often to check for the result of a file index build
+INDEX_CHECK_TIME = 0.250
+
 DEFAULT_ERROR_GCODE = """
 {% if 'heaters' in printer %}
    TURN_OFF_HEATERS
@@ -23,6 +30,11 @@ class VirtualSD:
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        # Optional index of layer, object, and Z offsets in the current file
+        self.index_files = config.getboolean('index_files', False)
+        self.file_index = None
+        self.object_ranges = {}
+        self.index_build = self.index_timer = None
         # Print Stat Tracking
         self.print_stats = self.printer.load_object(config, 'print_stats')
         # Work timer
@@ -46,6 +58,10 @@ class VirtualSD:
         self.gcode.register_command(
             "SDCARD_PRINT_FILE", self.cmd_SDCARD_PRINT_FILE,
             desc=self.cmd_SDCARD_PRINT_FILE_help)
+        if self.index_files:
+            self.gcode.register_command(
+                "SDCARD_SEEK_LAYER", self.cmd_SDCARD_SEEK_LAYER,
+                desc=self.cmd_SDCARD_SEEK_LAYER_help)
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
@@ -90,13 +106,24 @@ class VirtualSD:
                 logging.exception("virtual_sdcard get_file_list")
                 raise self.gcode.error("Unable to get file list")
     def get_status(self, eventtime):
-        return {
+        status = {
             'file_path': self.file_path(),
             'progress': self.progress(),
             'is_active': self.is_active(),
             'file_position': self.file_position,
             'file_size': self.file_size,
         }
+        if self.index_files:
+            layer = layer_count = file_z = None
+            if self.file_index is not None:
+                layer = self.file_index.get_layer(self.file_position)
+                layer_count = self.file_index.get_layer_count()
+                file_z = self.file_index.get_z(self.file_position)
+            status['layer'] = layer
+            status['layer_count'] = layer_count
+            status['file_z'] = file_z
+            status['object_ranges'] = self.object_ranges
+        return status
     def file_path(self):
         if self.current_file:
             return self.current_file.name
@@ -135,6 +162,9 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
         self.file_position = self.file_size = 0
+        self._stop_file_index()
+        self.file_index = None
+        self.object_ranges = {}
         self.print_stats.reset()
         self.printer.send_event("virtual_sdcard:reset_file")
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
@@ -183,7 +213,7 @@ class VirtualSD:
             if fname not in flist:
                 fname = files_by_lower[fname.lower()]
             fname = os.path.join(self.sdcard_dirname, fname)
-            f = io.open(fname, 'r', newline='')
+            f = io.open(fname, 'rb')
             f.seek(0, os.SEEK_END)
             fsize = f.tell()
             f.seek(0)
@@ -196,6 +226,61 @@ class VirtualSD:
         self.file_position = 0
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
+        if self.index_files:
+            self._start_file_index(f)
+    # File index
+    def _start_file_index(self, f):
+        # Load or build the index in a separate process, as building it
+        # requires reading and parsing the entire file
+        self._stop_file_index()
+        parent_conn, child_conn = multiprocessing.Pipe()
+        def build_index():
+            import queuelogger
+            queuelogger.clear_bg_logging()
+            try:
+                index = gcode_index.load_or_build(f.name)
+            except:
+                logging.exception("virtual_sdcard index build")
+                index = None
+            child_conn.send(index)
+            child_conn.close()
+        proc = multiprocessing.Process(target=build_index)
+        proc.daemon = True
+        proc.start()
+        self.index_build = (f, proc, parent_conn)
+        self.index_timer = self.reactor.register_timer(
+            self._check_file_index, self.reactor.NOW)
+    def _stop_file_index(self):
+        if self.index_build is None:
+            return
+        f, proc, parent_conn = self.index_build
+        self.index_build = None
+        self.reactor.unregister_timer(self.index_timer)
+        self.index_timer = None
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+        parent_conn.close()
+    def _check_file_index(self, eventtime):
+        f, proc, parent_conn = self.index_build
+        if not parent_conn.poll():
+            if proc.is_alive():
+                return eventtime + INDEX_CHECK_TIME
+            index = None
+        else:
+            index = parent_conn.recv()
+        self._stop_file_index()
+        if index is not None:
+            self._set_file_index(f, index)
+        return self.reactor.NEVER
+    def _set_file_index(self, f, index):
+        if f is not self.current_file:
+            # File changed while the index was being built
+            return
+        self.file_index = index
+        self.object_ranges = index.get_object_ranges()
+        logging.info("virtual_sdcard index: %d layers, %d objects",
+                     index.get_layer_count(), len(index.object_names))
     def cmd_M24(self, gcmd):
         # Start/resume SD print
         self.do_resume()
@@ -208,6 +293,18 @@ class VirtualSD:
             raise gcmd.error("SD busy")
         pos = gcmd.get_int('S', minval=0)
         self.file_position = pos
+    cmd_SDCARD_SEEK_LAYER_help = "Set the SD position to the start of a layer"
+    def cmd_SDCARD_SEEK_LAYER(self, gcmd):
+        if self.work_timer is not None:
+            raise gcmd.error("SD busy")
+        if self.file_index is None:
+            raise gcmd.error("No index available for the current file")
+        layer = gcmd.get_int('LAYER', minval=1)
+        pos = self.file_index.get_layer_offset(layer)
+        if pos is None:
+            raise gcmd.error("Layer %d not found (file has %d layers)"
+                             % (layer, self.file_index.get_layer_count()))
+        self.file_position = pos
     def cmd_M27(self, gcmd):
         # Report SD print status
         if self.current_file is None:
@@ -222,6 +319,47 @@ class VirtualSD:
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     # Background work timer
+    def _split_lines(self, data):
+        # Split a block of file data into lines (in reverse order so they
+        # can be popped) and return any trailing partial line.  The size
+        # of each line in bytes is only tracked if the block isn't ascii,
+        # otherwise the size is the length of the decoded line.
+        end = data.rfind(b'\n') + 1
+        block = data[:end]
+        if block.isascii():
+            lines = block.decode().split('\n')
+            line_sizes = None
+        else:
+            blines = block.split(b'\n')
+            lines = [l.decode(errors='replace') for l in blines]
+            line_sizes = [len(l) for l in blines]
+            line_sizes.pop()
+            line_sizes.reverse()
+        lines.pop()
+        lines.reverse()
+        return lines, line_sizes, data[end:]
+    def _dispatch_lines(self, lines, line_sizes, gcode_mutex):
+        # Run commands until the block is done, a pause is requested, or
+        # another request is waiting on the gcode mutex.  The caller must
+        # hold the gcode mutex.  Returns True if a command changed the
+        # file position.
+        run_script = self.gcode.run_script_from_command
+        while lines and not self.must_pause_work:
+            line = lines.pop()
+            if line_sizes is None:
+                size = len(line)
+            else:
+                size = line_sizes.pop()
+            next_file_position = self.file_position + size + 1
+            self.next_file_position = next_file_position
+            run_script(line)
+            self.file_position = self.next_file_position
+            # Do we need to skip around?
+            if self.next_file_position != next_file_position:
+                return True
+            if gcode_mutex.has_waiters():
+                break
+        return False
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
@@ -233,14 +371,15 @@ class VirtualSD:
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
+        partial_input = b""
         lines = []
+        line_sizes = None
         error_message = None
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    data = self.current_file.read(READ_BLOCK_SIZE)
                 except:
                     logging.exception("virtual_sdcard read")
                     break
@@ -251,26 +390,20 @@ class VirtualSD:
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
+                lines, line_sizes, partial_input = self._split_lines(
+                    partial_input + data)
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch a run of commands under a single mutex hold
             self.cmd_from_sd = True
-            line = lines.pop()
-            if sys.version_info.major >= 3:
-                next_file_position = self.file_position + len(line.encode()) + 1
-            else:
-                next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
             try:
-                self.gcode.run_script(line)
+                with gcode_mutex:
+                    need_seek = self._dispatch_lines(lines, line_sizes,
+                                                     gcode_mutex)
             except self.gcode.error as e:
                 error_message = str(e)
                 try:
@@ -282,9 +415,7 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position = self.next_file_position
-            # Do we need to skip around?
-            if self.next_file_position != next_file_position:
+            if need_seek:
                 try:
                     self.current_file.seek(self.file_position)
                 except:
@@ -292,7 +423,7 @@ class VirtualSD:
                     self.work_timer = None
                     return self.reactor.NEVER
                 lines = []
-                partial_input = ""
+                partial_input = b""
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
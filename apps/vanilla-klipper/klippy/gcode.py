@@ -188,23 +188,49 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*])')
+    simple_value_chars = '0123456789.-+'
+    def _parse_line(self, line):
+        # Fast path for simple traditional commands (eg, "G1 X10 Y20 E.5")
+        # where every part is a single letter followed by a number.
+        # Anything else (line numbers, checksums, extended commands, or
+        # messages) is handled by the full parser.
+        parts = line.upper().split()
+        if not parts:
+            return '', {}
+        params = {}
+        value_chars = self.simple_value_chars
+        for part in parts:
+            key = part[0]
+            value = part[1:]
+            if (key < 'A' or key > 'Z' or key == 'N'
+                or value.strip(value_chars)):
+                return self._parse_line_full(line)
+            params[key] = value
+        cmd = parts[0]
+        if not cmd[1:2].isdigit():
+            return self._parse_line_full(line)
+        return cmd, params
+    def _parse_line_full(self, line):
+        # Break line into parts and determine command
+        parts = self.args_r.split(line.upper())
+        if ''.join(parts[:2]) == 'N':
+            # Skip line number at start of command
+            cmd = ''.join(parts[3:5]).strip()
+        else:
+            cmd = ''.join(parts[:3]).strip()
+        # Build gcode "params" dictionary
+        params = { parts[i]: parts[i+1].strip()
+                   for i in range(1, len(parts), 2) }
+        return cmd, params
     def _process_commands(self, commands, need_ack=True):
+        parse_line = self._parse_line
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            if ''.join(parts[:2]) == 'N':
-                # Skip line number at start of command
-                cmd = ''.join(parts[3:5]).strip()
-            else:
-                cmd = ''.join(parts[:3]).strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, len(parts), 2) }
+            cmd, params = parse_line(line)
             gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
@@ -159,6 +159,39 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# Build a decoder specialized for the parameters of a message format.
+# Integer parameters (the bulk of all traffic) are decoded inline
+# instead of calling into each parameter type.
+def build_parser(msgid_len, param_names):
+    fields = []
+    for name, t in param_names:
+        if isinstance(t, PT_uint32):
+            fields.append((name, t.signed, None))
+        else:
+            fields.append((name, False, t.parse))
+    fields = tuple(fields)
+    def parse(s, pos):
+        pos += msgid_len
+        out = {}
+        for name, signed, tparse in fields:
+            if tparse is not None:
+                out[name], pos = tparse(s, pos)
+                continue
+            c = s[pos]
+            pos += 1
+            v = c & 0x7f
+            if (c & 0x60) == 0x60:
+                v |= -0x20
+            while c & 0x80:
+                c = s[pos]
+                pos += 1
+                v = (v<<7) | (c & 0x7f)
+            if not signed:
+                v &= 0xffffffff
+            out[name] = v
+        return out, pos
+    return parse
+
 class MessageFormat:
     def __init__(self, msgid_bytes, msgformat, enumerations={}):
         self.msgid_bytes = msgid_bytes
@@ -168,6 +201,7 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        self.parse = build_parser(len(msgid_bytes), self.param_names)
     def encode(self, params):
         out = list(self.msgid_bytes)
         for i, t in enumerate(self.param_types):
@@ -178,13 +212,6 @@ class MessageFormat:
         for name, t in self.param_names:
             t.encode(out, params[name])
         return out
-    def parse(self, s, pos):
-        pos += len(self.msgid_bytes)
-        out = {}
-        for name, t in self.param_names:
-            v, pos = t.parse(s, pos)
-            out[name] = v
-        return out, pos
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -282,7 +309,10 @@ class MessageParser:
             return "%s %s" % (name, msg)
         return str(params)
     def parse(self, s):
-        msgid, param_pos = self.msgid_parser.parse(s, MESSAGE_HEADER_SIZE)
+        msgid = s[MESSAGE_HEADER_SIZE]
+        if msgid >= 0x60:
+            # Not a single byte message id
+            msgid, param_pos = self.msgid_parser.parse(s, MESSAGE_HEADER_SIZE)
         mid = self.messages_by_id.get(msgid, self.unknown)
         params, pos = mid.parse(s, MESSAGE_HEADER_SIZE)
         if pos != len(s)-MESSAGE_TRAILER_SIZE:
@@ -3,20 +3,34 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, logging.handlers, threading, queue, time
+import logging, logging.handlers, threading, collections, time
+
+# Maximum number of records waiting for the background thread (kept
+# small so a stalled disk can't use much of the memory on small hosts)
+MAX_QUEUED_RECORDS = 10000
+
+# Argument types that can't change before the background thread formats
+# the message
+IMMUTABLE_ARG_TYPES = {str, int, float, bool, bytes, type(None)}
 
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
-    def __init__(self, queue):
+    def __init__(self, listener):
         logging.Handler.__init__(self)
-        self.queue = queue
+        self.listener = listener
     def emit(self, record):
         try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
-            self.queue.put_nowait(record)
+            args = record.args
+            if (record.exc_info or type(record.msg) is not str
+                or type(args) is not tuple
+                or not IMMUTABLE_ARG_TYPES.issuperset(map(type, args))):
+                # Format now, as the arguments may change (or hold
+                # references) by the time the background thread runs
+                self.format(record)
+                record.msg = record.message
+                record.args = None
+                record.exc_info = None
+            self.listener.queue_record(record)
         except Exception:
             self.handleError(record)
 
@@ -25,18 +39,53 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
     def __init__(self, filename):
         logging.handlers.TimedRotatingFileHandler.__init__(
             self, filename, when='midnight', backupCount=5)
-        self.bg_queue = queue.Queue()
+        self.bg_queue = collections.deque()
+        self.bg_event = threading.Event()
+        self.bg_stop = False
+        self.dropped = self.reported_dropped = 0
+        self.in_batch = False
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
         self.rollover_info = {}
+    def queue_record(self, record):
+        bg_queue = self.bg_queue
+        if (len(bg_queue) >= MAX_QUEUED_RECORDS
+            and record.levelno < logging.WARNING):
+            # The background thread is not keeping up - drop the record
+            self.dropped += 1
+            return
+        bg_queue.append(record)
+        if not self.bg_event.is_set():
+            self.bg_event.set()
     def _bg_thread(self):
+        bg_queue = self.bg_queue
         while 1:
-            record = self.bg_queue.get(True)
-            if record is None:
+            self.bg_event.wait()
+            # Clear the event before draining so that records queued
+            # during the drain wake the thread again
+            self.bg_event.clear()
+            stop = self.bg_stop
+            self.in_batch = True
+            while bg_queue:
+                self.handle(bg_queue.popleft())
+            dropped = self.dropped - self.reported_dropped
+            if dropped:
+                self.reported_dropped += dropped
+                self.handle(logging.makeLogRecord(
+                    {'msg': "Dropped %d log messages" % (dropped,),
+                     'levelno': logging.WARNING,
+                     'levelname': 'WARNING'}))
+            # Write out the whole batch at once
+            self.in_batch = False
+            self.flush()
+            if stop:
                 break
-            self.handle(record)
+    def flush(self):
+        if not self.in_batch:
+            logging.handlers.TimedRotatingFileHandler.flush(self)
     def stop(self):
-        self.bg_queue.put_nowait(None)
+        self.bg_stop = True
+        self.bg_event.set()
         self.bg_thread.join()
     def set_rollover_info(self, name, info):
         if info is None:
@@ -60,7 +109,7 @@ MainQueueHandler = None
 def setup_bg_logging(filename, debuglevel):
     global MainQueueHandler
     ql = QueueListener(filename)
-    MainQueueHandler = QueueHandler(ql.bg_queue)
+    MainQueueHandler = QueueHandler(ql)
     root = logging.getLogger()
     root.addHandler(MainQueueHandler)
     root.setLevel(debuglevel)
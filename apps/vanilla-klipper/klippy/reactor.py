@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, collections, heapq
 import greenlet
 import chelper, util
 
@@ -14,6 +14,9 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        # Sequence number of the timer's current heap entry (older
+        # entries are stale); -1 once the timer is unregistered
+        self.heap_seq = 0
 
 class ReactorCompletion:
     class sentinel: pass
@@ -72,6 +75,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -101,12 +106,18 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        # Timers - a heap of (waketime, seq, timer) entries with lazy
+        # deletion.  Entries scheduled during a timer pass are staged in
+        # _timer_pending so that each timer runs at most once per pass.
+        self._timer_heap = []
+        self._timer_pending = []
+        self._timer_seq = 0
+        self._timer_count = 0
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
-        self._async_queue = queue.Queue()
+        self._async_queue = collections.deque()
+        self._async_signaled = False
         # File descriptors
         self._read_fds = []
         self._write_fds = []
@@ -117,21 +128,37 @@ class SelectReactor:
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
     # Timers
+    def _schedule_timer(self, timer_handler, waketime):
+        self._timer_seq = seq = self._timer_seq + 1
+        timer_handler.heap_seq = seq
+        if waketime < self.NEVER:
+            self._timer_pending.append((waketime, seq, timer_handler))
+            self._next_timer = min(self._next_timer, waketime)
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
-        self._next_timer = min(self._next_timer, waketime)
+        if timer_handler.heap_seq >= 0:
+            self._schedule_timer(timer_handler, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        self._timer_count += 1
+        self._schedule_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        if timer_handler.heap_seq >= 0:
+            timer_handler.heap_seq = -1
+            self._timer_count -= 1
+    def _merge_pending_timers(self):
+        heap = self._timer_heap
+        if len(heap) > 4 * self._timer_count + 64:
+            # Too many stale entries - rebuild the heap
+            heap[:] = [e for e in heap if e[2].heap_seq == e[1]]
+            heapq.heapify(heap)
+        pending = self._timer_pending
+        self._timer_pending = []
+        for entry in pending:
+            if entry[2].heap_seq == entry[1]:
+                heapq.heappush(heap, entry)
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -149,18 +176,28 @@ class SelectReactor:
                     gc.collect(gc_level)
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
+        self._merge_pending_timers()
         self._next_timer = self.NEVER
+        heap = self._timer_heap
+        heappop = heapq.heappop
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        while heap:
+            waketime, seq, t = heap[0]
+            if t.heap_seq != seq:
+                heappop(heap)
+                continue
+            if eventtime < waketime:
+                self._next_timer = min(self._next_timer, waketime)
+                break
+            heappop(heap)
+            t.heap_seq = 0
+            t.waketime = self.NEVER
+            t.waketime = waketime = t.callback(eventtime)
+            if t.heap_seq >= 0:
+                self._schedule_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._end_greenlet(g_dispatch)
+                return 0.
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -169,28 +206,36 @@ class SelectReactor:
         rcb = ReactorCallback(self, callback, waketime)
         return rcb.completion
     # Asynchronous (from another thread) callbacks and completions
-    def register_async_callback(self, callback, waketime=NOW):
-        self._async_queue.put_nowait(
-            (ReactorCallback, (self, callback, waketime)))
+    def _async_signal(self):
+        # Only wake the reactor if it has not already been signaled
+        # since it last drained the queue
+        if self._async_signaled:
+            return
+        self._async_signaled = True
         try:
             os.write(self._pipe_fds[1], b'.')
         except os.error:
             pass
+    def register_async_callback(self, callback, waketime=NOW):
+        self._async_queue.append(
+            (ReactorCallback, (self, callback, waketime)))
+        self._async_signal()
     def async_complete(self, completion, result):
-        self._async_queue.put_nowait((completion.complete, (result,)))
-        try:
-            os.write(self._pipe_fds[1], b'.')
-        except os.error:
-            pass
+        self._async_queue.append((completion.complete, (result,)))
+        self._async_signal()
     def _got_pipe_signal(self, eventtime):
         try:
             os.read(self._pipe_fds[0], 4096)
         except os.error:
             pass
+        # Clear the signal before draining so that entries queued during
+        # the drain wake the reactor again
+        self._async_signaled = False
+        popleft = self._async_queue.popleft
         while 1:
             try:
-                func, args = self._async_queue.get_nowait()
-            except queue.Empty:
+                func, args = popleft()
+            except IndexError:
                 break
             func(*args)
     def _setup_async_callbacks(self):
@@ -198,6 +243,9 @@ class SelectReactor:
         util.set_nonblock(self._pipe_fds[0])
         util.set_nonblock(self._pipe_fds[1])
         self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
+        self._async_signaled = False
+        if self._async_queue:
+            self._async_signal()
     # Greenlets
     def _sys_pause(self, waketime):
         # Pause using system sleep for when reactor not running
@@ -11,6 +11,9 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Maximum number of messages to pull from the serialqueue at once
+PULL_BATCH_SIZE = 32
+
 class SerialReader:
     def __init__(self, reactor, warn_prefix=""):
         self.reactor = reactor
@@ -34,29 +37,35 @@ class SerialReader:
         self.last_notify_id = 0
         self.pending_notifications = {}
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_BATCH_SIZE,))
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, PULL_BATCH_SIZE)
             if count < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
-            except:
-                logging.exception("%sException in serial callback",
-                                  self.warn_prefix)
+            # Dispatch the batch in order, holding the lock once per batch
+            with self.lock:
+                for i in range(count):
+                    response = responses[i]
+                    if response.notify_id:
+                        params = {'#sent_time': response.sent_time,
+                                  '#receive_time': response.receive_time}
+                        completion = self.pending_notifications.pop(
+                            response.notify_id)
+                        self.reactor.async_complete(completion, params)
+                        continue
+                    params = self.msgparser.parse(
+                        response.msg[0:response.len])
+                    params['#sent_time'] = response.sent_time
+                    params['#receive_time'] = response.receive_time
+                    hdl = (params['#name'], params.get('oid'))
+                    try:
+                        hdl = self.handlers.get(hdl, self.handle_default)
+                        hdl(params)
+                    except:
+                        logging.exception("%sException in serial callback",
+                                          self.warn_prefix)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
     def _get_identify_data(self, eventtime):
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, pty, fcntl, termios, signal, logging, json, time
-import subprocess, traceback, shlex
+import subprocess, traceback, shlex, importlib
 
 
 ######################################################################
@@ -106,6 +106,21 @@ def setup_python2_wrappers():
 setup_python2_wrappers()
 
 
+######################################################################
+# Optional modules
+######################################################################
+
+# Numpy is optional - callers fall back to pure python when it is None
+NUMPY = []
+def load_numpy():
+    if not NUMPY:
+        try:
+            NUMPY.append(importlib.import_module('numpy'))
+        except ImportError:
+            NUMPY.append(None)
+    return NUMPY[0]
+
+
 ######################################################################
 # General system and software information
 ######################################################################
@@ -7,6 +7,12 @@ import logging, socket, os, sys, errno, json, collections
 import gcode
 
 REQUEST_LOG_SIZE = 20
+# Maximum number of queued messages passed to a single sendmsg() call
+SEND_IOV_MAX = 64
+# Status updates to a client are combined while more than this many bytes
+# are waiting to be sent to it
+SEND_HIGH_WATER = 256 * 1024
+MSG_TERMINATOR = b"\x03"
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
@@ -182,7 +188,10 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        # Queue of encoded messages, the first sent up to send_offset
+        self.send_queue = collections.deque()
+        self.send_offset = self.send_size = 0
         self.is_blocking = False
         self.blocking_count = 0
         self.set_client_info("?", "New connection")
@@ -213,6 +222,8 @@ class ClientConnection:
         self.set_client_info(None, "Disconnected")
         self.reactor.unregister_fd(self.fd_handle)
         self.fd_handle = None
+        self.send_queue.clear()
+        self.send_offset = self.send_size = 0
         try:
             self.sock.close()
         except socket.error:
@@ -270,27 +281,53 @@ class ClientConnection:
     def send(self, data):
         try:
             jmsg = json.dumps(data, separators=(',', ':'))
-            self.send_buffer += jmsg.encode() + b"\x03"
         except (TypeError, ValueError) as e:
             msg = ("json encoding error: %s" % (str(e),))
             logging.exception(msg)
             self.printer.invoke_shutdown(msg)
             return
+        self.send_encoded(jmsg.encode())
+
+    def send_encoded(self, jmsg):
+        # Send an already json encoded message
+        self.send_queue.append(jmsg)
+        self.send_queue.append(MSG_TERMINATOR)
+        self.send_size += len(jmsg) + len(MSG_TERMINATOR)
         if not self.is_blocking:
             self._do_send()
 
+    def is_send_backlogged(self):
+        return self.send_size > SEND_HIGH_WATER
+
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
-        try:
-            sent = self.sock.send(self.send_buffer)
-        except socket.error as e:
-            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
-                logging.info("webhooks: socket write error %d" % (self.uid,))
-                self.close()
-                return
-            sent = 0
-        if sent < len(self.send_buffer):
+        send_queue = self.send_queue
+        while send_queue:
+            # Write queued messages in place, without joining them
+            iov = [memoryview(send_queue[0])[self.send_offset:]]
+            for i in range(1, min(len(send_queue), SEND_IOV_MAX)):
+                iov.append(send_queue[i])
+            iov_size = sum([len(data) for data in iov])
+            try:
+                sent = self.sock.sendmsg(iov)
+            except socket.error as e:
+                if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    logging.info("webhooks: socket write error %d"
+                                 % (self.uid,))
+                    self.close()
+                    return
+                sent = 0
+            self.send_size -= sent
+            is_partial = sent < iov_size
+            # Advance past the fully sent messages
+            sent += self.send_offset
+            while send_queue and sent >= len(send_queue[0]):
+                sent -= len(send_queue.popleft())
+            self.send_offset = sent
+            if is_partial:
+                break
+        if send_queue:
             if not self.is_blocking:
                 self.reactor.set_fd_wake(self.fd_handle, False, True)
                 self.is_blocking = True
@@ -298,7 +335,6 @@ class ClientConnection:
         elif self.is_blocking:
             self.reactor.set_fd_wake(self.fd_handle, True, False)
             self.is_blocking = False
-        self.send_buffer = self.send_buffer[sent:]
 
 class WebHooks:
     def __init__(self, printer):
@@ -463,6 +499,8 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        # Combined status updates held back from slow clients
+        self.deferred_status = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -477,15 +515,15 @@ class QueryStatusHelper:
         query = self.last_query = {}
         msglist = self.pending_queries
         self.pending_queries = []
-        msglist.extend(self.clients.values())
-        # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
-            is_query = cconn is None
-            if not is_query and cconn.is_closed():
-                del self.clients[cconn]
+        for cinfo in list(self.clients.values()):
+            if cinfo[0].is_closed():
+                del self.clients[cinfo[0]]
+                self.deferred_status.pop(cinfo[0], None)
                 continue
-            # Query each requested printer object
-            cquery = {}
+            msglist.append(cinfo)
+        # Query each requested printer object once
+        obj_fields = {}
+        for cconn, subscription, send_func, template, prefix in msglist:
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
@@ -498,19 +536,56 @@ class QueryStatusHelper:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
-                    cquery[obj_name] = cres
-            # Send data
-            if cquery or is_query:
+                obj_fields.setdefault(obj_name, set()).update(req_items)
+        # Find the changed fields of each object, shared by all clients
+        changes = {}
+        for obj_name, fields in obj_fields.items():
+            res = query[obj_name]
+            lres = last_query.get(obj_name, {})
+            ochanges = {}
+            for ri in fields:
+                rd = res.get(ri, None)
+                if rd != lres.get(ri):
+                    ochanges[ri] = rd
+            if ochanges:
+                changes[obj_name] = ochanges
+        # Send data, encoding the status once per distinct subscription
+        encoded = {}
+        for cconn, subscription, send_func, template, prefix in msglist:
+            if cconn is None:
+                cquery = {}
+                for obj_name, req_items in subscription.items():
+                    res = query[obj_name]
+                    cquery[obj_name] = {ri: res.get(ri, None)
+                                        for ri in (req_items or [])}
+                tmp = dict(template)
+                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
+                send_func(tmp)
+                continue
+            if cconn in self.deferred_status or cconn.is_send_backlogged():
+                self._send_deferred(cconn, subscription, send_func, template,
+                                    changes, eventtime)
+                continue
+            if not changes:
+                continue
+            sub_key = tuple([(obj_name, tuple(req_items or ()))
+                             for obj_name, req_items in subscription.items()])
+            params = encoded.get(sub_key)
+            if params is None:
+                cquery = self._build_status(subscription, changes)
+                params = encoded[sub_key] = self._encode_params(
+                    eventtime, cquery)
+            if params is False:
+                # No changes for this subscription
+                continue
+            if params is None:
+                # Encoding failed, let send() report the error
+                cquery = self._build_status(subscription, changes)
                 tmp = dict(template)
                 tmp['params'] = {'eventtime': eventtime, 'status': cquery}
                 send_func(tmp)
+                continue
+            cconn.send_encoded(prefix + params + b'}')
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -518,6 +593,47 @@ class QueryStatusHelper:
             self.query_timer = None
             return reactor.NEVER
         return eventtime + SUBSCRIPTION_REFRESH_TIME
+    def _send_deferred(self, cconn, subscription, send_func, template,
+                       changes, eventtime):
+        # Combine the updates for a client that isn't keeping up, so that
+        # only the latest value of each field is queued once it drains
+        deferred = self.deferred_status.setdefault(cconn, {})
+        cquery = self._build_status(subscription, changes)
+        for obj_name, cres in cquery.items():
+            deferred.setdefault(obj_name, {}).update(cres)
+        if cconn.is_send_backlogged():
+            return
+        del self.deferred_status[cconn]
+        if deferred:
+            tmp = dict(template)
+            tmp['params'] = {'eventtime': eventtime, 'status': deferred}
+            send_func(tmp)
+    def _build_status(self, subscription, changes):
+        cquery = {}
+        for obj_name, req_items in subscription.items():
+            ochanges = changes.get(obj_name)
+            if ochanges is None or not req_items:
+                continue
+            cres = {ri: ochanges[ri] for ri in req_items if ri in ochanges}
+            if cres:
+                cquery[obj_name] = cres
+        return cquery
+    def _encode_params(self, eventtime, cquery):
+        if not cquery:
+            return False
+        try:
+            return json.dumps({'eventtime': eventtime, 'status': cquery},
+                              separators=(',', ':')).encode()
+        except (TypeError, ValueError):
+            return None
+    def _encode_template(self, template):
+        # Encode the response template up to the start of the params value
+        tmp = dict(template)
+        tmp.pop('params', None)
+        jmsg = json.dumps(tmp, separators=(',', ':'))[:-1]
+        if tmp:
+            jmsg += ','
+        return (jmsg + '"params":').encode()
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -533,9 +649,11 @@ class QueryStatusHelper:
         template = web_request.get_dict('response_template', {})
         if is_subscribe and cconn in self.clients:
             del self.clients[cconn]
+            self.deferred_status.pop(cconn, None)
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append(
+            (None, objects, complete.complete, {}, None))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -544,7 +662,9 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            prefix = self._encode_template(template)
+            self.clients[cconn] = (cconn, objects, cconn.send, template,
+                                   prefix)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Benchmark of the bed_mesh move splitting versus the sampled implementation
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, math, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bed_mesh
+
+class FakeConfig:
+    def __init__(self, options):
+        self.options = options
+    def getfloat(self, option, default, minval=None):
+        return self.options.get(option, default)
+
+# The original calc_z(), using a lerp of the mesh_matrix for each lookup
+def legacy_calc_z(mesh, x, y):
+    def get_linear_index(coord, mesh_min, mesh_cnt, mesh_dist):
+        idx = int(math.floor((coord - mesh_min) / mesh_dist))
+        idx = bed_mesh.constrain(idx, 0, mesh_cnt - 2)
+        t = (coord - (mesh_min + mesh_dist * idx)) / mesh_dist
+        return bed_mesh.constrain(t, 0., 1.), idx
+    tbl = mesh.mesh_matrix
+    tx, xidx = get_linear_index(x + mesh.mesh_offsets[0], mesh.mesh_x_min,
+                                mesh.mesh_x_count, mesh.mesh_x_dist)
+    ty, yidx = get_linear_index(y + mesh.mesh_offsets[1], mesh.mesh_y_min,
+                                mesh.mesh_y_count, mesh.mesh_y_dist)
+    z0 = bed_mesh.lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
+    z1 = bed_mesh.lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
+    return bed_mesh.lerp(ty, z0, z1)
+
+# The original splitter, which evaluates the mesh at every check distance
+class LegacyMoveSplitter(bed_mesh.MoveSplitter):
+    def _update_skip_distance(self):
+        self.skip_distance = 0.
+    def _calc_z_offset(self, pos):
+        z = legacy_calc_z(self.z_mesh, pos[0], pos[1])
+        offset = self.fade_offset
+        return self.z_factor * (z - offset) + offset
+
+def build_mesh(probe_count, pps, algo, size, seed):
+    rnd = random.Random(seed)
+    params = {'min_x': 10., 'max_x': size - 10., 'min_y': 10.,
+              'max_y': size - 10., 'x_count': probe_count,
+              'y_count': probe_count, 'mesh_x_pps': pps, 'mesh_y_pps': pps,
+              'algo': algo, 'tension': .2}
+    # A warped bed with some probe noise
+    z_matrix = [[.1 * math.sin(i * .5 + j * .3) + rnd.uniform(-.02, .02)
+                 for i in range(probe_count)] for j in range(probe_count)]
+    mesh = bed_mesh.ZMesh(params, "benchmark")
+    mesh.build_mesh(z_matrix)
+    return mesh
+
+def build_moves(count, size, seed):
+    rnd = random.Random(seed)
+    moves = []
+    pos = [size / 2., size / 2., .2, 0.]
+    for i in range(count):
+        # Mostly short perimeter and infill moves, some long travels
+        if rnd.random() < .1:
+            length = rnd.uniform(20., size)
+        else:
+            length = rnd.uniform(.2, 10.)
+        angle = rnd.uniform(0., 2. * math.pi)
+        x = bed_mesh.constrain(pos[0] + length * math.cos(angle), 0., size)
+        y = bed_mesh.constrain(pos[1] + length * math.sin(angle), 0., size)
+        next_pos = [x, y, pos[2], pos[3] + length * .05]
+        moves.append((pos, next_pos))
+        pos = next_pos
+    return moves
+
+def run_splitter(splitter, mesh, moves, factor):
+    splitter.initialize(mesh, 0.)
+    out = []
+    for prev_pos, next_pos in moves:
+        splitter.build_move(prev_pos, next_pos, factor)
+        while not splitter.traverse_complete:
+            out.append(tuple(splitter.split()))
+    return out
+
+def time_splitter(splitter, mesh, moves, factor, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.process_time()
+        run_splitter(splitter, mesh, moves, factor)
+        elapsed = time.process_time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=50000,
+                    help="number of moves to split")
+    opts.add_option("-p", "--probe-count", type="int", dest="probe_count",
+                    default=7, help="probe points per axis")
+    opts.add_option("-i", "--pps", type="int", dest="pps", default=2,
+                    help="interpolated points per segment")
+    opts.add_option("-a", "--algo", type="string", dest="algo",
+                    default="bicubic", help="mesh interpolation algorithm")
+    opts.add_option("-f", "--factor", type="float", dest="factor", default=1.,
+                    help="fade factor")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of runs (the best run is reported)")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    size = 300.
+    mesh = build_mesh(options.probe_count, options.pps, options.algo, size, 1)
+    moves = build_moves(options.moves, size, 2)
+    config = FakeConfig({})
+    legacy = LegacyMoveSplitter(config, None)
+    splitter = bed_mesh.MoveSplitter(config, None)
+    # Verify the split moves match the sampled implementation
+    legacy_out = run_splitter(legacy, mesh, moves, options.factor)
+    new_out = run_splitter(splitter, mesh, moves, options.factor)
+    if len(legacy_out) != len(new_out):
+        sys.stderr.write("Split count mismatch: %d vs %d\n"
+                         % (len(legacy_out), len(new_out)))
+        sys.exit(1)
+    for lpos, npos in zip(legacy_out, new_out):
+        if max([abs(l - n) for l, n in zip(lpos, npos)]) > 1e-9:
+            sys.stderr.write("Split mismatch: %s vs %s\n" % (lpos, npos))
+            sys.exit(1)
+    legacy_time = time_splitter(legacy, mesh, moves, options.factor,
+                                options.repeat)
+    new_time = time_splitter(splitter, mesh, moves, options.factor,
+                             options.repeat)
+    count = len(moves)
+    print("moves: %d split moves: %d mesh: %dx%d"
+          % (count, len(new_out), mesh.mesh_x_count, mesh.mesh_y_count))
+    for name, elapsed in [("sampled", legacy_time),
+                          ("cell crossings", new_time)]:
+        print("%-16s %8.3f usec/move %10.0f moves/sec" % (
+            name, elapsed * 1000000. / count, count / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Benchmark of gcode_macro template rendering on typical macros
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import gcode_macro
+
+MACROS = {
+    'PRINT_START': """
+{% set bed_temp = params.BED|default(60)|float %}
+{% set extruder_temp = params.EXTRUDER|default(210)|float %}
+{% set max_x = printer.configfile.settings.stepper_x.position_max %}
+{% set max_y = printer.configfile.settings.stepper_y.position_max %}
+{% if printer.toolhead.homed_axes != "xyz" %}
+G28
+{% endif %}
+M140 S{bed_temp}
+M104 S{extruder_temp * 0.75}
+G1 X{max_x / 2} Y{max_y / 2} Z10 F{printer.toolhead.max_velocity * 60}
+M190 S{bed_temp}
+M109 S{extruder_temp}
+{% if printer.bed_mesh.profile_name == "" %}
+BED_MESH_PROFILE LOAD=default
+{% endif %}
+""",
+    'LAYER_CHANGE': """
+{% set layer = printer.print_stats.info.current_layer|int %}
+{% set vars = printer["gcode_macro _PRINT_VARS"] %}
+{% if layer == vars.fan_layer %}
+M106 S{vars.fan_speed}
+{% endif %}
+{% if printer.extruder.target < printer.extruder.temperature - 5 %}
+RESPOND MSG="Layer {layer}: extruder cooling"
+{% endif %}
+""",
+    'PAUSE': """
+{% set pos = printer.gcode_move.gcode_position %}
+{% set max_z = printer.toolhead.axis_maximum.z %}
+{% set z = [pos.z + 10, max_z]|min %}
+SAVE_GCODE_STATE NAME=PAUSE_state
+SET_GCODE_VARIABLE MACRO=_PRINT_VARS VARIABLE=pause_z VALUE={pos.z}
+G91
+{% if printer.extruder.can_extrude %}
+G1 E-1 F2100
+{% endif %}
+G90
+G1 Z{z} F600
+G1 X{printer.toolhead.axis_minimum.x + 5} F6000
+G1 Y{printer.toolhead.axis_maximum.y - 5} F6000
+""",
+    'STATUS_DISPLAY': """
+{% if printer.virtual_sdcard.is_active %}
+{ "%3d%%"|format(printer.virtual_sdcard.progress * 100) }
+{% endif %}
+{ "E%3.0f/%3.0f"|format(printer.extruder.temperature,
+                        printer.extruder.target) }
+{ "B%3.0f/%3.0f"|format(printer.heater_bed.temperature,
+                        printer.heater_bed.target) }
+{% for name in ["toolhead", "extruder"] %}
+{ name } { printer[name].print_time|default(0) }
+{% endfor %}
+""",
+}
+
+class StatusObject:
+    def __init__(self, status):
+        self.status = status
+    def get_status(self, eventtime):
+        return self.status
+
+class FakeReactor:
+    def monotonic(self):
+        return 0.
+
+class FakePrinter:
+    def __init__(self, objects):
+        self.objects = objects
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def lookup_objects(self, module=None):
+        return list(self.objects.items())
+    def get_reactor(self):
+        return FakeReactor()
+
+class FakeConfig:
+    def __init__(self, printer):
+        self.printer = printer
+    def get_printer(self):
+        return self.printer
+
+def build_printer():
+    # A printer config with the size of a typical user setup
+    config = {}
+    for i in range(60):
+        config['section_%d' % (i,)] = {
+            'option_%d' % (j,): '%d.%d' % (i, j) for j in range(12)}
+    for axis in 'xyz':
+        config['stepper_' + axis] = {'position_max': 250., 'step_pin': 'PA0',
+                                     'microsteps': 16, 'rotation_distance': 40.}
+    mesh = [[.01 * (i - j) for i in range(9)] for j in range(9)]
+    status = {
+        'configfile': {'config': config, 'settings': config,
+                       'warnings': [], 'save_config_pending': False},
+        'toolhead': {'homed_axes': "xyz", 'print_time': 12.,
+                     'position': [10., 20., 5., 100.],
+                     'axis_minimum': {'x': 0., 'y': 0., 'z': -2.},
+                     'axis_maximum': {'x': 250., 'y': 250., 'z': 250.},
+                     'max_velocity': 300., 'max_accel': 3000.},
+        'extruder': {'temperature': 210., 'target': 210., 'power': .4,
+                     'can_extrude': True, 'pressure_advance': .04,
+                     'smooth_time': .04, 'print_time': 12.},
+        'heater_bed': {'temperature': 60., 'target': 60., 'power': .2},
+        'print_stats': {'filename': "part.gcode", 'state': "printing",
+                        'print_duration': 100., 'filament_used': 10.,
+                        'info': {'current_layer': 5, 'total_layer': 100}},
+        'gcode_move': {'gcode_position': {'x': 10., 'y': 20., 'z': 5.,
+                                          'e': 100.},
+                       'homing_origin': {'x': 0., 'y': 0., 'z': 0., 'e': 0.},
+                       'speed_factor': 1., 'absolute_coordinates': True},
+        'virtual_sdcard': {'file_path': "/tmp/part.gcode", 'progress': .05,
+                           'is_active': True, 'file_position': 1000,
+                           'file_size': 20000},
+        'bed_mesh': {'profile_name': "default", 'mesh_matrix': mesh,
+                     'probed_matrix': mesh,
+                     'profiles': {'default': {'points': mesh,
+                                              'mesh_params': {}}}},
+        'gcode_macro _PRINT_VARS': {'fan_layer': 5, 'fan_speed': 255,
+                                    'pause_z': 0.},
+    }
+    objects = {name: StatusObject(s) for name, s in status.items()}
+    printer = FakePrinter(objects)
+    objects['gcode'] = object()
+    objects['gcode_macro'] = gcode_macro.load_config(FakeConfig(printer))
+    return printer, objects['gcode_macro']
+
+def render_all(templates, create_context, context_args):
+    return [t.render(dict(create_context(), params=context_args))
+            for t in templates]
+
+def time_render(templates, create_context, context_args, count):
+    start = time.process_time()
+    for i in range(count):
+        render_all(templates, create_context, context_args)
+    return time.process_time() - start
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--renders", type="int", dest="renders",
+                    default=2000, help="number of renders of each macro")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    printer, pgm = build_printer()
+    templates = [gcode_macro.TemplateWrapper(printer, pgm.env, name, script)
+                 for name, script in sorted(MACROS.items())]
+    params = {'BED': "65", 'EXTRUDER': "215"}
+    for t in templates:
+        print("%-16s reads %s" % (t.name, t.status_refs))
+    lazy_refs = [t.status_refs for t in templates]
+    # Verify the output matches rendering with full status copies
+    lazy_out = render_all(templates, pgm.create_template_context, params)
+    for t in templates:
+        t.status_refs = None
+    full_out = render_all(templates, pgm.create_template_context, params)
+    if lazy_out != full_out:
+        sys.stderr.write("Render mismatch:\n%s\nvs\n%s\n"
+                         % (lazy_out, full_out))
+        sys.exit(1)
+    full_time = time_render(templates, pgm.create_template_context, params,
+                            options.renders)
+    for t, refs in zip(templates, lazy_refs):
+        t.status_refs = refs
+    lazy_time = time_render(templates, pgm.create_template_context, params,
+                            options.renders)
+    count = options.renders * len(templates)
+    print("renders: %d" % (count,))
+    for name, elapsed in [("full status", full_time),
+                          ("used fields", lazy_time)]:
+        print("%-16s %8.3f usec/render %10.0f renders/sec" % (
+            name, elapsed * 1000000. / count, count / elapsed))
+
+if __name__ == '__main__':
+    main()
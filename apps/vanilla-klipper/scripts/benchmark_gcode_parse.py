@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Benchmark of the G-Code line parsing throughput over sliced files
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import gcode
+
+def load_lines(filenames, max_lines):
+    lines = []
+    for filename in filenames:
+        with open(filename, 'r', errors='replace') as f:
+            for line in f:
+                # Strip comments as _process_commands() does
+                line = line.strip()
+                cpos = line.find(';')
+                if cpos >= 0:
+                    line = line[:cpos]
+                lines.append(line)
+                if len(lines) >= max_lines:
+                    return lines
+    return lines
+
+def time_parser(parse, lines, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.process_time()
+        for line in lines:
+            parse(line)
+        elapsed = time.process_time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    usage = "%prog [options] <file.gcode> [<file.gcode> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--lines", type="int", dest="lines",
+                    default=1000000, help="max number of lines to parse")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of runs (the best run is reported)")
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Incorrect number of arguments")
+    lines = load_lines(args, options.lines)
+    # The parsers only use class attributes, so no printer is needed
+    gd = gcode.GCodeDispatch.__new__(gcode.GCodeDispatch)
+    # Verify the fast path matches the full parser
+    for line in lines:
+        if gd._parse_line(line) != gd._parse_line_full(line):
+            sys.stderr.write("Parse mismatch on line: %s\n" % (line,))
+            sys.exit(1)
+    full_time = time_parser(gd._parse_line_full, lines, options.repeat)
+    fast_time = time_parser(gd._parse_line, lines, options.repeat)
+    count = len(lines)
+    print("lines: %d" % (count,))
+    for name, elapsed in [("full parser", full_time),
+                          ("with fast path", fast_time)]:
+        print("%-16s %8.3f usec/line %10.0f lines/sec" % (
+            name, elapsed * 1000000. / count, count / elapsed))
+
+if __name__ == '__main__':
+    main()
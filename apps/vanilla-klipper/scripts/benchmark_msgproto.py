@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Benchmark of the mcu response decoding throughput
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, json, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+# Responses typical of a printing mcu (from a stm32 build)
+SYNTHETIC_DICTIONARY = {
+    'commands': {'get_clock': 2},
+    'responses': {
+        'clock clock=%u': 80,
+        'stepper_position oid=%c pos=%i': 81,
+        'analog_in_state oid=%c next_clock=%u value=%hu': 82,
+        'trsync_state oid=%c can_trigger=%c trigger_reason=%c clock=%u': 83,
+        'endstop_state oid=%c homing=%c next_clock=%u pin_value=%c': 84,
+        'sensor_bulk_data oid=%c sequence=%hu data=%*s': 120,
+        'stats count=%u sum=%u sumsq=%u': 121,
+        'shutdown clock=%u static_string_id=%hu': 122,
+    },
+    'output': {'Got %u bytes: %.*s': 123},
+}
+
+def synthetic_messages(parser, count, seed):
+    rnd = random.Random(seed)
+    builders = [
+        ('clock', lambda: {'clock': rnd.randrange(1<<32)}),
+        ('stepper_position', lambda: {'oid': rnd.randrange(12),
+                                      'pos': rnd.randrange(-1<<31, 1<<31)}),
+        ('analog_in_state', lambda: {'oid': rnd.randrange(4),
+                                     'next_clock': rnd.randrange(1<<32),
+                                     'value': rnd.randrange(1<<14)}),
+        ('trsync_state', lambda: {'oid': rnd.randrange(4),
+                                  'can_trigger': rnd.randrange(2),
+                                  'trigger_reason': rnd.randrange(5),
+                                  'clock': rnd.randrange(1<<32)}),
+        ('sensor_bulk_data', lambda: {
+            'oid': 0, 'sequence': rnd.randrange(1<<16),
+            'data': bytes([rnd.randrange(256) for i in range(48)])}),
+        ('stats', lambda: {'count': rnd.randrange(1<<16),
+                           'sum': rnd.randrange(1<<32),
+                           'sumsq': rnd.randrange(1<<32)}),
+    ]
+    msgs = []
+    for i in range(count):
+        name, builder = rnd.choice(builders)
+        cmd = parser.messages_by_name[name].encode_by_name(**builder())
+        msg = [msgproto.MESSAGE_MIN + len(cmd), msgproto.MESSAGE_DEST] + cmd
+        msg.extend(msgproto.crc16_ccitt(msg))
+        msg.append(msgproto.MESSAGE_SYNC)
+        msgs.append(bytes(msg))
+    return msgs
+
+# Split a capture of the raw mcu serial stream into messages
+def split_capture(parser, data):
+    msgs = []
+    pos = 0
+    while pos < len(data):
+        msglen = parser.check_packet(data[pos:pos + msgproto.MESSAGE_MAX])
+        if msglen <= 0:
+            # Resync on the next sync byte
+            sync = data.find(bytes([msgproto.MESSAGE_SYNC]), pos)
+            if sync < 0:
+                break
+            pos = sync + 1
+            continue
+        msgs.append(data[pos:pos + msglen])
+        pos += msglen
+    return msgs
+
+# The decoding prior to the specialized parsers
+def reference_parse(parser, s):
+    pos = msgproto.MESSAGE_HEADER_SIZE
+    msgid, param_pos = parser.msgid_parser.parse(s, pos)
+    mid = parser.messages_by_id.get(msgid, parser.unknown)
+    if not isinstance(mid, msgproto.MessageFormat):
+        params, pos = mid.parse(s, msgproto.MESSAGE_HEADER_SIZE)
+    else:
+        pos = msgproto.MESSAGE_HEADER_SIZE + len(mid.msgid_bytes)
+        params = {}
+        for name, t in mid.param_names:
+            v, pos = t.parse(s, pos)
+            params[name] = v
+    if pos != len(s) - msgproto.MESSAGE_TRAILER_SIZE:
+        raise msgproto.error("Extra data at end of message")
+    params['#name'] = mid.name
+    return params
+
+def time_parser(parse, msgs, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.process_time()
+        for s in msgs:
+            parse(s)
+        elapsed = time.process_time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    usage = "%prog [options] [<dictionary.json> <serial_capture.bin>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--messages", type="int", dest="messages",
+                    default=200000, help="number of synthetic messages")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of runs (the best run is reported)")
+    options, args = opts.parse_args()
+    parser = msgproto.MessageParser()
+    if len(args) == 2:
+        with open(args[0], 'r') as f:
+            parser.process_identify(f.read(), decompress=False)
+        with open(args[1], 'rb') as f:
+            msgs = split_capture(parser, f.read())
+    elif not args:
+        parser.process_identify(json.dumps(SYNTHETIC_DICTIONARY),
+                                decompress=False)
+        msgs = synthetic_messages(parser, options.messages, 1)
+    else:
+        opts.error("Incorrect number of arguments")
+    if not msgs:
+        opts.error("No messages found in capture")
+    # Verify the specialized parsers match the generic decoding
+    for s in msgs:
+        if parser.parse(s) != reference_parse(parser, s):
+            sys.stderr.write("Parse mismatch on message: %s\n" % (s.hex(),))
+            sys.exit(1)
+    ref_time = time_parser(lambda s: reference_parse(parser, s), msgs,
+                           options.repeat)
+    new_time = time_parser(parser.parse, msgs, options.repeat)
+    count = len(msgs)
+    print("messages: %d" % (count,))
+    for name, elapsed in [("generic", ref_time), ("specialized", new_time)]:
+        print("%-16s %8.3f usec/msg %10.0f msgs/sec" % (
+            name, elapsed * 1000000. / count, count / elapsed))
+
+if __name__ == '__main__':
+    main()
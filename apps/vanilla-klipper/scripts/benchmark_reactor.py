@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the reactor timer dispatch cost versus timer count
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+def run_benchmark(timer_count, dispatches, idle_ratio):
+    r = reactor.SelectReactor()
+    rnd = random.Random(timer_count)
+    counts = [0]
+    def make_timer(period):
+        def callback(eventtime):
+            counts[0] += 1
+            return eventtime + period
+        return callback
+    # Most registered timers are idle (eg, disabled heaters, unused
+    # fans), the rest are periodic with typical klippy periods
+    for i in range(timer_count):
+        if rnd.random() < idle_ratio:
+            r.register_timer(make_timer(1.), r.NEVER)
+        else:
+            period = rnd.choice([.001, .005, .1, .25, .3, 1.])
+            r.register_timer(make_timer(period), rnd.random())
+    # Drive the timer dispatch directly with a simulated clock
+    eventtime = 0.
+    start = time.process_time()
+    passes = 0
+    while counts[0] < dispatches:
+        eventtime = max(eventtime, r._next_timer)
+        r._check_timers(eventtime, False)
+        passes += 1
+    elapsed = time.process_time() - start
+    return elapsed, counts[0], passes
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--dispatches", type="int", dest="dispatches",
+                    default=200000, help="number of timer callbacks to run")
+    opts.add_option("-c", "--counts", type="string", dest="counts",
+                    default="10,50,100,200,500,1000",
+                    help="comma separated list of timer counts")
+    opts.add_option("-i", "--idle", type="float", dest="idle", default=.5,
+                    help="fraction of registered timers that are idle")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    print("%8s %12s %12s %14s" % ("timers", "callbacks", "passes",
+                                  "usec/callback"))
+    for timer_count in [int(c) for c in options.counts.split(',')]:
+        elapsed, callbacks, passes = run_benchmark(
+            timer_count, options.dispatches, options.idle)
+        print("%8d %12d %12d %14.3f" % (timer_count, callbacks, passes,
+                                        elapsed * 1000000. / callbacks))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Benchmark of the input shaper fitting on recorded accelerometer data
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import numpy as np
+from extras import shaper_calibrate, shaper_defs
+
+def parse_log(logname):
+    # Raw accelerometer data as written by ACCELEROMETER_MEASURE
+    with open(logname) as f:
+        for header in f:
+            if not header.startswith('#'):
+                break
+            if not header.startswith('#time'):
+                # Already processed calibration data
+                return None
+    return np.loadtxt(logname, comments='#', delimiter=',')
+
+def synthetic_data(duration=30., sample_rate=3200.):
+    # A resonance test sweep exciting two resonances, with sensor noise
+    rng = np.random.default_rng(1)
+    t = np.arange(0., duration, 1. / sample_rate)
+    freq = 5. + 130. * t / duration
+    sweep = np.sin(2. * np.pi * np.cumsum(freq) / sample_rate)
+    gain = (3. / (1. + ((freq - 42.) / 3.)**2)
+            + 2. / (1. + ((freq - 71.) / 4.)**2))
+    accel = 1000. * sweep * gain
+    return np.stack([t, accel + rng.normal(0., 300., t.shape),
+                     .3 * accel + rng.normal(0., 300., t.shape),
+                     rng.normal(0., 50., t.shape)], axis=1)
+
+# The per shaper evaluation prior to the vectorized fitting
+def estimate_shaper(shaper, test_damping_ratio, test_freqs):
+    A, T = np.array(shaper[0]), np.array(shaper[1])
+    inv_D = 1. / A.sum()
+
+    omega = 2. * math.pi * test_freqs
+    damping = test_damping_ratio * omega
+    omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
+    W = A * np.exp(np.outer(-damping, (T[-1] - T)))
+    S = W * np.sin(np.outer(omega_d, T))
+    C = W * np.cos(np.outer(omega_d, T))
+    return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
+
+def estimate_remaining_vibrations(shaper, test_damping_ratio, freq_bins, psd):
+    vals = estimate_shaper(shaper, test_damping_ratio, freq_bins)
+    vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+    remaining_vibrations = np.maximum(vals * psd - vibr_threshold, 0).sum()
+    all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+    return (remaining_vibrations / all_vibrations, vals)
+
+def get_shaper_smoothing(shaper, accel=5000, scv=5.):
+    half_accel = accel * .5
+
+    A, T = shaper
+    inv_D = 1. / sum(A)
+    n = len(T)
+    # Calculate input shaper shift
+    ts = sum([A[i] * T[i] for i in range(n)]) * inv_D
+
+    # Calculate offset for 90 and 180 degrees turn
+    offset_90 = offset_180 = 0.
+    for i in range(n):
+        if T[i] >= ts:
+            # Calculate offset for one of the axes
+            offset_90 += A[i] * (scv + half_accel * (T[i]-ts)) * (T[i]-ts)
+        offset_180 += A[i] * half_accel * (T[i]-ts)**2
+    offset_90 *= inv_D * math.sqrt(2.)
+    offset_180 *= inv_D
+    return max(offset_90, offset_180)
+
+def bisect(func):
+    left = right = 1.
+    if not func(1e-9):
+        return 0.
+    while not func(left):
+        right = left
+        left *= .5
+    if right == left:
+        while func(right):
+            right *= 2.
+    while right - left > 1e-8:
+        middle = (left + right) * .5
+        if func(middle):
+            left = middle
+        else:
+            right = middle
+    return left
+
+def find_shaper_max_accel(shaper, scv):
+    TARGET_SMOOTHING = 0.12
+    return bisect(lambda test_accel: get_shaper_smoothing(
+        shaper, test_accel, scv) <= TARGET_SMOOTHING)
+
+# The sequential fitting, evaluating one shaper frequency at a time
+def reference_fit_shaper(shaper_cfg, calibration_data, scv, max_smoothing):
+    test_freqs = np.arange(shaper_cfg.min_freq,
+                           shaper_calibrate.MAX_SHAPER_FREQ, .2)
+    freq_bins = calibration_data.freq_bins
+    psd = calibration_data.psd_sum[freq_bins <= shaper_calibrate.MAX_FREQ]
+    freq_bins = freq_bins[freq_bins <= shaper_calibrate.MAX_FREQ]
+    best_res = None
+    results = []
+    for test_freq in test_freqs[::-1]:
+        shaper_vibrations = 0.
+        shaper_vals = np.zeros(shape=freq_bins.shape)
+        shaper = shaper_cfg.init_func(test_freq,
+                                      shaper_defs.DEFAULT_DAMPING_RATIO)
+        shaper_smoothing = get_shaper_smoothing(shaper, scv=scv)
+        if max_smoothing and shaper_smoothing > max_smoothing and best_res:
+            return best_res
+        for dr in shaper_calibrate.TEST_DAMPING_RATIOS:
+            vibrations, vals = estimate_remaining_vibrations(
+                    shaper, dr, freq_bins, psd)
+            shaper_vals = np.maximum(shaper_vals, vals)
+            if vibrations > shaper_vibrations:
+                shaper_vibrations = vibrations
+        max_accel = find_shaper_max_accel(shaper, scv)
+        shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
+                                           shaper_vibrations * .2 + .01)
+        results.append(shaper_calibrate.CalibrationResult(
+                name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
+                vibrs=shaper_vibrations, smoothing=shaper_smoothing,
+                score=shaper_score, max_accel=max_accel))
+        if best_res is None or best_res.vibrs > results[-1].vibrs:
+            best_res = results[-1]
+    selected = best_res
+    for res in results[::-1]:
+        if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
+            selected = res
+    return selected
+
+def main():
+    usage = "%prog [options] [<raw_data.csv> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("--scv", type="float", dest="scv", default=5.,
+                    help="square corner velocity")
+    opts.add_option("--max_smoothing", type="float", dest="max_smoothing",
+                    default=None, help="maximum shaper smoothing")
+    options, args = opts.parse_args()
+    helper = shaper_calibrate.ShaperCalibrate(printer=None)
+    datasets = []
+    for logname in args:
+        data = parse_log(logname)
+        if data is None:
+            opts.error("%s is not a raw accelerometer data file" % (logname,))
+        datasets.append((os.path.basename(logname), data))
+    if not datasets:
+        datasets.append(("synthetic", synthetic_data()))
+    shaper_cfgs = [cfg for cfg in shaper_defs.INPUT_SHAPERS
+                   if cfg.name in shaper_calibrate.AUTOTUNE_SHAPERS]
+    for name, data in datasets:
+        calibration_data = helper.calc_freq_response(data)
+        calibration_data.set_numpy(np)
+        calibration_data.normalize_to_frequencies()
+        start = time.time()
+        reference = [reference_fit_shaper(cfg, calibration_data, options.scv,
+                                          options.max_smoothing)
+                     for cfg in shaper_cfgs]
+        reference_time = time.time() - start
+        start = time.time()
+        best, fitted = helper.find_best_shaper(
+                calibration_data, scv=options.scv,
+                max_smoothing=options.max_smoothing)
+        fitted_time = time.time() - start
+        print("%s: sequential %.2fs, vectorized and parallel %.2fs"
+              % (name, reference_time, fitted_time))
+        for ref, res in zip(reference, fitted):
+            print("  %-9s %6.1f Hz (reference %6.1f Hz)"
+                  " vibrations %5.1f%% max_accel %6.0f"
+                  % (res.name, res.freq, ref.freq, res.vibrs * 100.,
+                     res.max_accel))
+        print("  recommended shaper: %s" % (best.name,))
+
+if __name__ == '__main__':
+    main()